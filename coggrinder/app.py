@@ -4,10 +4,12 @@ Created on Apr 4, 2012
 @author: Clay Carpenter
 """
 from coggrinder.gui.task_widgets import TaskTreeWindowController
-from gi.repository import Gtk
+from gi.repository import Gtk, GObject
 from coggrinder.authentication_services import AuthenticationService
 from coggrinder.gui.authentication_widgets import AuthenticationDialogViewController
-from coggrinder.task_services import GoogleTasksServiceProxy
+from coggrinder.task_services import GoogleTasksServiceProxy, TaskTreeService
+from coggrinder.cache_services import TaskCacheService
+from coggrinder.sync_services import WriteBehindQueue
 
 class CogGrinder(object):
     def start(self):
@@ -15,6 +17,9 @@ class CogGrinder(object):
         Begin the CogGrinder application by authenticating the user, and then
         creating and starting the controller for the primary app view.
         """
+        # Task data is refreshed from a background thread.
+        GObject.threads_init()
+        
         main_controller = TaskTreeWindowController()
 
         # With the UI built, attempt to access the authentication credentials
@@ -49,13 +54,22 @@ class CogGrinder(object):
         tasklist_service = gtasks_service_proxy.create_tasklist_service()
         task_service = gtasks_service_proxy.create_task_service()        
         
-        tasktree_service = TaskTreeService()
-        tasktree_service.tasklist_service = tasklist_service
-        tasktree_service.task_service = task_service
+        tasktree_service = TaskTreeService(tasklist_service, task_service,
+            TaskCacheService())
         
         main_controller.tasktree_service = tasktree_service
-        main_controller.refresh_task_data()
+        
+        # Changes are sent to the task services in the background, along with
+        # any changes left unsent by a previous session.
+        operation_queue = WriteBehindQueue(tasklist_service, task_service)
+        main_controller.attach_operation_queue(operation_queue)
+        operation_queue.start()
+        
+        # Show the last-known task data right away, and then bring it up to 
+        # date with the task services in the background.
+        main_controller.show_cached_task_data()
         main_controller.show()
+        main_controller.refresh_task_data()
         
         Gtk.main()
 #------------------------------------------------------------------------------ 
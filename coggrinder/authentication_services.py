@@ -10,9 +10,70 @@ import oauth2client.tools
 import oauth2client.client
 import oauth2client.file
 
+import threading
 import unittest
 from mockito import mock, when, any
-import apiclient.discovery
+from coggrinder.cache_services import DiscoveryDocumentCache
+
+class AuthorizedHttpPool(object):
+    """
+    An authorized HTTP transport that can be shared by every service proxy and
+    thread in the process.
+    
+    httplib2.Http objects aren't thread-safe, so each thread is handed its own
+    authorized Http the first time it makes a request, and keeps it for later
+    requests. Each Http keeps its connections alive between requests, so only
+    the first request from a thread pays for the connection and TLS 
+    handshake.
+    """
+    DEFAULT_TIMEOUT = 30
+
+    def __init__(self, credentials, timeout=DEFAULT_TIMEOUT, http_factory=None):
+        """
+        Args:
+            credentials: The credentials used to authorize each Http.
+            timeout: Socket timeout, in seconds, for each request.
+            http_factory: Optional function that creates an (unauthorized)
+                Http, given a timeout. Defaults to httplib2.Http.
+        """
+        if http_factory is None:
+            http_factory = httplib2.Http
+
+        self.credentials = credentials
+        self.timeout = timeout
+        self.http_factory = http_factory
+
+        self._thread_state = threading.local()
+        self._lock = threading.Lock()
+        self._all_https = list()
+
+    def get_http(self):
+        """Get the authorized Http belonging to the current thread."""
+        http = getattr(self._thread_state, "http", None)
+        if http is None:
+            http = self.credentials.authorize(
+                self.http_factory(timeout=self.timeout))
+            self._thread_state.http = http
+
+            with self._lock:
+                self._all_https.append(http)
+
+        return http
+
+    def request(self, *args, **kwargs):
+        """Make the request with the current thread's authorized Http. Accepts
+        the same arguments as httplib2.Http.request.
+        """
+        return self.get_http().request(*args, **kwargs)
+
+    @property
+    def http_count(self):
+        """Number of Http objects created (one per thread that made a 
+        request).
+        """
+        with self._lock:
+            return len(self._all_https)
+#------------------------------------------------------------------------------ 
 
 class AuthenticationService(object):        
     def __init__(self, credentials=None, storage=None,
@@ -25,18 +86,26 @@ class AuthenticationService(object):
             oauth_service = OAuthService()
         self.oauth_service = oauth_service
         
-    def authenticate_connection(self):
-        # If credentials aren't already present, acquire them.        
-        if self.credentials is None:        
-            self.credentials = self.get_credentials()        
-        assert self.credentials is not None
-        
-        # Use the credentials to override the default HTTP implementation with
-        # and authorization-aware alternative.
-        http = httplib2.Http()
-        http = self.credentials.authorize(http)
+        self._http_pool = None
+        self._http_pool_lock = threading.Lock()
         
-        return http
+    def authenticate_connection(self):
+        """
+        Get the authorized HTTP transport. The same transport is returned for
+        every call, and can be shared between threads.
+        """
+        with self._http_pool_lock:
+            if self._http_pool is None:
+                # If credentials aren't already present, acquire them.        
+                if self.credentials is None:        
+                    self.credentials = self.get_credentials()        
+                assert self.credentials is not None
+                
+                # Use the credentials to override the default HTTP 
+                # implementation with an authorization-aware alternative.
+                self._http_pool = AuthorizedHttpPool(self.credentials)
+        
+        return self._http_pool
     
     def get_credentials(self):        
         # First check to see if local credentials are already present.        
@@ -72,8 +141,10 @@ class AuthenticationService(object):
 
     def create_gtasks_service_proxy(self):
         authorized_http = self.authenticate_connection()
-        gtasks_service_proxy = apiclient.discovery.build("tasks", "v1",
-            http=authorized_http)
+        gtasks_service_proxy = DiscoveryDocumentCache().build_service("tasks",
+            "v1", authorized_http)
+        
+        return gtasks_service_proxy
 
 class OAuthService(object):
     CLIENT_ID = "877874321255.apps.googleusercontent.com"
@@ -95,6 +166,7 @@ class OAuthService(object):
 class AuthenticationServiceTest(unittest.TestCase):
     def test_authenticate_connection(self):
         mock_http = mock()
+        when(mock_http).request("http://example.com").thenReturn("response")
         
         mock_credentials = mock(oauth2client.client.OAuth2Credentials)
         when(mock_credentials).authorize(any()).thenReturn(mock_http)
@@ -102,7 +174,11 @@ class AuthenticationServiceTest(unittest.TestCase):
         auth_service = AuthenticationService(credentials=mock_credentials)
         http = auth_service.authenticate_connection()
         
-        self.assertIs(http, mock_http)        
+        # The same (shared) transport should be returned each time, and should
+        # make requests with the authorized Http.
+        self.assertIs(http, auth_service.authenticate_connection())
+        self.assertIs(mock_http, http.get_http())
+        self.assertEqual("response", http.request("http://example.com"))
         
     def test_get_credentials_from_storage(self):        
         expected_credentials = mock()
@@ -116,3 +192,43 @@ class AuthenticationServiceTest(unittest.TestCase):
         
         self.assertIs(credentials, expected_credentials)
         
+#------------------------------------------------------------------------------ 
+
+class AuthorizedHttpPoolTest(unittest.TestCase):
+    def setUp(self):
+        # Authorize each Http by simply marking it as authorized.
+        class Credentials(object):
+            def authorize(self, http):
+                http.is_authorized = True
+                return http
+        
+        class Http(object):
+            def __init__(self, timeout=None):
+                self.timeout = timeout
+        
+        self.http_pool = AuthorizedHttpPool(Credentials(), timeout=5,
+            http_factory=Http)
+        
+    def test_get_http_same_thread(self):
+        http = self.http_pool.get_http()
+        
+        self.assertIs(http, self.http_pool.get_http())
+        self.assertTrue(http.is_authorized)
+        self.assertEqual(5, http.timeout)
+        self.assertEqual(1, self.http_pool.http_count)
+        
+    def test_get_http_per_thread(self):
+        thread_https = list()
+        def get_https():
+            thread_https.append(self.http_pool.get_http())
+            thread_https.append(self.http_pool.get_http())
+        
+        threads = [threading.Thread(target=get_https) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        # Each thread should get its own Http, and keep it.
+        self.assertEqual(3, len(set(id(http) for http in thread_https)))
+        self.assertEqual(3, self.http_pool.http_count)
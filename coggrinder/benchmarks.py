@@ -0,0 +1,473 @@
+"""
+Created on May 2, 2012
+
+@author: Clay Carpenter
+
+Simple, console-driven performance benchmarks. Run with:
+    python -m coggrinder.benchmarks
+"""
+import datetime
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import timeit
+from coggrinder.cache_services import TaskCacheService
+from coggrinder.entities.properties import RFC3339Converter
+from coggrinder.entities.tasks import TaskList, Task
+from coggrinder.entities.tree import Tree
+from coggrinder.task_services import TaskTreeService, TaskListService, \
+    TaskService, FakeTaskServiceProxy, FakeTaskListServiceProxy
+
+class EagerPathTree(Tree):
+    """Reproduces the original tree insertion behavior, where the path of
+    every later sibling was rewritten after each insert. Used only as a
+    baseline for the lazy path benchmarks.
+    """
+    def __init__(self):
+        Tree.__init__(self)
+
+        self.eager_paths = dict()
+
+    def insert_node(self, node_indices):
+        child_node = Tree.insert_node(self, node_indices)
+
+        parent_node = child_node.parent
+        parent_path = parent_node.path
+        child_index = node_indices[-1]
+        for index in range(child_index, len(parent_node.children)):
+            updated_node = parent_node.children[index]
+            self.eager_paths[updated_node] = parent_path + (index,)
+
+        return child_node
+#------------------------------------------------------------------------------
+
+class DictBackedObject(object):
+    """Plain object that holds copies of another object's slotted attributes
+    in an instance __dict__. Reproduces the memory layout entities and tree
+    nodes had before they were slotted, for use as a baseline.
+    """
+    def __init__(self, source):
+        for name in BenchmarkUtil.get_slot_names(type(source)):
+            if hasattr(source, name):
+                setattr(self, name, getattr(source, name))
+#------------------------------------------------------------------------------
+
+class BenchmarkUtil(object):
+    @staticmethod
+    def time_call(func, repeat=3, setup=None):
+        """Time the given function, returning the best of the repeated runs in
+        seconds.
+
+        Args:
+            func: The function to time. Called without arguments, unless a
+                setup function is provided.
+            repeat: Number of timed runs.
+            setup: Optional (untimed) function called before each run. Its
+                result is passed as the only argument to func.
+        """
+        if setup is None:
+            return min(timeit.repeat(func, number=1, repeat=repeat))
+
+        timings = list()
+        for i in range(repeat):
+            setup_result = setup()
+
+            start = timeit.default_timer()
+            func(setup_result)
+            timings.append(timeit.default_timer() - start)
+
+        return min(timings)
+
+    @staticmethod
+    def get_slot_names(cls):
+        slot_names = list()
+        for klass in cls.__mro__:
+            slots = klass.__dict__.get("__slots__", ())
+            if isinstance(slots, str):
+                slots = (slots,)
+            slot_names.extend(slots)
+
+        return slot_names
+
+    @staticmethod
+    def get_instance_bytes(obj):
+        """Measure the memory held by an object's own attribute storage: the
+        object itself, plus its instance __dict__ (if any). The attribute
+        values themselves aren't included, as they are the same regardless
+        of how the attributes are stored.
+
+        The tracemalloc module isn't available on the Python 2 runtime, so
+        sys.getsizeof is used instead.
+        """
+        instance_bytes = sys.getsizeof(obj)
+        if hasattr(obj, "__dict__"):
+            instance_bytes += sys.getsizeof(obj.__dict__)
+
+        return instance_bytes
+
+    @staticmethod
+    def report(name, seconds, count=None, unit="items"):
+        if count:
+            print "{0:<50} {1:>10.4f}s {2:>14,.0f} {3}/s".format(name, seconds,
+                count / seconds, unit)
+        else:
+            print "{0:<50} {1:>10.4f}s".format(name, seconds)
+
+    @staticmethod
+    def build_synthetic_account(tasklist_count, task_count, seed=0):
+        """Create a synthetic account with the given number of tasklists and
+        tasks. Roughly half of the tasks are top-level tasks; the rest are
+        children of a randomly chosen task earlier in the same tasklist.
+
+        Returns:
+            A (tasklists, tasks) tuple of dicts keyed by entity ID.
+        """
+        rand = random.Random(seed)
+
+        tasklists = dict()
+        tasklist_task_ids = dict()
+        for i in range(tasklist_count):
+            tasklist = TaskList(entity_id="tl-{0}".format(i),
+                title="TaskList {0}".format(i))
+            tasklists[tasklist.entity_id] = tasklist
+            tasklist_task_ids[tasklist.entity_id] = list()
+
+        tasklist_ids = sorted(tasklists.keys())
+        tasks = dict()
+        for i in range(task_count):
+            tasklist_id = rand.choice(tasklist_ids)
+            sibling_ids = tasklist_task_ids[tasklist_id]
+
+            parent_id = None
+            if sibling_ids and rand.random() < 0.5:
+                parent_id = rand.choice(sibling_ids)
+
+            task = Task(entity_id="t-{0}".format(i), title="Task {0}".format(i),
+                tasklist_id=tasklist_id, parent_id=parent_id,
+                position=rand.randint(0, 2 ** 31))
+            tasks[task.entity_id] = task
+            sibling_ids.append(task.entity_id)
+
+        return tasklists, tasks
+#------------------------------------------------------------------------------
+
+class EntityBenchmarks(object):
+    @staticmethod
+    def bench_memory():
+        print "Entity and tree node memory (bytes per task, excluding values) >>>"
+        tasklists, tasks = BenchmarkUtil.build_synthetic_account(20, 20000)
+        tree = Tree.from_tasks(tasklists, tasks)
+
+        samples = (("Task", tasks.values()),
+            ("TreeNode", [tree.get_node_for_entity_id(task_id)
+                for task_id in tasks]))
+        for name, objects in samples:
+            slotted_bytes = sum(BenchmarkUtil.get_instance_bytes(obj)
+                for obj in objects)
+            dict_bytes = sum(BenchmarkUtil.get_instance_bytes(
+                DictBackedObject(obj)) for obj in objects)
+
+            print "{0:<50} {1:>8.1f} bytes (with __dict__: {2:.1f} bytes)".format(
+                "{0}, __slots__".format(name),
+                float(slotted_bytes) / len(objects),
+                float(dict_bytes) / len(objects))
+
+    @staticmethod
+    def decode_generic(cls, str_dict):
+        """Reproduces the original, per-property loop used to decode a str
+        dict into an entity. Used only as a baseline for the codec benchmark.
+        """
+        entity = cls._create_blank_entity()
+        for prop in cls._get_properties():
+            if str_dict.has_key(prop.str_dict_key):
+                setattr(entity, prop.entity_key,
+                    prop.from_str(str_dict[prop.str_dict_key]))
+
+        return entity
+
+    @staticmethod
+    def bench_decode():
+        print "Decoding a tasks.list response (str dicts to Tasks) >>>"
+        task_count = 10000
+        tasklists, tasks = BenchmarkUtil.build_synthetic_account(1, task_count)
+        for task in tasks.values():
+            task.notes = "Notes for {0}".format(task.title)
+
+        # Timestamp parsing dominates decoding when the updated date is 
+        # present, so decode both with and without it to isolate the cost
+        # of the per-property dispatch.
+        for with_timestamps in (False, True):
+            for task in tasks.values():
+                if with_timestamps:
+                    task.updated_date = datetime.datetime(2012, 5, 2, 12, 30, 15)
+                else:
+                    task.updated_date = None
+            items = [task.to_str_dict() for task in tasks.values()]
+            label = "{0} tasks, {1} timestamps".format(task_count,
+                "with" if with_timestamps else "without")
+
+            seconds = BenchmarkUtil.time_call(lambda: [
+                EntityBenchmarks.decode_generic(Task, item) for item in items])
+            BenchmarkUtil.report("property loop, " + label, seconds,
+                task_count, "tasks")
+
+            seconds = BenchmarkUtil.time_call(lambda: [Task.from_str_dict(item)
+                for item in items])
+            BenchmarkUtil.report("Task.from_str_dict, " + label, seconds,
+                task_count, "tasks")
+
+    @staticmethod
+    def parse_timestamp_strptime(str_value):
+        """Reproduces the original regex + strptime timestamp parsing. Used
+        only as a baseline for the timestamp benchmark.
+        """
+        match_result = re.match(r"(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})\.",
+            str_value.strip())
+
+        return datetime.datetime.strptime(match_result.groups()[0],
+            "%Y-%m-%dT%H:%M:%S")
+
+    @staticmethod
+    def bench_timestamps():
+        print "RFC3339 timestamp parsing >>>"
+        timestamp_count = 30000
+        rand = random.Random(0)
+        start = datetime.datetime(2012, 1, 1)
+
+        # Updated timestamps are (nearly) all distinct, while due dates are
+        # always midnight and repeat heavily.
+        updated_timestamps = ["{0}.{1:03d}Z".format((start + datetime.timedelta(
+            seconds=rand.randint(0, 10 ** 8))).strftime("%Y-%m-%dT%H:%M:%S"),
+            rand.randint(0, 999)) for i in range(timestamp_count)]
+        due_timestamps = [(start + datetime.timedelta(days=rand.randint(0,
+            365))).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+            for i in range(timestamp_count)]
+
+        for name, timestamps in (("distinct", updated_timestamps),
+                ("repeated due dates", due_timestamps)):
+            seconds = BenchmarkUtil.time_call(lambda: [
+                EntityBenchmarks.parse_timestamp_strptime(timestamp)
+                for timestamp in timestamps])
+            BenchmarkUtil.report("regex + strptime, {0}".format(name), seconds,
+                timestamp_count, "timestamps")
+
+            def parse_timestamps():
+                # Start from an empty cache for each run.
+                RFC3339Converter.clear_cache()
+
+                converter = RFC3339Converter()
+                for timestamp in timestamps:
+                    converter.from_str(timestamp)
+
+            seconds = BenchmarkUtil.time_call(parse_timestamps)
+            BenchmarkUtil.report("RFC3339Converter, {0}".format(name), seconds,
+                timestamp_count, "timestamps")
+#------------------------------------------------------------------------------
+
+class TreeBenchmarks(object):
+    @staticmethod
+    def build_wide_tree(tree_type, child_count):
+        """Build a tree with a single parent (root) node and the specified
+        number of children, inserting each child at the front of the sibling
+        group (the worst case for path maintenance).
+        """
+        tree = tree_type()
+        tree.insert(Tree.ROOT_PATH, "root")
+
+        for i in range(child_count):
+            tree.insert(Tree.ROOT_PATH + (0,), i)
+
+        return tree
+
+    @staticmethod
+    def bench_insert_paths():
+        print "Tree insert (at front of sibling group), eager vs lazy paths >>>"
+        for child_count in (1000, 2500, 5000):
+            for tree_type in (EagerPathTree, Tree):
+                seconds = BenchmarkUtil.time_call(
+                    lambda: TreeBenchmarks.build_wide_tree(tree_type, child_count))
+                BenchmarkUtil.report("{0}, {1} children".format(
+                    tree_type.__name__, child_count), seconds, child_count,
+                    "inserts")
+
+    @staticmethod
+    def bench_path_lookup():
+        print "Tree path lookup after build (all children) >>>"
+        child_count = 20000
+        tree = TreeBenchmarks.build_wide_tree(Tree, child_count)
+        children = tree.get_node(Tree.ROOT_PATH).children
+
+        def lookup_paths():
+            for node in children:
+                node.path
+
+        seconds = BenchmarkUtil.time_call(lookup_paths)
+        BenchmarkUtil.report("Tree, {0} children".format(child_count), seconds,
+            child_count, "lookups")
+
+    @staticmethod
+    def bench_from_tasks():
+        print "Tree.from_tasks (bulk build from flat task dicts) >>>"
+        for task_count in (5000, 50000):
+            tasklists, tasks = BenchmarkUtil.build_synthetic_account(20,
+                task_count)
+            seconds = BenchmarkUtil.time_call(
+                lambda: Tree.from_tasks(tasklists, tasks))
+            BenchmarkUtil.report("{0} tasks".format(task_count), seconds,
+                task_count, "tasks")
+
+    @staticmethod
+    def build_sibling_group(sibling_count):
+        """Build a tree with a single sibling group below root, and select
+        every other sibling in the group.
+
+        Returns:
+            A (tree, selected_nodes) tuple.
+        """
+        tree = Tree()
+        root = tree.append(None, "root")
+
+        selected_nodes = list()
+        for i in range(sibling_count):
+            node = tree.append(root, i)
+            if i % 2:
+                selected_nodes.append(node)
+
+        return tree, selected_nodes
+
+    @staticmethod
+    def bench_reorganize():
+        print "Tree reorganization (every other sibling selected) >>>"
+        operations = (("reorder_up", Tree.reorder_up),
+            ("reorder_down", Tree.reorder_down),
+            ("demote", Tree.demote))
+
+        for sibling_count in (10, 1000, 100000):
+            for name, operation in operations:
+                seconds = BenchmarkUtil.time_call(
+                    lambda (tree, selected_nodes): operation(tree, *selected_nodes),
+                    setup=lambda: TreeBenchmarks.build_sibling_group(sibling_count))
+                BenchmarkUtil.report("{0}, {1} siblings".format(name,
+                    sibling_count), seconds, sibling_count, "siblings")
+
+    @staticmethod
+    def bench_promote():
+        print "Tree promote (every other node of a sibling group + descendants) >>>"
+        def build_tree(sibling_count):
+            # Build a sibling group below a single top-level node, with each
+            # sibling having a child; select every other sibling and every
+            # other child.
+            tree = Tree()
+            root = tree.append(None, "root")
+            parent = tree.append(root, "parent")
+
+            selected_nodes = list()
+            for i in range(sibling_count):
+                node = tree.append(parent, i)
+                child_node = tree.append(node, i)
+                if i % 2:
+                    selected_nodes.append(node)
+                else:
+                    selected_nodes.append(child_node)
+
+            return tree, selected_nodes
+
+        for sibling_count in (1000, 10000):
+            seconds = BenchmarkUtil.time_call(
+                lambda (tree, selected_nodes): tree.promote(*selected_nodes),
+                setup=lambda: build_tree(sibling_count))
+            BenchmarkUtil.report("promote, {0} selected nodes".format(
+                sibling_count), seconds, sibling_count, "nodes")
+#------------------------------------------------------------------------------
+
+class StartupBenchmarks(object):
+    @staticmethod
+    def bench_startup():
+        print "Startup, time until the task tree can be shown (20k tasks) >>>"
+        task_count = 20000
+        latency = 0.02
+        tasklists, tasks = BenchmarkUtil.build_synthetic_account(20, task_count)
+        for index, task in enumerate(tasks.values()):
+            task.updated_date = datetime.datetime(2012, 5, 2) + \
+                datetime.timedelta(seconds=index)
+
+        tasklist_str_dicts = [tasklist.to_str_dict()
+            for tasklist in tasklists.values()]
+        task_str_dicts = dict((tasklist_id, list()) for tasklist_id in tasklists)
+        for task in tasks.values():
+            task_str_dicts[task.tasklist_id].append(task.to_str_dict())
+
+        def create_tasktree_service(cache_service=None):
+            return TaskTreeService(
+                TaskListService(FakeTaskListServiceProxy(tasklist_str_dicts,
+                    latency)),
+                TaskService(FakeTaskServiceProxy(task_str_dicts, latency)),
+                cache_service)
+
+        cache_directory = tempfile.mkdtemp()
+        try:
+            cache_path = os.path.join(cache_directory, "cache.db")
+
+            seconds = BenchmarkUtil.time_call(
+                lambda: create_tasktree_service().refresh(), repeat=1)
+            BenchmarkUtil.report(
+                "full refresh ({0:.0f}ms/request)".format(latency * 1000),
+                seconds, task_count, "tasks")
+
+            create_tasktree_service(TaskCacheService(cache_path)).refresh()
+
+            seconds = BenchmarkUtil.time_call(lambda: create_tasktree_service(
+                TaskCacheService(cache_path)).load_cache())
+            BenchmarkUtil.report("cache load", seconds, task_count, "tasks")
+
+            tasktree_service = create_tasktree_service(
+                TaskCacheService(cache_path))
+            tasktree_service.load_cache()
+            seconds = BenchmarkUtil.time_call(tasktree_service.refresh)
+            BenchmarkUtil.report("incremental refresh, after cache load",
+                seconds)
+        finally:
+            shutil.rmtree(cache_directory)
+
+    @staticmethod
+    def bench_parallel_refresh():
+        print "Full refresh, by worker pool size (60 tasklists, 150 tasks each) >>>"
+        tasklist_count = 60
+        latency = 0.02
+        tasklists, tasks = BenchmarkUtil.build_synthetic_account(tasklist_count,
+            tasklist_count * 150)
+
+        tasklist_str_dicts = [tasklist.to_str_dict()
+            for tasklist in tasklists.values()]
+        task_str_dicts = dict((tasklist_id, list()) for tasklist_id in tasklists)
+        for task in tasks.values():
+            task_str_dicts[task.tasklist_id].append(task.to_str_dict())
+
+        for max_workers in (1, 4, 16, 64):
+            tasktree_service = TaskTreeService(
+                TaskListService(FakeTaskListServiceProxy(tasklist_str_dicts)),
+                TaskService(FakeTaskServiceProxy(task_str_dicts, latency)),
+                max_workers=max_workers)
+            seconds = BenchmarkUtil.time_call(tasktree_service.refresh,
+                repeat=1)
+            tasktree_service.close()
+
+            BenchmarkUtil.report("{0} workers ({1:.0f}ms/request)".format(
+                max_workers, latency * 1000), seconds, tasklist_count,
+                "tasklists")
+#------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    EntityBenchmarks.bench_memory()
+    EntityBenchmarks.bench_decode()
+    EntityBenchmarks.bench_timestamps()
+    TreeBenchmarks.bench_insert_paths()
+    TreeBenchmarks.bench_path_lookup()
+    TreeBenchmarks.bench_from_tasks()
+    TreeBenchmarks.bench_reorganize()
+    TreeBenchmarks.bench_promote()
+    StartupBenchmarks.bench_startup()
+    StartupBenchmarks.bench_parallel_refresh()
@@ -0,0 +1,398 @@
+"""
+Created on May 4, 2012
+
+@author: Clay Carpenter
+"""
+
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+from datetime import datetime
+import apiclient.discovery
+import apiclient.errors
+from coggrinder.entities.tasks import TaskList, Task
+from coggrinder.entities.properties import RFC3339Converter
+
+class TaskCacheService(object):
+    """
+    Stores the last-known tasklists and tasks in a local SQLite database, so
+    that they can be shown immediately at startup, before the Google Tasks
+    services have been contacted.
+
+    Entities are stored by entity ID as their str dicts (JSON encoded), along
+    with their etags. Saving takes only the changes since the last save (or 
+    load), and of the changed entities only writes those whose etags differ 
+    from the stored ones. Entities without an etag are always written.
+    """
+    DEFAULT_PATH = "coggrinder-cache.db"
+
+    def __init__(self, path=None):
+        if path is None:
+            path = TaskCacheService.DEFAULT_PATH
+        self.path = path
+
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._create_tables()
+
+        # Etags of the entities currently stored, keyed by entity ID.
+        self._stored_etags = dict()
+
+    def _create_tables(self):
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS tasklists "
+                "(entity_id TEXT PRIMARY KEY, e_tag TEXT, data TEXT)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS tasks "
+                "(entity_id TEXT PRIMARY KEY, tasklist_id TEXT, e_tag TEXT, "
+                "data TEXT)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS high_water_marks "
+                "(tasklist_id TEXT PRIMARY KEY, updated TEXT)")
+
+    def load(self):
+        """
+        Load the stored tasklists and tasks.
+
+        Returns:
+            A (tasklists, tasks, high_water_marks) tuple. The tasklists and
+            tasks are dicts keyed by entity ID; the high-water marks are a
+            dict of datetimes keyed by tasklist ID.
+        """
+        self._stored_etags = dict()
+
+        tasklists = dict()
+        for entity_id, e_tag, data in self._connection.execute(
+                "SELECT entity_id, e_tag, data FROM tasklists"):
+            tasklist = TaskList.from_str_dict(json.loads(data))
+            tasklists[tasklist.entity_id] = tasklist
+            self._stored_etags[entity_id] = e_tag
+
+        tasks = dict()
+        for entity_id, tasklist_id, e_tag, data in self._connection.execute(
+                "SELECT entity_id, tasklist_id, e_tag, data FROM tasks"):
+            task = Task.from_str_dict(json.loads(data))
+            task.tasklist_id = str(tasklist_id)
+            tasks[task.entity_id] = task
+            self._stored_etags[entity_id] = e_tag
+
+        converter = RFC3339Converter()
+        high_water_marks = dict()
+        for tasklist_id, updated in self._connection.execute(
+                "SELECT tasklist_id, updated FROM high_water_marks"):
+            high_water_marks[str(tasklist_id)] = converter.from_str(updated)
+
+        return tasklists, tasks, high_water_marks
+
+    def save(self, updated_entities, removed_entity_ids, high_water_marks,
+            replace=False):
+        """
+        Store the changes to the tasklists and tasks.
+
+        Args:
+            updated_entities: The new and updated TaskLists and Tasks.
+            removed_entity_ids: IDs of the removed tasklists and tasks. The 
+                tasks of a removed tasklist are removed along with it.
+            high_water_marks: All of the high-water marks, replacing those 
+                stored.
+            replace: If True, discard everything stored before.
+        """
+        with self._connection:
+            if replace:
+                self._clear_tables()
+
+            self._remove_entities(removed_entity_ids)
+
+            # Write only the new or changed entities (the etag property may be
+            # unset).
+            tasklist_rows = list()
+            task_rows = list()
+            for entity in updated_entities:
+                e_tag = getattr(entity, "e_tag", None)
+                if (e_tag is not None 
+                        and self._stored_etags.get(entity.entity_id) == e_tag):
+                    continue
+                self._stored_etags[entity.entity_id] = e_tag
+
+                if isinstance(entity, TaskList):
+                    tasklist_rows.append((entity.entity_id, e_tag,
+                        json.dumps(entity.to_str_dict())))
+                else:
+                    task_rows.append((entity.entity_id, entity.tasklist_id,
+                        e_tag, json.dumps(entity.to_str_dict())))
+            self._connection.executemany("INSERT OR REPLACE INTO tasklists "
+                "VALUES (?, ?, ?)", tasklist_rows)
+            self._connection.executemany("INSERT OR REPLACE INTO tasks "
+                "VALUES (?, ?, ?, ?)", task_rows)
+
+            converter = RFC3339Converter()
+            self._connection.execute("DELETE FROM high_water_marks")
+            self._connection.executemany("INSERT INTO high_water_marks "
+                "(tasklist_id, updated) VALUES (?, ?)",
+                [(tasklist_id, converter.to_str(updated)) for tasklist_id, updated
+                    in high_water_marks.items()])
+
+    def _remove_entities(self, entity_ids):
+        for entity_id in entity_ids:
+            self._stored_etags.pop(entity_id, None)
+
+            if self._connection.execute("DELETE FROM tasklists "
+                    "WHERE entity_id = ?", (entity_id,)).rowcount:
+                task_ids = [task_id for task_id, in self._connection.execute(
+                    "SELECT entity_id FROM tasks WHERE tasklist_id = ?",
+                    (entity_id,))]
+                for task_id in task_ids:
+                    self._stored_etags.pop(task_id, None)
+                self._connection.execute("DELETE FROM tasks "
+                    "WHERE tasklist_id = ?", (entity_id,))
+            else:
+                self._connection.execute("DELETE FROM tasks "
+                    "WHERE entity_id = ?", (entity_id,))
+
+    def clear(self):
+        with self._connection:
+            self._clear_tables()
+
+    def _clear_tables(self):
+        for table in ("tasklists", "tasks", "high_water_marks"):
+            self._connection.execute("DELETE FROM {0}".format(table))
+
+        self._stored_etags = dict()
+
+    def close(self):
+        self._connection.close()
+#------------------------------------------------------------------------------
+
+class TaskCacheServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_service = TaskCacheService(":memory:")
+
+        self.tasklists = {"tl-0": TaskList(entity_id="tl-0", title="TaskList 0")}
+        self.tasks = dict()
+        for count in range(3):
+            task = Task(entity_id="t-{0}".format(count), tasklist_id="tl-0",
+                title="Task {0}".format(count),
+                updated_date=datetime(2012, 5, 1, 12, 0, count))
+            task.e_tag = "etag-{0}".format(count)
+            self.tasks[task.entity_id] = task
+        self.high_water_marks = {"tl-0": datetime(2012, 5, 1, 12, 0, 2)}
+
+    def _save_all(self, replace=False):
+        self.cache_service.save(self.tasklists.values() + self.tasks.values(),
+            [], self.high_water_marks, replace=replace)
+
+    def test_save_load(self):
+        self._save_all()
+
+        tasklists, tasks, high_water_marks = self.cache_service.load()
+
+        self.assertEqual(self.tasklists, tasklists)
+        self.assertEqual(self.tasks, tasks)
+        self.assertEqual("tl-0", tasks["t-1"].tasklist_id)
+        self.assertEqual(self.high_water_marks, high_water_marks)
+
+    def test_save_changed_and_removed(self):
+        self._save_all()
+
+        # Change a task (and its etag), and remove another.
+        self.tasks["t-0"].title = "Updated title"
+        self.tasks["t-0"].e_tag = "etag-0-updated"
+        self.cache_service.save([self.tasks["t-0"]], ["t-1"],
+            self.high_water_marks)
+
+        tasklists, tasks, high_water_marks = self.cache_service.load()
+
+        self.assertEqual("Updated title", tasks["t-0"].title)
+        self.assertEqual(["t-0", "t-2"], sorted(tasks.keys()))
+
+    def test_save_unchanged_etag(self):
+        # An entity with an unchanged etag is not rewritten.
+        self._save_all()
+
+        self.tasks["t-0"].title = "Updated title"
+        self.cache_service.save([self.tasks["t-0"]], [], self.high_water_marks)
+
+        tasklists, tasks, high_water_marks = self.cache_service.load()
+
+        self.assertEqual("Task 0", tasks["t-0"].title)
+
+    def test_save_removed_tasklist(self):
+        # The tasks of a removed tasklist go along with it.
+        self._save_all()
+
+        self.cache_service.save([], ["tl-0"], {})
+
+        self.assertEqual(({}, {}, {}), self.cache_service.load())
+
+    def test_save_replace(self):
+        self.cache_service.save([TaskList(entity_id="tl-old")], [], {})
+
+        self._save_all(replace=True)
+
+        tasklists, tasks, high_water_marks = self.cache_service.load()
+
+        self.assertEqual(self.tasklists, tasklists)
+        self.assertEqual(self.tasks, tasks)
+
+    def test_load_empty(self):
+        self.assertEqual(({}, {}, {}), self.cache_service.load())
+#------------------------------------------------------------------------------
+
+class DiscoveryDocumentCache(object):
+    """
+    Stores Google API discovery documents in a local JSON file, so that the 
+    service proxies can be built (with build_from_document) without fetching
+    the discovery document on every start.
+
+    Documents are stored by API name and version, along with the time they were
+    fetched. A document older than max_age is fetched again; if that fetch 
+    fails, the stale document is used instead.
+    """
+    DEFAULT_PATH = "coggrinder-discovery.json"
+    DEFAULT_MAX_AGE = 24 * 60 * 60
+    DISCOVERY_URI = apiclient.discovery.DISCOVERY_URI
+
+    def __init__(self, path=None, max_age=DEFAULT_MAX_AGE):
+        """
+        Args:
+            path: Path of the JSON file holding the cached documents.
+            max_age: Seconds before a cached document expires.
+        """
+        if path is None:
+            path = DiscoveryDocumentCache.DEFAULT_PATH
+        self.path = path
+        self.max_age = max_age
+
+    def build_service(self, api, version, http):
+        """
+        Build the service proxy for the API from the cached discovery 
+        document, fetching the document first if it is missing or expired.
+        """
+        document = self.get_document(api, version, http)
+
+        return apiclient.discovery.build_from_document(document, http=http)
+
+    def get_document(self, api, version, http):
+        entries = self._load_entries()
+        key = "{0}/{1}".format(api, version)
+
+        entry = entries.get(key)
+        if entry is not None and time.time() - entry["fetched"] < self.max_age:
+            return entry["document"]
+
+        try:
+            document = self._fetch_document(api, version, http)
+        except Exception:
+            if entry is None:
+                raise
+
+            # Fall back on the expired document (the service may be 
+            # unreachable right now).
+            return entry["document"]
+
+        entries[key] = {"fetched": time.time(), "document": document}
+        self._save_entries(entries)
+
+        return document
+
+    def _fetch_document(self, api, version, http):
+        uri = self.DISCOVERY_URI.format(api=api, apiVersion=version)
+        response, content = http.request(uri)
+        if response.status >= 400:
+            raise apiclient.errors.HttpError(response, content, uri=uri)
+
+        # Confirm the document can be parsed before it is stored.
+        json.loads(content)
+
+        return content
+
+    def _load_entries(self):
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (IOError, ValueError):
+            return dict()
+
+    def _save_entries(self, entries):
+        # Write to a temporary file first, so that a failed write can't leave 
+        # a truncated cache behind.
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as cache_file:
+            json.dump(entries, cache_file)
+        os.rename(temp_path, self.path)
+#------------------------------------------------------------------------------
+
+class DiscoveryDocumentCacheTest(unittest.TestCase):
+    DOCUMENT = json.dumps({
+        "name": "tasks", "version": "v1",
+        "rootUrl": "https://www.googleapis.com/", "servicePath": "tasks/v1/",
+        "resources": {"tasklists": {"methods": {"list": {
+            "id": "tasks.tasklists.list", "path": "users/@me/lists",
+            "httpMethod": "GET"}}}}})
+
+    class Response(object):
+        def __init__(self, status):
+            self.status = status
+            self.reason = ""
+
+        def get(self, key, default=None):
+            return default
+
+    class Http(object):
+        def __init__(self, status, content):
+            self.status = status
+            self.content = content
+            self.requested_uris = list()
+
+        def request(self, uri, *args, **kwargs):
+            self.requested_uris.append(uri)
+
+            return DiscoveryDocumentCacheTest.Response(self.status), self.content
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = DiscoveryDocumentCache(
+            os.path.join(self.temp_dir, "discovery.json"))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_build_service_fetches_once(self):
+        http = self.Http(200, self.DOCUMENT)
+
+        service = self.cache.build_service("tasks", "v1", http)
+        self.assertIsNotNone(service.tasklists())
+        self.cache.build_service("tasks", "v1", http)
+
+        self.assertEqual(["https://www.googleapis.com/discovery/v1/apis/tasks/v1/rest"],
+            http.requested_uris)
+
+    def test_build_service_offline(self):
+        self.cache.get_document("tasks", "v1", self.Http(200, self.DOCUMENT))
+
+        # A cached document should be used without any requests.
+        offline_http = self.Http(500, "")
+        service = self.cache.build_service("tasks", "v1", offline_http)
+
+        self.assertIsNotNone(service.tasklists())
+        self.assertEqual([], offline_http.requested_uris)
+
+    def test_expired_document(self):
+        self.cache.get_document("tasks", "v1", self.Http(200, self.DOCUMENT))
+        self.cache.max_age = 0
+
+        # An expired document is fetched again, but still used if that fails.
+        offline_http = self.Http(500, "")
+        self.assertEqual(self.DOCUMENT,
+            self.cache.get_document("tasks", "v1", offline_http))
+        self.assertEqual(1, len(offline_http.requested_uris))
+
+        updated_document = self.DOCUMENT.replace("tasks/v1/", "tasks/v2/")
+        self.assertEqual(updated_document, self.cache.get_document("tasks", "v1",
+            self.Http(200, updated_document)))
+
+    def test_missing_document_fetch_failure(self):
+        self.assertRaises(apiclient.errors.HttpError, self.cache.get_document,
+            "tasks", "v1", self.Http(404, ""))
+#------------------------------------------------------------------------------
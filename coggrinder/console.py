@@ -6,19 +6,24 @@ Created on Mar 22, 2012
 from coggrinder.entities.tasks import TaskList, Task
 from coggrinder.task_services import TaskListService, TaskService
 from coggrinder.authentication_services import AuthenticationService
-import apiclient.discovery
+from coggrinder.cache_services import DiscoveryDocumentCache
 import random
 
 # TODO: Refactor this by moving it to utilities.ConsoleTest.
 class ConsoleTestUtil(object):
+    # The service proxy (and the authorized connections behind it) is built 
+    # once and shared by every service created afterwards.
+    _gtasks_service_proxy = None
+    
     @classmethod
     def create_gtasks_service_proxy(cls):
-        auth_service = AuthenticationService()
-        authorized_http = auth_service.authenticate_connection()
-        gtasks_service_proxy = apiclient.discovery.build("tasks", "v1",
-            http=authorized_http)
+        if cls._gtasks_service_proxy is None:
+            auth_service = AuthenticationService()
+            authorized_http = auth_service.authenticate_connection()
+            cls._gtasks_service_proxy = DiscoveryDocumentCache().build_service(
+                "tasks", "v1", authorized_http)
         
-        return gtasks_service_proxy
+        return cls._gtasks_service_proxy
     
     @classmethod
     def create_tasklist_service(cls):        
@@ -6,7 +6,6 @@ Created on Mar 22, 2012
 
 import unittest
 import datetime
-import re
 
 class EntityProperty(object):
     def __init__(self, entity_key, str_dict_key, converter=None, is_required=False):
@@ -32,6 +31,206 @@ class EntityProperty(object):
         return self.__str__()          
 #------------------------------------------------------------------------------ 
 
+class _Missing(object):
+    """
+    Marks a property that is unset on an entity, within a snapshot. Pickling
+    or copying a snapshot keeps the single _MISSING instance, so that copied
+    snapshots still compare equal to unset properties.
+    """
+    __slots__ = ()
+
+    def __reduce__(self):
+        return "_MISSING"
+
+    def __repr__(self):
+        return "_MISSING"
+
+_MISSING = _Missing()
+#------------------------------------------------------------------------------ 
+
+class EntityCodec(object):
+    """
+    Converts entities to and from str dicts using decode and encode functions
+    that are generated (once) from a tuple of EntityProperty definitions. The
+    generated functions are unrolled over the properties, so converting an
+    entity doesn't involve looping over the properties or dispatching through
+    each EntityProperty.
+
+    A property whose key is missing from a str dict is left unset on the 
+    entity, and a property that is unset on an entity is left out of the str
+    dict.
+
+    A snapshot of an entity's property values can be taken (or taken while
+    decoding, at little more than the cost of decoding alone), and later used
+    to encode only the properties that have changed since.
+    """
+    _MISSING = _MISSING
+
+    def __init__(self, properties):
+        self.properties = tuple(properties)
+
+        namespace = {"_MISSING": EntityCodec._MISSING}
+        decode_lines = ["def decode(str_dict, entity):",
+            "    get = str_dict.get"]
+        decode_snapshot_lines = ["def decode_snapshot(str_dict, entity):",
+            "    get = str_dict.get"]
+        encode_lines = ["def encode(entity, include_none_values):",
+            "    str_dict = {}"]
+        snapshot_values = list()
+        encode_modified_lines = ["def encode_modified(entity, snapshot):",
+            "    str_dict = {}"]
+        for index, prop in enumerate(self.properties):
+            # Bind each converter method directly into the generated 
+            # functions' namespace.
+            from_str_name = "from_str_{0}".format(index)
+            to_str_name = "to_str_{0}".format(index)
+            namespace[from_str_name] = prop.converter.from_str
+            namespace[to_str_name] = prop.converter.to_str
+
+            decode_lines.extend((
+                "    value = get({0!r}, _MISSING)".format(prop.str_dict_key),
+                "    if value is not _MISSING:",
+                "        entity.{0} = {1}(value)".format(prop.entity_key,
+                    from_str_name)))
+            # Properties missing from the str dict keep whatever value the
+            # entity already had.
+            decode_snapshot_lines.extend((
+                "    value = get({0!r}, _MISSING)".format(prop.str_dict_key),
+                "    if value is not _MISSING:",
+                "        entity.{0} = value_{1} = {2}(value)".format(
+                    prop.entity_key, index, from_str_name),
+                "    else:",
+                "        value_{0} = getattr(entity, {1!r}, _MISSING)".format(
+                    index, prop.entity_key)))
+            encode_lines.extend((
+                "    value = getattr(entity, {0!r}, _MISSING)".format(
+                    prop.entity_key),
+                "    if value is not _MISSING and (value is not None or include_none_values):",
+                "        str_dict[{0!r}] = {1}(value)".format(prop.str_dict_key,
+                    to_str_name)))
+            snapshot_values.append("getattr(entity, {0!r}, _MISSING)".format(
+                prop.entity_key))
+            # A property that has been cleared (or unset) is encoded as None.
+            encode_modified_lines.extend((
+                "    value = getattr(entity, {0!r}, _MISSING)".format(
+                    prop.entity_key),
+                "    if value != snapshot[{0}]:".format(index),
+                "        if value is _MISSING or value is None:",
+                "            str_dict[{0!r}] = None".format(prop.str_dict_key),
+                "        else:",
+                "            str_dict[{0!r}] = {1}(value)".format(
+                    prop.str_dict_key, to_str_name)))
+        decode_lines.append("    return entity")
+        decode_snapshot_lines.append("    return ({0},)".format(", ".join(
+            "value_{0}".format(index) 
+            for index in range(len(self.properties)))))
+        encode_lines.append("    return str_dict")
+        snapshot_lines = ["def snapshot(entity):",
+            "    return ({0},)".format(", ".join(snapshot_values))]
+        encode_modified_lines.append("    return str_dict")
+
+        source = "\n".join(decode_lines + decode_snapshot_lines + encode_lines
+            + snapshot_lines + encode_modified_lines) + "\n"
+        exec compile(source, "<EntityCodec>", "exec") in namespace
+
+        self._decode = namespace["decode"]
+        self._decode_snapshot = namespace["decode_snapshot"]
+        self._encode = namespace["encode"]
+        self._snapshot = namespace["snapshot"]
+        self._encode_modified = namespace["encode_modified"]
+
+    def decode(self, str_dict, entity):
+        """Convert the values in the str dict and set them on the entity.
+
+        Returns:
+            The entity.
+        """
+        return self._decode(str_dict, entity)
+
+    def decode_snapshot(self, str_dict, entity):
+        """Convert the values in the str dict and set them on the entity, 
+        taking a snapshot of the entity's property values along the way.
+
+        Returns:
+            The snapshot, as snapshot would take it after decoding.
+        """
+        return self._decode_snapshot(str_dict, entity)
+
+    def encode(self, entity, include_none_values=False):
+        """Convert the entity's property values into a new str dict."""
+        return self._encode(entity, include_none_values)
+
+    def snapshot(self, entity):
+        """Capture the entity's current property values, as a tuple."""
+        return self._snapshot(entity)
+
+    def encode_modified(self, entity, snapshot):
+        """Convert only the entity's property values that differ from the
+        snapshot into a new str dict. Properties that have been cleared are
+        included with a None value.
+        """
+        return self._encode_modified(entity, snapshot)
+#------------------------------------------------------------------------------ 
+
+class EntityCodecTest(unittest.TestCase):
+    class Entity(object):
+        pass
+
+    def setUp(self):
+        self.codec = EntityCodec((EntityProperty("name", "title"),
+            EntityProperty("count", "total", IntConverter())))
+
+    def test_decode(self):
+        entity = self.codec.decode({"title": "a name", "total": "3"},
+            EntityCodecTest.Entity())
+
+        self.assertEqual("a name", entity.name)
+        self.assertEqual(3, entity.count)
+
+    def test_decode_missing_key(self):
+        entity = self.codec.decode({"title": "a name"}, EntityCodecTest.Entity())
+
+        self.assertFalse(hasattr(entity, "count"))
+
+    def test_encode(self):
+        entity = EntityCodecTest.Entity()
+        entity.name = "a name"
+        entity.count = 3
+
+        self.assertEqual({"title": "a name", "total": "3"},
+            self.codec.encode(entity))
+
+    def test_encode_unset_and_none(self):
+        entity = EntityCodecTest.Entity()
+        entity.name = None
+
+        self.assertEqual({}, self.codec.encode(entity))
+        self.assertEqual({"title": None},
+            self.codec.encode(entity, include_none_values=True))
+
+    def test_encode_modified(self):
+        entity = self.codec.decode({"title": "a name", "total": "3"},
+            EntityCodecTest.Entity())
+        snapshot = self.codec.snapshot(entity)
+        self.assertEqual({}, self.codec.encode_modified(entity, snapshot))
+
+        entity.count = 4
+        self.assertEqual({"total": "4"},
+            self.codec.encode_modified(entity, snapshot))
+
+        entity.name = None
+        self.assertEqual({"title": None, "total": "4"},
+            self.codec.encode_modified(entity, snapshot))
+
+    def test_decode_snapshot(self):
+        entity = EntityCodecTest.Entity()
+        entity.count = 2
+        snapshot = self.codec.decode_snapshot({"title": "a name"}, entity)
+
+        self.assertEqual("a name", entity.name)
+        self.assertEqual(self.codec.snapshot(entity), snapshot)
+#------------------------------------------------------------------------------ 
+
 class PropertyConverter(object):
     _ABSTRACT_ERROR_MESSAGE = "Abstract method cannot be called."
     
@@ -100,13 +299,21 @@ class StrConverterTest(unittest.TestCase):
 #------------------------------------------------------------------------------ 
 
 class RFC3339Converter(PropertyConverter):
-    """            
-    This convertor ignores the microsecond and timezone values.
     """
-    _RFC3339_REGEX = r"(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})\."
-    _DATE_FORMAT = ""
+    Converts between RFC3339 timestamps and naive datetime objects, expressed
+    in UTC. Fractional seconds are preserved to microsecond precision, and 
+    timestamps with a numeric UTC offset are normalized to UTC.
+    
+    Timestamps are parsed by slicing the fixed-width fields out of the string
+    rather than with a regex and strptime, and recently parsed timestamps are
+    kept in a (class-wide, approximately) LRU cache, as the same timestamps 
+    (due dates in particular) tend to repeat many times within a single tasks
+    listing.
+    """
+    _CACHE_SIZE = 1024
+    _recent_cache = dict()
+    _older_cache = dict()
 
-    # TODO: This doesn't count blank strings as None, and vice versa.
     def to_str(self, obj_value):
         # Check if the value is None, in which case return a None object. 
         # An empty string cannot be used here because Google will balk at emtpy 
@@ -117,34 +324,109 @@ class RFC3339Converter(PropertyConverter):
             # Ensure that a proper datetime object has been provided
             assert isinstance(obj_value, datetime.datetime)
             
-            # Ask datetime to convert the date to an RFC3339-formatted timestamp.
-            str_value = obj_value.strftime("%Y-%m-%dT%H:%M:%S")
-            
-            # Add blank microsecond and default timezone values.
-            str_value = str_value + ".000Z"
+            # Format the timestamp to millisecond precision, in UTC.
+            str_value = "{0:04d}-{1:02d}-{2:02d}T{3:02d}:{4:02d}:{5:02d}.{6:03d}Z".format(
+                obj_value.year, obj_value.month, obj_value.day, obj_value.hour,
+                obj_value.minute, obj_value.second, obj_value.microsecond // 1000)
             
         # Return the string timestamp representation.
         return str_value
 
-    def from_str(self, str_value):        
-        # If the string is blank/emtpy (after trimming), interpret it as None.
+    def from_str(self, str_value):
+        # If the string is blank/emtpy, interpret it as None.
         if str_value == "" or str_value is None:
-            obj_value = None
-        else:
-            # Trim any leading or trailing whitespace.
-            str_value = str_value.strip()
-            
-            # Remove the trailing microsecond and timezone information from the 
-            # timestamp.    
-            match_result = re.match(RFC3339Converter._RFC3339_REGEX, str_value)
-            assert match_result is not None, "Could not parse the provided timestamp: {0}".format(str_value)
-            stripped_timestamp = match_result.groups()[0]
-            
-            # Convert the timestamp (now stripped of microsecond and timezone info)
-            # into a datetime object.
-            obj_value = datetime.datetime.strptime(stripped_timestamp,
-                "%Y-%m-%dT%H:%M:%S")
-        
+            return None
+
+        # Datetimes are immutable, so a cached result can safely be shared.
+        obj_value = RFC3339Converter._recent_cache.get(str_value)
+        if obj_value is None:
+            obj_value = RFC3339Converter._older_cache.get(str_value)
+            if obj_value is None:
+                obj_value = RFC3339Converter._parse(str_value)
+                if obj_value is None:
+                    return None
+
+            RFC3339Converter._cache_timestamp(str_value, obj_value)
+
+        return obj_value
+
+    @classmethod
+    def _cache_timestamp(cls, str_value, obj_value):
+        """Add a timestamp to the cache as the most recently used.
+        
+        The cache approximates an LRU cache with two generations of plain 
+        dicts, which avoids the (considerable) per-lookup cost of maintaining
+        an ordered dict. When the recent generation fills up, it becomes the 
+        older generation and the previous older generation is discarded; a 
+        timestamp found in the older generation is moved back to the recent
+        generation.
+        """
+        if len(cls._recent_cache) >= cls._CACHE_SIZE:
+            cls._older_cache = cls._recent_cache
+            cls._recent_cache = dict()
+
+        cls._recent_cache[str_value] = obj_value
+
+    @classmethod
+    def clear_cache(cls):
+        cls._recent_cache = dict()
+        cls._older_cache = dict()
+
+    @staticmethod
+    def _parse(str_value):
+        """Parse an RFC3339 timestamp of the form 
+        YYYY-MM-DDTHH:MM:SS[.fraction](Z|+HH:MM|-HH:MM), ignoring any leading
+        or trailing whitespace.
+
+        Returns:
+            The datetime, or None if the timestamp is blank (only whitespace).
+        Raises:
+            ValueError if the (non-blank) timestamp is malformed.
+        """
+        # Trim any leading or trailing whitespace.
+        timestamp = str_value.strip()
+        if timestamp == "":
+            return None
+
+        try:
+            if (timestamp[4] != "-" or timestamp[7] != "-" 
+                    or timestamp[10] not in "Tt" or timestamp[13] != ":"
+                    or timestamp[16] != ":"):
+                raise ValueError()
+
+            # Fractional seconds are optional, and may have any number of 
+            # digits; anything past microseconds is truncated.
+            microsecond = 0
+            zone_index = 19
+            if timestamp[19] == ".":
+                zone_index = 20
+                while timestamp[zone_index].isdigit():
+                    zone_index += 1
+                fraction = timestamp[20:zone_index]
+                if not fraction:
+                    raise ValueError()
+                microsecond = int((fraction + "00000")[:6])
+
+            obj_value = datetime.datetime(int(timestamp[0:4]),
+                int(timestamp[5:7]), int(timestamp[8:10]),
+                int(timestamp[11:13]), int(timestamp[14:16]),
+                int(timestamp[17:19]), microsecond)
+
+            zone = timestamp[zone_index:]
+            if zone not in ("Z", "z"):
+                if len(zone) != 6 or zone[0] not in "+-" or zone[3] != ":":
+                    raise ValueError()
+
+                offset = datetime.timedelta(hours=int(zone[1:3]),
+                    minutes=int(zone[4:6]))
+                if zone[0] == "+":
+                    obj_value = obj_value - offset
+                else:
+                    obj_value = obj_value + offset
+        except (ValueError, IndexError):
+            raise ValueError(
+                "Could not parse the provided timestamp: {0}".format(str_value))
+
         return obj_value
 #------------------------------------------------------------------------------ 
 
@@ -173,6 +455,10 @@ class RFC3339ConverterTest(unittest.TestCase):
         
         self.assertIsNone(datetime_timestamp)
         
+    def test_from_str_whitespace(self):
+        # A timestamp of only whitespace is blank as well.
+        self.assertIsNone(RFC3339Converter().from_str("  "))
+
     def test_from_str_none(self):
         # None value for the timestamp (i.e., undefined/ignored property value)
         rfc_timestamp = None
@@ -195,6 +481,72 @@ class RFC3339ConverterTest(unittest.TestCase):
         rfc_timestamp = RFC3339Converter().to_str(date_timestamp)
         
         self.assertEqual(None, rfc_timestamp)
+
+    def test_from_str_fractional_seconds(self):
+        datetime_timestamp = RFC3339Converter().from_str(
+            "2012-03-10T03:30:06.25Z")
+
+        self.assertEqual(datetime.datetime(2012, 3, 10, 3, 30, 6, 250000),
+            datetime_timestamp)
+
+    def test_from_str_no_fraction(self):
+        datetime_timestamp = RFC3339Converter().from_str("2012-03-10T03:30:06Z")
+
+        self.assertEqual(datetime.datetime(2012, 3, 10, 3, 30, 6),
+            datetime_timestamp)
+
+    def test_from_str_offset(self):
+        # Timestamps with an offset should be normalized to UTC.
+        converter = RFC3339Converter()
+
+        self.assertEqual(datetime.datetime(2012, 3, 9, 22, 0, 6),
+            converter.from_str("2012-03-10T03:30:06.000+05:30"))
+        self.assertEqual(datetime.datetime(2012, 3, 10, 8, 30, 6),
+            converter.from_str("2012-03-10T03:30:06-05:00"))
+
+    def test_from_str_repeated(self):
+        # The same (cached) timestamp should be returned for repeated strings.
+        converter = RFC3339Converter()
+
+        datetime_timestamp = converter.from_str("2012-04-01T00:00:00.000Z")
+
+        self.assertIs(datetime_timestamp,
+            converter.from_str("2012-04-01T00:00:00.000Z"))
+
+    def test_cache_eviction(self):
+        # Timestamps that are used least recently should be evicted first.
+        RFC3339Converter.clear_cache()
+        converter = RFC3339Converter()
+        first_timestamp = "2012-04-01T00:00:00.000Z"
+
+        datetime_timestamp = converter.from_str(first_timestamp)
+        for i in range(RFC3339Converter._CACHE_SIZE * 2):
+            converter.from_str("2012-04-01T00:00:00.{0:06d}Z".format(i))
+
+            # Keep the first timestamp in use.
+            self.assertIs(datetime_timestamp, converter.from_str(first_timestamp))
+
+        for i in range(RFC3339Converter._CACHE_SIZE * 2):
+            converter.from_str("2012-04-02T00:00:00.{0:06d}Z".format(i))
+
+        self.assertIsNot(datetime_timestamp, converter.from_str(first_timestamp))
+        self.assertEqual(datetime_timestamp, converter.from_str(first_timestamp))
+
+    def test_from_str_invalid(self):
+        converter = RFC3339Converter()
+
+        for rfc_timestamp in ("2012-03-10", "2012-03-10 03:30:06.000Z",
+                "2012-03-10T03:30:06.Z", "2012-03-10T03:30:06.000",
+                "2012-03-10T03:30:06.000+0530", "2012-13-10T03:30:06.000Z"):
+            with self.assertRaises(ValueError):
+                converter.from_str(rfc_timestamp)
+
+    def test_to_str_milliseconds(self):
+        date_timestamp = datetime.datetime(2012, 3, 10, 3, 30, 6, 250999)
+
+        rfc_timestamp = RFC3339Converter().to_str(date_timestamp)
+
+        self.assertEqual("2012-03-10T03:30:06.250Z", rfc_timestamp)
 #------------------------------------------------------------------------------ 
 
 class IntConverter(PropertyConverter):
@@ -5,12 +5,29 @@ Created on Mar 18, 2012
 """
 
 from datetime import datetime
+import copy
+import pickle
 import unittest
 import coggrinder.utilities
-from coggrinder.entities.properties import EntityProperty, RFC3339Converter, IntConverter, BooleanConverter, TaskStatus, TaskStatusConverter
+from coggrinder.entities.properties import EntityProperty, EntityCodec, RFC3339Converter, IntConverter, BooleanConverter, TaskStatus, TaskStatusConverter
 from coggrinder.utilities import GoogleKeywords
 
 class BaseTaskEntity(object):
+    """
+    Entities use __slots__ rather than a per-instance __dict__, as large 
+    accounts can hold tens of thousands of tasks in memory at once. Any
+    subclass must also declare __slots__ (even if empty) to preserve this.
+    
+    A property that has never been assigned is considered absent (not None)
+    when converting to and from str dicts and when testing for equality.
+    
+    Entities loaded from a str dict keep track of which properties have been
+    modified since, so that updates only need to send those properties. The
+    loaded values are captured (as a snapshot) by the codec while decoding,
+    which costs far less than a __setattr__ override watching every change.
+    """
+    __slots__ = ("entity_id", "e_tag", "title", "updated_date", "is_updated",
+        "children", "_snapshot")
     _ARGUMENT_FAIL_MESSAGE = "Provided {0} argument must be of type {1}"
     _properties = (
             EntityProperty("entity_id", GoogleKeywords.ID),
@@ -52,30 +69,63 @@ class BaseTaskEntity(object):
         else:
             self.children = children
 
+        # Property values as of the last load, or None if every property is
+        # to be considered modified.
+        self._snapshot = None
+
     @classmethod
     def from_str_dict(cls, str_dict):
-        # Create a new blank entity.
+        # Create a new blank entity, and use the class' codec to convert each
+        # string representation into the correct "object" value for the 
+        # property.
         entity = cls._create_blank_entity()
+        entity._snapshot = cls._get_codec().decode_snapshot(str_dict, entity)
+
+        return entity
+
+    def mark_unmodified(self):
+        """Treat the current property values as unmodified."""
+        self._snapshot = self._get_codec().snapshot(self)
 
-        # Loop through each property, converting each string representation 
-        # into the correct "object" value for the property.
-        for prop in cls._get_properties():
-            # For each property, lookup the value of the property in the string
-            # dict.
-            if str_dict.has_key(prop.str_dict_key):
-                # Key is present, convert to object value.
-                str_value = str_dict[prop.str_dict_key]
+    def mark_modified(self):
+        """Treat every property as modified."""
+        self._snapshot = None
 
-                # Using the property's specific converter, convert from the string 
-                # representation to the object value.
-                obj_value = prop.from_str(str_value)
+    def get_modified_str_dict(self):
+        """
+        Create a str dict of only the properties that have been modified since
+        the entity was loaded (or marked unmodified). Properties that have 
+        been cleared are included with a None value. If the entity wasn't
+        loaded from a str dict, all of its properties are included.
+        """
+        if self._snapshot is None:
+            return self.to_str_dict()
+
+        return self._get_codec().encode_modified(self, self._snapshot)
 
-                # Push the object value into the new entity's corresponding property.
-                entity.__dict__[prop.entity_key] = obj_value
+    def copy(self):
+        """Create a copy of the entity, including which of its properties have
+        been modified.
+        """
+        entity = self.from_str_dict(self.to_str_dict())
+        entity._snapshot = self._snapshot
 
-        # Return the (hopefully completed) entity.
         return entity
 
+    @classmethod
+    def _get_codec(cls):
+        """
+        Get the EntityCodec for this class, building it from the class' 
+        properties the first time it's requested. Codecs are cached per 
+        class, so subclasses never share a codec with their parent class.
+        """
+        codec = cls.__dict__.get("_codec")
+        if codec is None:
+            codec = EntityCodec(cls._get_properties())
+            cls._codec = codec
+
+        return codec
+
     @classmethod
     def _create_blank_entity(cls):
         """
@@ -91,27 +141,7 @@ class BaseTaskEntity(object):
         return BaseTaskEntity._properties
 
     def to_str_dict(self, include_none_values=False):
-        # Create a blank string dict.
-        str_dict = dict()
-
-        # Loop through each property, converting the property value to string
-        # representations.
-        for prop in self._get_properties():
-            # Ensure the property has an associated value.
-            if self.__dict__.has_key(prop.entity_key):
-                # Identify the property value.
-                obj_value = self.__dict__[prop.entity_key]
-
-                # Only add the value to the str dict if the value isn't None, or
-                # none values are specified to be included.
-                if obj_value != None or include_none_values:
-                    # Convert the property value to a string representation.
-                    str_value = prop.to_str(obj_value)
-
-                    # Push that string representation into the string dict.
-                    str_dict[prop.str_dict_key] = str_value
-
-        return str_dict
+        return self._get_codec().encode(self, include_none_values)
 
     def to_insert_dict(self):
         # Create base dict.
@@ -150,20 +180,23 @@ class BaseTaskEntity(object):
             # same between the two objects.
             are_equal = True
             for prop in self._get_properties():
-                if self.__dict__.has_key(prop.entity_key):
+                if hasattr(self, prop.entity_key):
                     # If the key is defined for the current entity, make sure the
                     # other entity also has the key defined and that those two
                     # keys have the same value.
-                    if (not other.__dict__.has_key(prop.entity_key)) or (self.__dict__[prop.entity_key] != other.__dict__[prop.entity_key]):
+                    if (not hasattr(other, prop.entity_key)) or (getattr(self, prop.entity_key) != getattr(other, prop.entity_key)):
                         are_equal = False
                         break
-                elif other.__dict__.has_key(prop.entity_key):
+                elif hasattr(other, prop.entity_key):
                     # The key is not defined in self, but is in other. The two
                     # objects are not equal.
                     are_equal = False
                     break
 
         return are_equal
+    
+    def __ne__(self, other):
+        return not self.__eq__(other)
 #------------------------------------------------------------------------------ 
 
 class BaseTaskEntityTest(unittest.TestCase):
@@ -235,6 +268,8 @@ class TaskList(BaseTaskEntity):
     clear whether a TaskList or Task entity is being used. A TaskList is 
     otherwise (functionaly) identical to the BaseTaskEntity class. 
     """
+    __slots__ = ()
+    
     @classmethod
     def _create_blank_entity(cls):
         # A tasklist is basically a BaseTaskEntity, but the 
@@ -247,6 +282,8 @@ class TaskList(BaseTaskEntity):
 #------------------------------------------------------------------------------ 
 
 class Task(BaseTaskEntity):
+    __slots__ = ("tasklist_id", "parent_id", "position", "notes", "task_status",
+        "due_date", "completed_date", "is_deleted", "is_hidden")
     _properties = (
             EntityProperty("parent_id", GoogleKeywords.PARENT),
             EntityProperty("position", GoogleKeywords.POSITION, IntConverter()),
@@ -261,12 +298,13 @@ class Task(BaseTaskEntity):
 
     def __init__(self, tasklist_id=None, entity_id=None, title=None, updated_date=None,
             children=None, parent_id=None, task_status=TaskStatus.NEEDS_ACTION,
-            position=0):
+            position=None):
         super(Task, self).__init__(entity_id, title, updated_date, children)
 
         self.parent_id = parent_id
         self.task_status = task_status
         self.tasklist_id = tasklist_id
+        self.position = position
 
         # Establish default properties.
         self.notes = None
@@ -298,6 +336,7 @@ class Task(BaseTaskEntity):
             # Aggregate those properties along with this class' particular
             # property definitions.
             cls._properties = cls._properties + super_properties
+            cls._props_initialized = True
 
         # Return combined properties. 
         return cls._properties
@@ -306,6 +345,13 @@ class Task(BaseTaskEntity):
     def _create_blank_entity(cls):
         entity = Task()
 
+        return entity
+
+    def copy(self):
+        # The tasklist ID isn't part of the task's str dict.
+        entity = super(Task, self).copy()
+        entity.tasklist_id = self.tasklist_id
+
         return entity
 #------------------------------------------------------------------------------ 
 
@@ -330,7 +376,7 @@ class TaskItemTest(unittest.TestCase):
         taskitem.title = task_title
         taskitem.updated_date = datetime(2012, 3, 10, 3, 30, 6)
         taskitem.position = 1073741823
-        taskitem.status = task_status
+        taskitem.task_status = task_status
 
         actual_str_dict = taskitem.to_str_dict()
 
@@ -356,9 +402,107 @@ class TaskItemTest(unittest.TestCase):
         expected_taskitem.title = task_title
         expected_taskitem.updated_date = datetime(2012, 3, 10, 3, 30, 6)
         expected_taskitem.position = 1073741823
-        expected_taskitem.status = task_status
+        expected_taskitem.task_status = task_status
 
         actual_taskitem = Task.from_str_dict(str_dict)
 
         self.assertEqual(expected_taskitem, actual_taskitem)
+
+    def test_to_str_dict_no_position(self):
+        # A task that was never given a position shouldn't gain one when it's
+        # encoded.
+        str_dict = {GoogleKeywords.ID: "abcid",
+            GoogleKeywords.TITLE: "task title",
+            GoogleKeywords.STATUS: TaskStatus.NEEDS_ACTION}
+
+        self.assertEqual(str_dict, Task.from_str_dict(str_dict).to_str_dict())
+
+    def test_slots(self):
+        # Tasks should not carry a per-instance __dict__, and unknown 
+        # attributes should be rejected.
+        task = Task(entity_id="abcid", title="task title")
+        
+        self.assertFalse(hasattr(task, "__dict__"))
+        with self.assertRaises(AttributeError):
+            task.status = TaskStatus.COMPLETED
+
+    def test_properties_aggregated_once(self):
+        # Repeated lookups should not keep re-appending the ancestor
+        # properties.
+        property_count = len(Task._get_properties())
+
+        self.assertEqual(property_count, len(Task._get_properties()))
+        self.assertEqual(len(BaseTaskEntity._get_properties()) + 8,
+            property_count)
+
+    def test_codec_per_class(self):
+        self.assertIsNot(Task._get_codec(), TaskList._get_codec())
+        self.assertIs(Task._get_codec(), Task._get_codec())
+        self.assertIsInstance(TaskList.from_str_dict({GoogleKeywords.ID: "1"}),
+            TaskList)
+
+    def test_equality_unset_property(self):
+        # A property that has been set (even to None) on only one of the tasks
+        # makes the tasks unequal.
+        task_1 = Task(entity_id="abcid", title="task title")
+        task_2 = Task(entity_id="abcid", title="task title")
+        self.assertEqual(task_1, task_2)
+        
+        task_1.e_tag = None
+        self.assertNotEqual(task_1, task_2)
+
+    def test_get_modified_str_dict(self):
+        task = Task.from_str_dict({GoogleKeywords.ID: "abcid",
+            GoogleKeywords.TITLE: "task title",
+            GoogleKeywords.NOTES: "task notes"})
+        self.assertEqual({}, task.get_modified_str_dict())
+
+        task.title = "updated title"
+        task.notes = None
+        self.assertEqual({GoogleKeywords.TITLE: "updated title",
+            GoogleKeywords.NOTES: None}, task.get_modified_str_dict())
+
+        # A copy keeps track of the same modifications.
+        task_copy = task.copy()
+        self.assertEqual(task.get_modified_str_dict(),
+            task_copy.get_modified_str_dict())
+
+        task.mark_unmodified()
+        self.assertEqual({}, task.get_modified_str_dict())
+
+        # A task that wasn't loaded is entirely modified.
+        task.mark_modified()
+        self.assertEqual(task.to_str_dict(), task.get_modified_str_dict())
+
+    def test_get_modified_str_dict_unset_property(self):
+        # A property missing from the str dict keeps the blank task's value,
+        # and is only modified once that value changes.
+        task = Task.from_str_dict({GoogleKeywords.ID: "abcid"})
+        self.assertEqual({}, task.get_modified_str_dict())
+
+        task.notes = "task notes"
+        self.assertEqual({GoogleKeywords.NOTES: "task notes"},
+            task.get_modified_str_dict())
+
+    def test_from_str_dict_type(self):
+        task = Task.from_str_dict({GoogleKeywords.ID: "abcid"})
+        task.title = "updated title"
+
+        self.assertIs(Task, type(task))
+        self.assertIs(TaskList,
+            type(TaskList.from_str_dict({GoogleKeywords.ID: "1"})))
+
+    def test_pickle_and_deepcopy(self):
+        # Loaded tasks survive being pickled and deep copied, along with 
+        # their modifications.
+        task = Task.from_str_dict({GoogleKeywords.ID: "abcid",
+            GoogleKeywords.TITLE: "task title"})
+        task.title = "updated title"
+
+        for task_copy in (copy.deepcopy(task), 
+            pickle.loads(pickle.dumps(task, pickle.HIGHEST_PROTOCOL))):
+            self.assertIs(Task, type(task_copy))
+            self.assertEqual(task, task_copy)
+            self.assertEqual({GoogleKeywords.TITLE: "updated title"},
+                task_copy.get_modified_str_dict())
 #------------------------------------------------------------------------------ 
@@ -5,15 +5,305 @@ Created on Apr 11, 2012
 '''
 
 import unittest
+from coggrinder.entities.tasks import TaskList, Task
 
-class Tree(object):
+class NodeContainer(object):
+    """Common base for anything that holds an ordered list of child nodes (the
+    tree itself, and each tree node).
+
+    Child paths are never stored eagerly. Instead, each container keeps a
+    version number for its list of children that is bumped whenever the
+    positions of existing children change, along with a lazily rebuilt
+    index of child positions. Nodes use both to derive (and cache) their
+    paths on demand.
+    """
+    __slots__ = ("children", "_children_version", "_child_positions")
+
+    def __init__(self):
+        self.children = list()
+        self._children_version = 0
+        self._child_positions = None
+
+    def _invalidate_child_paths(self):
+        """Mark the paths of all children (and, by extension, their
+        descendants) as stale. Must be called after any change to the
+        children list that shifts the position of an existing child.
+        """
+        self._children_version += 1
+        self._child_positions = None
+
+    def _get_child_position(self, node):
+        """Find the index of the given node within this container's children.
+
+        The position index is rebuilt at most once per structural change, so
+        repeatedly resolving the positions of siblings is O(1) amortized.
+        """
+        if self._child_positions is None:
+            positions = dict()
+            for index, child_node in enumerate(self.children):
+                positions[child_node] = index
+
+            self._child_positions = positions
+
+        return self._child_positions[node]
+
+    def _append_child(self, node):
+        """Append a node to the end of the children list.
+
+        Appending doesn't shift any existing children, so the paths of the
+        current children remain valid and no invalidation is needed.
+        """
+        if self._child_positions is not None:
+            self._child_positions[node] = len(self.children)
+
+        self.children.append(node)
+#------------------------------------------------------------------------------ 
+
+class Tree(NodeContainer):
     ROOT_PATH = (0,)
     PATH_SEPARATOR = ":"
 
     def __init__(self):
-        self.children = list()
+        NodeContainer.__init__(self)
+
+        # The tree itself is the (addressless) parent of the root node.
         self.path = ()
 
+        # Index of all nodes holding an entity value, keyed by entity ID.
+        self._entity_index = dict()
+
+    @classmethod
+    def from_tasks(cls, tasklists, tasks):
+        """Build a complete task tree from flat collections of tasklists and
+        tasks.
+
+        The root node of the resulting tree holds no value. Tasklists will be
+        the first-level nodes (in the iteration order of the tasklists dict),
+        with their tasks below them, and siblings ordered by task position.
+        Tasks are grouped by parent in a single pass and the tree is built
+        iteratively, so the build is O(n log n) in the number of tasks.
+
+        Tasks belonging to an unknown tasklist are ignored. Tasks whose parent
+        task cannot be found are treated as top-level tasks of their tasklist.
+
+        Args:
+            tasklists: A dict of TaskLists, keyed by entity ID.
+            tasks: A dict of Tasks, keyed by entity ID.
+        Returns:
+            The populated Tree.
+        """
+        tree = cls()
+        root_node = tree.append(None, None)
+
+        # Group the tasks by (tasklist, parent) in a single pass.
+        child_tasks = dict()
+        for task in tasks.itervalues():
+            parent_id = task.parent_id
+            if parent_id is not None and parent_id not in tasks:
+                # Orphaned task, promote it to be a top-level task.
+                parent_id = None
+
+            sibling_key = (task.tasklist_id, parent_id)
+            if sibling_key in child_tasks:
+                child_tasks[sibling_key].append(task)
+            else:
+                child_tasks[sibling_key] = [task]
+
+        for sibling_tasks in child_tasks.itervalues():
+            sibling_tasks.sort(key=Tree._get_task_sort_key)
+
+        # Walk down from each tasklist, adding each group of child tasks
+        # beneath their parent node.
+        pending_nodes = list()
+        for tasklist in tasklists.itervalues():
+            tasklist_node = tree.append(root_node, tasklist)
+            pending_nodes.append((tasklist_node, tasklist.entity_id, None))
+
+        while pending_nodes:
+            parent_node, tasklist_id, parent_id = pending_nodes.pop()
+
+            for task in child_tasks.get((tasklist_id, parent_id), ()):
+                task_node = tree.append(parent_node, task)
+                pending_nodes.append((task_node, tasklist_id, task.entity_id))
+
+        return tree
+
+    @staticmethod
+    def _get_task_sort_key(task):
+        position = getattr(task, "position", None)
+        if position is None:
+            position = 0
+
+        return (position, task.entity_id)
+
+    def apply_entity_changes(self, changes, listener=None):
+        """Apply changes to the tasklists and tasks of a task tree (as built
+        by from_tasks) in place, placing each added, updated or moved entity 
+        where from_tasks would.
+
+        Only the nodes of the changed entities are visited, along with the 
+        siblings they're placed among, so the cost depends on the number of 
+        changes rather than on the size of the tree.
+
+        A task left behind by a removed parent task becomes a top-level task
+        of its tasklist, while the tasks of a removed tasklist are removed 
+        along with it.
+
+        Args:
+            changes: The EntityChanges to apply.
+            listener: Optional TreeChangeListener, told about each change to
+                the tree right after it has been made.
+        """
+        if listener is None:
+            listener = TreeChangeListener()
+
+        for old_entity_id, new_entity_id in changes.replaced_entity_ids.iteritems():
+            node = self._entity_index.pop(old_entity_id, None)
+            if node is None:
+                continue
+
+            existing_node = self._entity_index.get(new_entity_id)
+            if existing_node is None:
+                self._entity_index[new_entity_id] = node
+                listener.entity_id_replaced(old_entity_id, new_entity_id)
+            else:
+                # The entity was already added under its new ID (e.g., by a 
+                # refresh), so the node for the old ID hands over its 
+                # children and goes.
+                for child_node in list(node.children):
+                    self._move_entity_node(child_node, existing_node, listener)
+
+                path, parent_node = node.path, node.parent
+                self.remove_node(node)
+                listener.node_removed(node, path, parent_node, False)
+
+        removed_entity_ids = set(changes.removed_entity_ids)
+        for entity_id in changes.removed_entity_ids:
+            node = self.get_node_for_entity_id(entity_id, must_find=False)
+            if node is not None:
+                self._remove_entity_node(node, removed_entity_ids, listener)
+
+        for entity in self._order_parents_first(changes.updated_entities):
+            self._place_entity(entity, listener)
+
+    def _remove_entity_node(self, node, removed_entity_ids, listener):
+        if isinstance(node.value, Task):
+            tasklist_node = self.get_node_for_entity_id(node.value.tasklist_id,
+                must_find=False)
+            for child_node in list(node.children):
+                if (tasklist_node is not None 
+                        and child_node.value.entity_id not in removed_entity_ids):
+                    self._move_entity_node(child_node, tasklist_node, listener)
+
+        path, parent_node = node.path, node.parent
+        self.remove_node(node)
+        listener.node_removed(node, path, parent_node, False)
+
+    def _place_entity(self, entity, listener):
+        node = self.get_node_for_entity_id(entity.entity_id, must_find=False)
+        parent_node = self._find_entity_parent_node(entity)
+
+        if parent_node is None:
+            # Tasks belonging to an unknown tasklist aren't part of the tree.
+            if node is not None:
+                self._remove_entity_node(node, (), listener)
+        elif node is None:
+            node = TreeNode(value=entity)
+            self._attach_node(parent_node, node,
+                self._find_entity_position(parent_node, entity))
+            self._index_node(node)
+            listener.node_inserted(node)
+        else:
+            node.value = entity
+            if node.parent is parent_node and self._is_entity_in_position(node):
+                listener.node_updated(node)
+            else:
+                self._move_entity_node(node, parent_node, listener)
+
+    def _move_entity_node(self, node, parent_node, listener):
+        self._validate_move_target(parent_node, node)
+
+        path, old_parent_node = node.path, node.parent
+        self._detach_node(node)
+        listener.node_removed(node, path, old_parent_node, True)
+
+        self._attach_node(parent_node, node,
+            self._find_entity_position(parent_node, node.value))
+        listener.node_inserted(node)
+
+    def _find_entity_parent_node(self, entity):
+        if isinstance(entity, TaskList):
+            return self.get_node(Tree.ROOT_PATH)
+
+        parent_node = None
+        if entity.parent_id is not None:
+            parent_node = self.get_node_for_entity_id(entity.parent_id,
+                must_find=False)
+        if parent_node is None:
+            # Orphaned (or top-level) task.
+            parent_node = self.get_node_for_entity_id(entity.tasklist_id,
+                must_find=False)
+
+        return parent_node
+
+    def _find_entity_position(self, parent_node, entity):
+        """Find the position that a task should be inserted at among the 
+        (sorted) child tasks of the parent node, or None to append a 
+        tasklist.
+        """
+        if isinstance(entity, TaskList):
+            return None
+
+        sort_key = Tree._get_task_sort_key(entity)
+        child_nodes = parent_node.children
+        low, high = 0, len(child_nodes)
+        while low < high:
+            middle = (low + high) // 2
+            if Tree._get_task_sort_key(child_nodes[middle].value) < sort_key:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def _is_entity_in_position(self, node):
+        if isinstance(node.value, TaskList):
+            return True
+
+        sort_key = Tree._get_task_sort_key(node.value)
+        sibling_nodes = node.parent.children
+        position = node.path[-1]
+
+        return ((position == 0 or Tree._get_task_sort_key(
+                sibling_nodes[position - 1].value) < sort_key)
+            and (position == len(sibling_nodes) - 1 or sort_key 
+                < Tree._get_task_sort_key(sibling_nodes[position + 1].value)))
+
+    @staticmethod
+    def _order_parents_first(entities):
+        """Order the entities so that tasklists come first, and each task 
+        comes after its parent task (if the parent is also among the 
+        entities).
+        """
+        ordered_entities = [entity for entity in entities 
+            if isinstance(entity, TaskList)]
+        pending_tasks = dict((entity.entity_id, entity) for entity in entities
+            if not isinstance(entity, TaskList))
+
+        for entity in entities:
+            # Walk up through any pending ancestors, and then add them from 
+            # the top down.
+            ancestor_tasks = list()
+            while entity is not None and entity.entity_id in pending_tasks:
+                entity = pending_tasks.pop(entity.entity_id)
+                ancestor_tasks.append(entity)
+                entity = pending_tasks.get(entity.parent_id)
+
+            ancestor_tasks.reverse()
+            ordered_entities.extend(ancestor_tasks)
+
+        return ordered_entities
+
     # TODO: What's the difference between append and insert?
     def append(self, parent_node, value):
         new_node = TreeNode(value=value)
@@ -21,6 +311,19 @@ class Tree(object):
         return self.append_node(parent_node, new_node)
 
     def append_node(self, parent_node, new_node):
+        self._attach_node(parent_node, new_node)
+        self._index_subtree(new_node)
+
+        return new_node
+
+    def _attach_node(self, parent_node, new_node, position=None):
+        """Add the node to the children of the parent node without updating
+        the entity index.
+
+        Args:
+            position: The index of the node among its new siblings. Defaults
+                to None, placing the node after all of its siblings.
+        """
         if not parent_node:
             # An empty parent node implies the tree is the parent.
             parent_node = self
@@ -29,11 +332,12 @@ class Tree(object):
                 # If the tree already has a root node, raise an error.
                 raise DuplicateRootError()
 
-        new_child_index = len(parent_node.children)
-        new_node.path = parent_node.path + (new_child_index,)
         new_node.parent = parent_node
-
-        parent_node.children.append(new_node)
+        if position is None or position == len(parent_node.children):
+            parent_node._append_child(new_node)
+        else:
+            parent_node.children.insert(position, new_node)
+            parent_node._invalidate_child_paths()
 
         return new_node
 
@@ -109,33 +413,86 @@ class Tree(object):
         if self.get_node(Tree.ROOT_PATH) in nodes:
             raise RootReorganizationError()
 
+        # Collect the nodes into a set to allow constant time membership tests
+        # while walking each sibling group.
+        selected_nodes = set(nodes)
+
         # Sort all nodes by parent.
         sorted_nodes = self._sort_nodes_by_parent(*nodes)
 
         # Perform demotion operations in the context of each sibling group.
         for parent_node in sorted_nodes:
             if len(parent_node.children) > 1:
-                # Create a set to collect adjacent selected nodes. Adjacent 
-                # selected nodes will be demoted as a group below the lowest 
-                # order adjacent unselected node.
-                adjacent_selected_nodes = set()
-
-                # Walk the list of all sibling nodes (_not_ just the
-                # selected nodes) backwards (lowest order to highest).
-                for sibling_node in reversed(parent_node.children):
-                    if sibling_node in nodes:
-                        # The sibling is selected for demotion, add it to the
-                        # adjacent selected nodes set.
-                        adjacent_selected_nodes.add(sibling_node)
+                # Walk the list of all sibling nodes (_not_ just the selected
+                # nodes) in order, tracking the closest preceding unselected
+                # sibling. Each selected node will be demoted to become the 
+                # last child of that sibling. Selected nodes at the front of
+                # the sibling group have no such sibling and are left in 
+                # place.
+                remaining_nodes = list()
+                new_parent_node = None
+                for sibling_node in parent_node.children:
+                    if sibling_node not in selected_nodes:
+                        new_parent_node = sibling_node
+                        remaining_nodes.append(sibling_node)
+                    elif new_parent_node is None:
+                        remaining_nodes.append(sibling_node)
                     else:
-                        if adjacent_selected_nodes:
-                            # Make all of the adjacent selected nodes children
-                            # of this sibling.
-                            for selected_node in adjacent_selected_nodes:
-                                self.move_node(sibling_node, selected_node)
+                        sibling_node.parent = new_parent_node
+                        new_parent_node._append_child(sibling_node)
+
+                if len(remaining_nodes) != len(parent_node.children):
+                    parent_node.children = remaining_nodes
+                    parent_node._invalidate_child_paths()
+
+    def get_node_for_entity_id(self, entity_id, must_find=True):
+        """Finds the node holding the entity with the given ID.
 
-                            # Reset the adjacent selected nodes collection.
-                            adjacent_selected_nodes.clear()
+        Args:
+            entity_id: The ID of the entity stored as a node value.
+            must_find: If True (the default), raise an EntityNotFoundError
+                when no node holds the entity.
+        Returns:
+            The TreeNode holding the entity, or None if no such node exists
+            and must_find is False.
+        """
+        node = self._entity_index.get(entity_id)
+
+        if must_find and node is None:
+            raise EntityNotFoundError(entity_id)
+
+        return node
+
+    def has_entity_id(self, entity_id):
+        return entity_id in self._entity_index
+
+    def _index_subtree(self, node):
+        """Add the node and all of its descendants to the entity index."""
+        pending_nodes = [node]
+        while pending_nodes:
+            current_node = pending_nodes.pop()
+            self._index_node(current_node)
+            pending_nodes.extend(current_node.children)
+
+    def _unindex_subtree(self, node):
+        """Remove the node and all of its descendants from the entity index."""
+        pending_nodes = [node]
+        while pending_nodes:
+            current_node = pending_nodes.pop()
+            self._unindex_node(current_node)
+            pending_nodes.extend(current_node.children)
+
+    def _index_node(self, node):
+        entity_id = getattr(node.value, "entity_id", None)
+        if entity_id is not None:
+            self._entity_index[entity_id] = node
+
+    def _unindex_node(self, node):
+        entity_id = getattr(node.value, "entity_id", None)
+
+        # Only remove the index entry if it actually points to this node.
+        if entity_id is not None and self._entity_index.get(entity_id) is node:
+            del self._entity_index[entity_id]
 
     def get(self, node_indices):
         node = self.get_node(node_indices)
@@ -198,6 +555,7 @@ class Tree(object):
         new_node = self.insert_node(node_indices)
 
         new_node.value = value
+        self._index_node(new_node)
 
         return new_node
 
@@ -216,17 +574,33 @@ class Tree(object):
         if child_index < 0 or child_index > len(parent_node.children):
             raise IndexError("Node index {0} is not valid for the parent at path {1}".format(child_index, parent_node_address))
 
-        child_node = TreeNode(parent_node, node_indices)
-        parent_node.children.insert(child_index, child_node)
+        child_node = TreeNode(parent_node)
 
-        # Update the paths of any moved nodes.
-        for index in range(child_index, len(parent_node.children)):
-            updated_node = parent_node.children[index]
-            updated_node.path = parent_node.path + (index,)
+        if child_index == len(parent_node.children):
+            parent_node._append_child(child_node)
+        else:
+            # Inserting ahead of existing children shifts their positions.
+            # Rather than rewriting the path of every later sibling (and
+            # their descendants), mark the sibling paths as stale; they will
+            # be recomputed if and when they are requested.
+            parent_node.children.insert(child_index, child_node)
+            parent_node._invalidate_child_paths()
 
         return child_node
 
     def move_node(self, new_parent_node, node):
+        self._validate_move_target(new_parent_node, node)
+
+        # Remove the node from its current position. The node (and its
+        # descendants) remain in the tree, so the entity index is untouched.
+        self._detach_node(node)
+
+        # Add the moving node to the new parent node's children.
+        self._attach_node(new_parent_node, node)
+
+        return node
+
+    def _validate_move_target(self, new_parent_node, node):
         if node is self.get_node(Tree.ROOT_PATH):
             raise RootReorganizationError()
 
@@ -239,48 +613,68 @@ class Tree(object):
 
             parent_node = parent_node.parent
 
-        # Remove the node from its current position.
-        self.remove_node(node)
-
-        # Add the moving node to the new parent node's children.
-        self.append_node(new_parent_node, node)
-
-        return node
-
     def promote(self, *nodes):
         self._validate_reorganization_nodes(*nodes)
 
-        # Sort the nodes in order from deepest (longest path) to shallowest
-        # (shortest path).
-        sorted_nodes = self._sort_nodes_by_depth(*nodes)
-
-        for node in sorted_nodes:
-            grandparent_node = node.parent.parent
-
-            # If the node is already a direct descendant of root, don't 
-            # promote.
-            if grandparent_node is self:
-                continue
-
-            self.remove_node(node)
-            self.append_node(grandparent_node, node)
-
-    def _sort_nodes_by_depth(self, *nodes):
-        sorted_nodes = list()
+        # Group the nodes by depth, and promote each group in order from 
+        # deepest (longest path) to shallowest (shortest path).
+        for depth_nodes in self._group_nodes_by_depth(*nodes):
+            # Find the nodes that can be promoted. If a node is already a
+            # direct descendant of root, don't promote.
+            promoted_nodes = [node for node in depth_nodes
+                if node.parent.parent is not self]
+
+            # Nodes at the same depth can't be ancestors of one another, so 
+            # all of them can be removed from their parents in a single pass 
+            # per sibling group.
+            for parent_node, sibling_nodes in self._sort_nodes_by_parent(
+                *promoted_nodes).iteritems():
+                removed_nodes = set(sibling_nodes)
+                parent_node.children = [child_node
+                    for child_node in parent_node.children
+                    if child_node not in removed_nodes]
+                parent_node._invalidate_child_paths()
+
+            # Append each promoted node to its grandparent, in group order.
+            for node in promoted_nodes:
+                grandparent_node = node.parent.parent
+                node.parent = grandparent_node
+                grandparent_node._append_child(node)
+
+    def _group_nodes_by_depth(self, *nodes):
+        """Group the nodes by their depth in the tree.
+
+        Nodes of the same depth are ordered the way the original insertion 
+        sort ordered them: each node that is no deeper than all of the nodes
+        provided before it starts a new run, later runs come first, and 
+        within a run nodes keep the order in which they were provided. 
+        Promoting same-depth siblings X,Y,Z therefore appends them as Z,Y,X.
 
+        Returns:
+            A list of node lists, one per depth, ordered from the deepest group
+            to the shallowest.
+        """
+        runs = list()
+        min_depth = None
         for node in nodes:
-            # Find the first node in the shortest node that is shallower than 
-            # the current node (has a shorter path), and insert the current
-            # node _before_ it.
-            insert_index = 0
-            for sorted_node in sorted_nodes:
-                if len(node.path) > len(sorted_node.path):
-                    insert_index = sorted_nodes.index(sorted_node)
-                    break
+            depth = node.depth
+            if min_depth is None or depth <= min_depth:
+                min_depth = depth
+                runs.append(list())
 
-            sorted_nodes.insert(insert_index, node)
+            runs[-1].append(node)
 
-        return sorted_nodes
+        depth_groups = dict()
+        for run in reversed(runs):
+            for node in run:
+                depth = node.depth
+                if depth in depth_groups:
+                    depth_groups[depth].append(node)
+                else:
+                    depth_groups[depth] = [node]
+
+        return [depth_groups[depth]
+            for depth in sorted(depth_groups.keys(), reverse=True)]
 
     def remove(self, node_indices):
         node = self.get_node(node_indices)
@@ -289,15 +683,31 @@ class Tree(object):
         return node
 
     def remove_node(self, node):
+        self._detach_node(node)
+        self._unindex_subtree(node)
+
+        return node
+
+    def _detach_node(self, node):
+        """Remove the node from its parent without updating the entity
+        index.
+        """
+        parent_node = node.parent
+
         try:
-            node.parent.children.remove(node)
-        except IndexError:
+            parent_node.children.remove(node)
+        except (AttributeError, ValueError):
             raise NodeNotFoundError(node.path)
 
+        # Removing a node shifts the position of any later siblings.
+        parent_node._invalidate_child_paths()
+        node.parent = None
+
         return node
 
     def reorder_down(self, *nodes):
         assert nodes, "Must provide at least one node to reorder down."
+        selected_nodes = set(nodes)
 
         # Sort all nodes by parent.
         sorted_nodes = self._sort_nodes_by_parent(*nodes)
@@ -311,14 +721,17 @@ class Tree(object):
                     current_node = parent_node.children[i]
                     next_node = parent_node.children[i + 1]
 
-                    if current_node in nodes and not next_node in nodes:
+                    if current_node in selected_nodes and not next_node in selected_nodes:
                         # Current node is selected to move down, while the
                         # next node is _not_. Swap the node positions.
                         parent_node.children[i] = next_node
                         parent_node.children[i + 1] = current_node
 
+                parent_node._invalidate_child_paths()
+
     def reorder_up(self, *nodes):
         assert nodes, "Must provide at least one node to reorder up."
+        selected_nodes = set(nodes)
 
         # Sort all nodes by parent.
         sorted_nodes = self._sort_nodes_by_parent(*nodes)
@@ -332,12 +745,14 @@ class Tree(object):
                     current_node = parent_node.children[i]
                     next_node = parent_node.children[i + 1]
 
-                    if not current_node in nodes and next_node in nodes:
+                    if not current_node in selected_nodes and next_node in selected_nodes:
                         # Current node is not selected to move up, while the
                         # next node is. Swap the node positions.
                         parent_node.children[i] = next_node
                         parent_node.children[i + 1] = current_node
 
+                parent_node._invalidate_child_paths()
+
     def _sort_nodes_by_parent(self, *nodes):
         sorted_nodes = dict()
 
@@ -358,7 +773,9 @@ class Tree(object):
         if node is None:
             raise NodeNotFoundError(node_indices)
 
+        self._unindex_node(node)
         node.value = value
+        self._index_node(node)
 
         return node
 
@@ -371,21 +788,140 @@ class Tree(object):
             raise RootReorganizationError()
 #------------------------------------------------------------------------------ 
 
-class TreeNode(object):
+class EntityChanges(object):
+    """The changes to the tasklists and tasks of a task tree, as applied by
+    Tree.apply_entity_changes.
+
+    Attributes:
+        updated_entities: List of the tasklists and tasks that have been 
+            added or updated.
+        removed_entity_ids: List of the IDs of the tasklists and tasks that 
+            have been removed.
+        replaced_entity_ids: Dict of the new IDs of entities whose IDs have 
+            changed (e.g., once a new task has been assigned its real ID),
+            keyed by the old IDs. Each entity must also be among the updated
+            entities, under its new ID.
+    """
+    def __init__(self, updated_entities=None, removed_entity_ids=None,
+            replaced_entity_ids=None):
+        if updated_entities is None:
+            updated_entities = list()
+        if removed_entity_ids is None:
+            removed_entity_ids = list()
+        if replaced_entity_ids is None:
+            replaced_entity_ids = dict()
+
+        self.updated_entities = updated_entities
+        self.removed_entity_ids = removed_entity_ids
+        self.replaced_entity_ids = replaced_entity_ids
+
+    def __repr__(self):
+        return "EntityChanges(updated: {0}, removed: {1}, replaced: {2})".format(
+            [entity.entity_id for entity in self.updated_entities],
+            self.removed_entity_ids, self.replaced_entity_ids)
+#------------------------------------------------------------------------------ 
+
+class TreeChangeListener(object):
+    """Receives each change Tree.apply_entity_changes makes to a tree, right
+    after it has been made. Does nothing by default.
+    """
+    def node_inserted(self, node):
+        """The node has been inserted (or moved) into the tree."""
+        pass
+
+    def node_removed(self, node, path, parent_node, is_moving):
+        """The node (along with its descendants) has been taken out of the 
+        tree, from the path beneath the parent node. If is_moving, the node 
+        is about to be inserted elsewhere in the tree.
+        """
+        pass
+
+    def node_updated(self, node):
+        """The node's value has been replaced, without moving the node."""
+        pass
+
+    def entity_id_replaced(self, old_entity_id, new_entity_id):
+        """The node holding the entity now holds it under a new ID."""
+        pass
+#------------------------------------------------------------------------------ 
+
+class TreeNode(NodeContainer):
     """Simple tree node that contains a value and allows traversal up (towards
     root), down (to children), previous and next.
+
+    Nodes use __slots__ to keep the per-node memory overhead down, as a tree
+    holds one node for every task in the account.
     """
-    def __init__(self, parent=None, path=None, value=None):
+    __slots__ = ("parent", "value", "_path", "_path_parent",
+        "_path_parent_path", "_path_parent_version")
+
+    def __init__(self, parent=None, value=None):
         """Create the node with a parent and option value.
 
         Args:
+            parent: The parent node (or tree) of this node. Defaults to None,
+                indicating a node that has not yet been added to a tree.
             value: The value to be stored at this tree node.
         """
+        NodeContainer.__init__(self)
+
         self.parent = parent
-        self.path = path
         self.value = value
 
-        self.children = list()
+        # Cached path, along with the state of the parent that the cached
+        # path was derived from.
+        self._path = None
+        self._path_parent = None
+        self._path_parent_path = None
+        self._path_parent_version = None
+
+    @property
+    def path(self):
+        """The address of this node within its tree, derived from the parent
+        links and sibling positions.
+
+        The path is computed on demand and cached. The cached value is only
+        reused while the parent is the same, the parent's own path is
+        unchanged, and the parent's children have not been reordered;
+        structural changes therefore invalidate entire subtrees without
+        having to visit them.
+
+        Returns:
+            A tuple of child indices beginning with the root node (0), or None
+            if the node doesn't belong to a tree.
+        """
+        parent_node = self.parent
+        if parent_node is None:
+            return None
+
+        parent_path = parent_node.path
+        if parent_path is None:
+            return None
+
+        if (self._path is None
+            or self._path_parent is not parent_node
+            or self._path_parent_path is not parent_path
+            or self._path_parent_version != parent_node._children_version):
+            self._path = parent_path + (parent_node._get_child_position(self),)
+            self._path_parent = parent_node
+            self._path_parent_path = parent_path
+            self._path_parent_version = parent_node._children_version
+
+        return self._path
+
+    @property
+    def depth(self):
+        """The number of nodes between this node and the tree, inclusive. For
+        nodes within a tree, this is always equal to the length of the node's
+        path, but avoids the need to resolve sibling positions.
+        """
+        depth = 0
+        node = self
+        while isinstance(node, TreeNode):
+            depth += 1
+            node = node.parent
+
+        return depth
 
     def has_children(self):
         if len(self.children) > 0:
@@ -406,6 +942,13 @@ class NodeNotFoundError(Exception):
             "Node could not be found at path {0}".format(node_path))
 #------------------------------------------------------------------------------
 
+class EntityNotFoundError(Exception):
+    def __init__(self, entity_id):
+        Exception.__init__(self,
+            "Node could not be found for entity id {0}".format(entity_id))
+        self.entity_id = entity_id
+#------------------------------------------------------------------------------
+
 class DuplicateRootError(Exception):
     def __init__(self):
         Exception.__init__(self, "Cannot add another root to the tree.")
@@ -1207,6 +1750,122 @@ class TreePopulateTest(unittest.TestCase):
         self.assertEqual(root_value, tree.get((0,)))
         self.assertEqual(n1_value, tree.get((0, 0)))
         self.assertEqual(n2_value, tree.get((0, 1)))
+
+    def test_insert_updates_descendant_paths(self):
+        """Ensure inserting a node ahead of existing siblings updates the
+        paths of those siblings and of their descendants.
+
+        Initial tree:
+        - root
+            - A
+                - B
+
+        Expected result tree:
+        - root
+            - N
+            - A
+                - B
+
+        Arrange:
+            Create root,A,B nodes.
+            Access the path of B (to populate any cached paths).
+        Act:
+            Insert new node N at 0:0.
+        Assert:
+            Node A has path 0:1.
+            Node B has path 0:1:0.
+        """
+        ### Arrange ###
+        tree = Tree()
+        root = tree.append(None, "root")
+        node_a = tree.append(root, "A")
+        node_b = tree.append(node_a, "B")
+        self.assertEqual((0, 0, 0), node_b.path)
+
+        ### Act ###
+        tree.insert((0, 0), "N")
+
+        ### Assert ###
+        self.assertEqual((0, 1), node_a.path)
+        self.assertEqual((0, 1, 0), node_b.path)
+
+    def test_remove_node_updates_sibling_paths(self):
+        """Ensure removing a node updates the paths of the later siblings and
+        their descendants, and detaches the removed node.
+
+        Initial tree:
+        - root
+            - A
+            - B
+                - C
+
+        Arrange:
+            Create root,A,B,C nodes.
+            Access the path of C (to populate any cached paths).
+        Act:
+            Remove node A.
+        Assert:
+            Node B has path 0:0.
+            Node C has path 0:0:0.
+            Node A no longer has a path.
+        """
+        ### Arrange ###
+        tree = Tree()
+        root = tree.append(None, "root")
+        node_a = tree.append(root, "A")
+        node_b = tree.append(root, "B")
+        node_c = tree.append(node_b, "C")
+        self.assertEqual((0, 1, 0), node_c.path)
+
+        ### Act ###
+        tree.remove_node(node_a)
+
+        ### Assert ###
+        self.assertEqual((0, 0), node_b.path)
+        self.assertEqual((0, 0, 0), node_c.path)
+        self.assertIsNone(node_a.path)
+
+    def test_move_node_updates_descendant_paths(self):
+        """Ensure moving a branch node updates the paths of its descendants.
+
+        Initial tree:
+        - root
+            - A
+                - B
+                    - C
+            - D
+
+        Expected result tree:
+        - root
+            - A
+            - D
+                - B
+                    - C
+
+        Arrange:
+            Create root,A,B,C,D nodes.
+            Access the path of C (to populate any cached paths).
+        Act:
+            Move node B to be a child of D.
+        Assert:
+            Node B has path 0:1:0.
+            Node C has path 0:1:0:0.
+        """
+        ### Arrange ###
+        tree = Tree()
+        root = tree.append(None, "root")
+        node_a = tree.append(root, "A")
+        node_b = tree.append(node_a, "B")
+        node_c = tree.append(node_b, "C")
+        node_d = tree.append(root, "D")
+        self.assertEqual((0, 0, 0, 0), node_c.path)
+
+        ### Act ###
+        tree.move_node(node_d, node_b)
+
+        ### Assert ###
+        self.assertEqual((0, 1, 0), node_b.path)
+        self.assertEqual((0, 1, 0, 0), node_c.path)
 #------------------------------------------------------------------------------
 
 class BaseTreeReorganizationTest(unittest.TestCase):
@@ -1547,6 +2206,29 @@ class TreePromoteTest(unittest.TestCase):
         self.assertEqual(self.node_c, self.tree.get_node((0, 0, 1)))
         self.assertEqual(self.node_d, self.tree.get_node((0, 0, 0, 0)))
 
+    def test_promote_multiple_adjacent_nodes_reverse_order(self):
+        """Test promoting nodes D,C (providing the shallower node last).
+
+        The order in which the nodes are provided should not matter; the
+        result should be the same as promoting nodes C,D.
+
+        Act:
+            Promote nodes D,C.
+        Assert:
+            Node B is still directly below A and in the first position
+            (0,0,0).
+            Node C is directly below A in the second position, behind
+            node B (0,0,1).
+            Node D is a direct child of B (0,0,0,0).
+        """
+        ### Act ###
+        self.tree.promote(self.node_d, self.node_c)
+
+        ### Assert ###
+        self.assertEqual(self.node_b, self.tree.get_node((0, 0, 0)))
+        self.assertEqual(self.node_c, self.tree.get_node((0, 0, 1)))
+        self.assertEqual(self.node_d, self.tree.get_node((0, 0, 0, 0)))
+
     def test_promote_multiple_separate_nodes(self):
         """Test promoting nodes C,E.
 
@@ -1582,6 +2264,86 @@ class TreePromoteTest(unittest.TestCase):
         self.assertEqual(self.node_e, self.tree.get_node((0, 0, 1, 1)))
 #------------------------------------------------------------------------------ 
 
+class TreePromoteOrderTest(unittest.TestCase):
+    """Test the order in which nodes of the same depth are appended to their
+    grandparent when promoted together.
+
+    Assume the following tree for this test case group:
+    - root
+        - G
+            - A
+                - X
+                - Y
+                - Z
+        - H
+            - K
+    """
+    def setUp(self):
+        """Create the tree outlined in the class docstring."""
+        self.tree = Tree()
+
+        self.root = self.tree.append(None, "root")
+
+        self.node_g = self.tree.append(self.root, "G")
+        self.node_a = self.tree.append(self.node_g, "A")
+        self.node_x = self.tree.append(self.node_a, "X")
+        self.node_y = self.tree.append(self.node_a, "Y")
+        self.node_z = self.tree.append(self.node_a, "Z")
+        self.node_h = self.tree.append(self.root, "H")
+        self.node_k = self.tree.append(self.node_h, "K")
+
+    def _get_child_values(self, node):
+        return [child_node.value for child_node in node.children]
+
+    def test_promote_siblings(self):
+        """Test promoting nodes X,Y,Z.
+
+        Act:
+            Promote nodes X,Y,Z.
+        Assert:
+            G's children are A,Z,Y,X.
+        """
+        ### Act ###
+        self.tree.promote(self.node_x, self.node_y, self.node_z)
+
+        ### Assert ###
+        self.assertEqual(["A", "Z", "Y", "X"],
+            self._get_child_values(self.node_g))
+
+    def test_promote_siblings_out_of_order(self):
+        """Test promoting nodes Z,X.
+
+        Act:
+            Promote nodes Z,X.
+        Assert:
+            G's children are A,X,Z.
+        """
+        ### Act ###
+        self.tree.promote(self.node_z, self.node_x)
+
+        ### Assert ###
+        self.assertEqual(["A", "X", "Z"], self._get_child_values(self.node_g))
+
+    def test_promote_siblings_after_shallower_node(self):
+        """Test promoting nodes K,X,Y.
+
+        Nodes X and Y are deeper than node K, which was provided before them,
+        so they keep the order in which they were provided.
+
+        Act:
+            Promote nodes K,X,Y.
+        Assert:
+            G's children are A,X,Y.
+            Root's children are G,H,K.
+        """
+        ### Act ###
+        self.tree.promote(self.node_k, self.node_x, self.node_y)
+
+        ### Assert ###
+        self.assertEqual(["A", "X", "Y"], self._get_child_values(self.node_g))
+        self.assertEqual(["G", "H", "K"], self._get_child_values(self.root))
+#------------------------------------------------------------------------------ 
+
 class TreeDemoteTest(BaseTreeReorganizationTest):
     """Test the demotion functions of the Tree class with a simple, multi-level
     tree.
@@ -1727,4 +2489,336 @@ class TreeDemoteTest(BaseTreeReorganizationTest):
         self.assertEqual(self.node_c, self.tree.get_node((0, 0, 0)))
         self.assertEqual(self.node_e, self.tree.get_node((0, 0, 1, 0)))
         self.assertEqual(self.node_g, self.tree.get_node((0, 1, 0, 0)))
+
+    def test_demote_multiple_adjacent(self):
+        """Test demoting nodes D,E.
+
+        This should cause both D and E to be demoted below C, keeping their
+        original order.
+
+        Expected result tree architecture:
+        - root
+            - A
+                - C
+                    - D
+                    - E
+            - B
+                - F
+                - G
+
+        Act:
+            Demote nodes D,E.
+        Assert:
+            Node C is the only child of A (0,0,0).
+            Node D is the first child of C (0,0,0,0).
+            Node E is the second child of C (0,0,0,1).
+        """
+        ### Act ###
+        self.tree.demote(self.node_d, self.node_e)
+
+        ### Assert ###
+        self.assertEqual([self.node_c], self.node_a.children)
+        self.assertEqual(self.node_d, self.tree.get_node((0, 0, 0, 0)))
+        self.assertEqual(self.node_e, self.tree.get_node((0, 0, 0, 1)))
+        self.assertEqual((0, 0, 0, 1), self.node_e.path)
+#------------------------------------------------------------------------------
+
+class TreeEntityIndexTest(BaseTreeReorganizationTest):
+    """Test that the entity ID index is kept up to date as the tree is
+    populated and reorganized.
+
+    Assume the following tree for this test case group:
+    - root
+        - tasklist
+            - A
+                - C
+            - B
+    """
+    def setUp(self):
+        """Create a simple tree, as outlined in the class docstring."""
+        self.tree = Tree()
+
+        self.root = self.tree.append(None, None)
+        self.tasklist_node = self.tree.append(self.root,
+            TaskList(entity_id="tl", title="tasklist"))
+
+        self.node_a = self.tree.append(self.tasklist_node,
+            Task(entity_id="a", title="A"))
+        self.node_c = self.tree.append(self.node_a,
+            Task(entity_id="c", title="C"))
+        self.node_b = self.tree.append(self.tasklist_node,
+            Task(entity_id="b", title="B"))
+
+    def test_get_node_for_entity_id(self):
+        """Look up nodes by the IDs of the entities they hold.
+
+        Assert:
+            Each entity ID resolves to the node holding that entity.
+            An unknown entity ID raises an EntityNotFoundError, or returns None
+            if must_find is False.
+        """
+        ### Assert ###
+        self.assertIs(self.tasklist_node, self.tree.get_node_for_entity_id("tl"))
+        self.assertIs(self.node_a, self.tree.get_node_for_entity_id("a"))
+        self.assertIs(self.node_b, self.tree.get_node_for_entity_id("b"))
+        self.assertIs(self.node_c, self.tree.get_node_for_entity_id("c"))
+
+        with self.assertRaises(EntityNotFoundError):
+            self.tree.get_node_for_entity_id("missing")
+        self.assertIsNone(self.tree.get_node_for_entity_id("missing",
+            must_find=False))
+
+    def test_insert_and_update(self):
+        """Insert a node with an entity value, then replace the value.
+
+        Act:
+            Insert a task D at the front of the tasklist.
+            Replace the value of D with a task E.
+        Assert:
+            Task D is no longer indexed.
+            Task E resolves to the inserted node.
+        """
+        ### Act ###
+        node_d = self.tree.insert((0, 0, 0), Task(entity_id="d", title="D"))
+        self.assertIs(node_d, self.tree.get_node_for_entity_id("d"))
+        self.tree.update(node_d.path, Task(entity_id="e", title="E"))
+
+        ### Assert ###
+        self.assertFalse(self.tree.has_entity_id("d"))
+        self.assertIs(node_d, self.tree.get_node_for_entity_id("e"))
+
+    def test_remove_node_branch(self):
+        """Remove a branch node.
+
+        Act:
+            Remove node A.
+        Assert:
+            Neither A nor its child C are indexed.
+            Node B is still indexed.
+        """
+        ### Act ###
+        self.tree.remove_node(self.node_a)
+
+        ### Assert ###
+        self.assertFalse(self.tree.has_entity_id("a"))
+        self.assertFalse(self.tree.has_entity_id("c"))
+        self.assertIs(self.node_b, self.tree.get_node_for_entity_id("b"))
+
+    def test_reorganize(self):
+        """Move, promote and demote nodes.
+
+        Act:
+            Move node C to be a child of B.
+            Promote node C.
+            Demote node B.
+        Assert:
+            All entity IDs still resolve to the same nodes, and those nodes
+            have the expected paths.
+        """
+        ### Act ###
+        self.tree.move_node(self.node_b, self.node_c)
+        self.tree.promote(self.node_c)
+        self.tree.demote(self.node_b)
+
+        ### Assert ###
+        self.assertIs(self.node_a, self.tree.get_node_for_entity_id("a"))
+        self.assertIs(self.node_b, self.tree.get_node_for_entity_id("b"))
+        self.assertIs(self.node_c, self.tree.get_node_for_entity_id("c"))
+        self.assertEqual((0, 0, 0, 0), self.tree.get_node_for_entity_id("b").path)
+        self.assertEqual((0, 0, 1), self.tree.get_node_for_entity_id("c").path)
+#------------------------------------------------------------------------------ 
+
+class TreeFromTasksTest(unittest.TestCase):
+    def test_from_tasks(self):
+        """Build a tree from a tasklist and a flat dict of tasks.
+
+        Tasks A and B are top-level tasks, with B positioned ahead of A. Task
+        C is a child of A. Task D has a parent that doesn't exist. Task E
+        belongs to an unknown tasklist.
+
+        Expected tree:
+        - root
+            - tasklist
+                - B
+                - A
+                    - C
+                - D
+
+        Arrange:
+            Create a tasklist and tasks A-E.
+        Act:
+            Build the tree from the tasklist and tasks.
+        Assert:
+            Tasklist and tasks are found at the expected paths.
+            Task E is not in the tree.
+        """
+        ### Arrange ###
+        tasklist = TaskList(entity_id="tl", title="tasklist")
+        task_a = Task(entity_id="a", title="A", tasklist_id="tl", position=2)
+        task_b = Task(entity_id="b", title="B", tasklist_id="tl", position=1)
+        task_c = Task(entity_id="c", title="C", tasklist_id="tl",
+            parent_id="a", position=1)
+        task_d = Task(entity_id="d", title="D", tasklist_id="tl",
+            parent_id="missing", position=3)
+        task_e = Task(entity_id="e", title="E", tasklist_id="other")
+
+        tasklists = {tasklist.entity_id: tasklist}
+        tasks = dict((task.entity_id, task)
+            for task in (task_a, task_b, task_c, task_d, task_e))
+
+        ### Act ###
+        tree = Tree.from_tasks(tasklists, tasks)
+
+        ### Assert ###
+        self.assertIs(tasklist, tree.get((0, 0)))
+        self.assertIs(task_b, tree.get((0, 0, 0)))
+        self.assertIs(task_a, tree.get((0, 0, 1)))
+        self.assertIs(task_c, tree.get((0, 0, 1, 0)))
+        self.assertIs(task_d, tree.get((0, 0, 2)))
+        self.assertFalse(tree.has_entity_id(task_e.entity_id))
+#------------------------------------------------------------------------------ 
+
+class TreeEntityChangesTest(unittest.TestCase):
+    """
+    Each test applies changes to a tree built from tasks, checking that the 
+    result matches the tree built from the changed tasks, and which changes
+    the listener was told about.
+    """
+    class RecordingListener(TreeChangeListener):
+        def __init__(self):
+            self.changes = list()
+
+        def node_inserted(self, node):
+            self.changes.append(("inserted", node.value.entity_id, node.path))
+
+        def node_removed(self, node, path, parent_node, is_moving):
+            self.changes.append(("removed", node.value.entity_id, path))
+
+        def node_updated(self, node):
+            self.changes.append(("updated", node.value.entity_id, node.path))
+
+    def setUp(self):
+        self.tasklists = {"tl": TaskList(entity_id="tl", title="tasklist")}
+        self.tasks = dict()
+        self.listener = TreeEntityChangesTest.RecordingListener()
+
+    def _set_task(self, entity_id, parent_id, position):
+        task = Task(entity_id=entity_id, title=entity_id, tasklist_id="tl",
+            parent_id=parent_id, position=position)
+        self.tasks[entity_id] = task
+
+        return task
+
+    def _build_tree(self, *task_specs):
+        """Build a tree from (entity ID, parent ID, position) tuples."""
+        for task_spec in task_specs:
+            self._set_task(*task_spec)
+
+        return Tree.from_tasks(self.tasklists, self.tasks)
+
+    def _assert_applied(self, tree, changes):
+        tree.apply_entity_changes(changes, self.listener)
+
+        expected_tree = Tree.from_tasks(self.tasklists, self.tasks)
+        self.assertEqual(self._get_structure(expected_tree),
+            self._get_structure(tree))
+
+    @staticmethod
+    def _get_structure(tree):
+        structure = list()
+        pending_nodes = list(reversed(tree.get_node(Tree.ROOT_PATH).children))
+        while pending_nodes:
+            node = pending_nodes.pop()
+            structure.append((node.path, node.value))
+            pending_nodes.extend(reversed(node.children))
+
+        for entity_path, entity in structure:
+            assert tree.get_node_for_entity_id(entity.entity_id).path == entity_path
+
+        return structure
+
+    def test_update(self):
+        tree = self._build_tree(("a", None, 1), ("b", None, 2))
+
+        self._assert_applied(tree, EntityChanges([self._set_task("b", None, 2)]))
+
+        self.assertEqual([("updated", "b", (0, 0, 1))], self.listener.changes)
+
+    def test_insert(self):
+        tree = self._build_tree(("a", None, 1), ("b", None, 3))
+
+        self._assert_applied(tree, EntityChanges([self._set_task("c", None, 2),
+            self._set_task("d", "c", 1)]))
+
+        self.assertEqual([("inserted", "c", (0, 0, 1)), 
+            ("inserted", "d", (0, 0, 1, 0))], self.listener.changes)
+
+    def test_insert_child_before_parent(self):
+        tree = self._build_tree(("a", None, 1))
+
+        self._assert_applied(tree, EntityChanges([self._set_task("c", "b", 1),
+            self._set_task("b", "a", 1)]))
+
+    def test_reorder(self):
+        tree = self._build_tree(("a", None, 1), ("b", None, 2), ("c", None, 3))
+
+        self._assert_applied(tree, EntityChanges([self._set_task("c", None, 0)]))
+
+        self.assertEqual([("removed", "c", (0, 0, 2)), 
+            ("inserted", "c", (0, 0, 0))], self.listener.changes)
+
+    def test_move_to_new_parent(self):
+        tree = self._build_tree(("a", None, 1), ("b", None, 2), ("c", "a", 1),
+            ("d", "c", 1))
+
+        self._assert_applied(tree, EntityChanges([self._set_task("c", "b", 1)]))
+
+    def test_remove(self):
+        tree = self._build_tree(("a", None, 1), ("b", None, 2), ("c", "b", 1))
+        del self.tasks["b"]
+        del self.tasks["c"]
+
+        self._assert_applied(tree, EntityChanges(removed_entity_ids=["b", "c"]))
+
+        self.assertEqual([("removed", "b", (0, 0, 1))], self.listener.changes)
+
+    def test_remove_parent_keep_child(self):
+        # The surviving child becomes a top-level task.
+        tree = self._build_tree(("a", None, 2), ("b", "a", 1), ("c", "a", 3))
+        del self.tasks["a"]
+
+        self._assert_applied(tree, EntityChanges(removed_entity_ids=["a"]))
+
+    def test_remove_tasklist(self):
+        tree = self._build_tree(("a", None, 1), ("b", "a", 1))
+        self.tasklists.clear()
+
+        self._assert_applied(tree, EntityChanges(removed_entity_ids=["tl"]))
+
+        self.assertFalse(tree.has_entity_id("b"))
+
+    def test_replace_entity_id(self):
+        tree = self._build_tree(("local-1", None, 1), ("b", "local-1", 1))
+        del self.tasks["local-1"]
+        node = tree.get_node_for_entity_id("local-1")
+
+        self._assert_applied(tree, EntityChanges(
+            [self._set_task("t-1", None, 1), self._set_task("b", "t-1", 1)],
+            replaced_entity_ids={"local-1": "t-1"}))
+
+        self.assertIs(node, tree.get_node_for_entity_id("t-1"))
+        self.assertFalse(tree.has_entity_id("local-1"))
+
+    def test_replace_entity_id_already_added(self):
+        tree = self._build_tree(("local-1", None, 1), ("b", "local-1", 1),
+            ("t-1", None, 2))
+        del self.tasks["local-1"]
+        node = tree.get_node_for_entity_id("t-1")
+
+        self._assert_applied(tree, EntityChanges(
+            [self._set_task("t-1", None, 1), self._set_task("b", "t-1", 1)],
+            replaced_entity_ids={"local-1": "t-1"}))
+
+        self.assertIs(node, tree.get_node_for_entity_id("t-1"))
+        self.assertFalse(tree.has_entity_id("local-1"))
 #------------------------------------------------------------------------------ 
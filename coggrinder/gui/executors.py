@@ -0,0 +1,212 @@
+"""
+Created on May 11, 2012
+
+@author: Clay Carpenter
+"""
+
+import multiprocessing.pool
+import Queue
+import threading
+import unittest
+from coggrinder.gui.events import Event
+
+class BackgroundCall(object):
+    """
+    A call submitted to a BackgroundExecutor. Cancelling the call prevents it
+    from being run if it hasn't started yet, and prevents its callbacks from
+    being run in any case.
+    """
+    def __init__(self, executor, function, args, on_success, on_error):
+        self.executor = executor
+        self.function = function
+        self.args = args
+        self.on_success = on_success
+        self.on_error = on_error
+        self.is_cancelled = False
+
+    def cancel(self):
+        """Cancel the call. Must be called from the main loop."""
+        if not self.is_cancelled:
+            self.is_cancelled = True
+            self.executor._finish_call(self)
+#------------------------------------------------------------------------------
+
+class BackgroundExecutor(object):
+    """
+    Runs blocking calls (e.g., service requests) on a pool of worker threads,
+    so that they don't hold up the Gtk main loop, and hands each result (or
+    error) to a callback run from the main loop.
+
+    Calls must be submitted and cancelled from the main loop.
+
+    Events:
+        busy_changed: Fired (from the main loop) with True when the first
+            call is submitted, and with False when the last outstanding call
+            has finished or been cancelled.
+    """
+    DEFAULT_MAX_WORKERS = 4
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, idle_add=None):
+        """
+        Args:
+            max_workers: Number of worker threads.
+            idle_add: Function that schedules a callback to be run from the
+                main loop. Defaults to GLib.idle_add.
+        """
+        if idle_add is None:
+            # Only import Gtk when it's actually needed, so that the executor
+            # can be used without a display.
+            from gi.repository import GLib
+            idle_add = GLib.idle_add
+        self._idle_add = idle_add
+
+        self.max_workers = max_workers
+        self.busy_changed = Event()
+
+        self._worker_pool = None
+        self._outstanding_calls = set()
+
+    @property
+    def is_busy(self):
+        return len(self._outstanding_calls) > 0
+
+    def submit(self, function, args=(), on_success=None, on_error=None):
+        """
+        Run the function with the arguments on a worker thread. Once the
+        function has returned, on_success is called with its result from the
+        main loop; if the function raised an exception, on_error is called
+        with the exception instead (or the exception is re-raised from the
+        main loop, if there is no on_error callback).
+
+        Returns:
+            The BackgroundCall, which can be used to cancel the call.
+        """
+        if self._worker_pool is None:
+            self._worker_pool = multiprocessing.pool.ThreadPool(self.max_workers)
+
+        call = BackgroundCall(self, function, args, on_success, on_error)
+        self._outstanding_calls.add(call)
+        if len(self._outstanding_calls) == 1:
+            self.busy_changed.fire(True)
+
+        self._worker_pool.apply_async(self._run_call, (call,))
+
+        return call
+
+    def cancel_all(self):
+        """Cancel all of the outstanding calls."""
+        for call in list(self._outstanding_calls):
+            call.cancel()
+
+    def shutdown(self):
+        """Cancel all of the outstanding calls, and stop the worker threads."""
+        self.cancel_all()
+
+        if self._worker_pool is not None:
+            self._worker_pool.terminate()
+            self._worker_pool = None
+
+    def _run_call(self, call):
+        # Run from a worker thread.
+        if call.is_cancelled:
+            return
+
+        try:
+            result = call.function(*call.args)
+        except Exception as error:
+            self._idle_add(self._complete_call, call, None, error)
+        else:
+            self._idle_add(self._complete_call, call, result, None)
+
+    def _complete_call(self, call, result, error):
+        # Run from the main loop.
+        if not call.is_cancelled:
+            self._finish_call(call)
+
+            if error is None:
+                if call.on_success is not None:
+                    call.on_success(result)
+            elif call.on_error is not None:
+                call.on_error(error)
+            else:
+                raise error
+
+        # Run only once when used as an idle callback.
+        return False
+
+    def _finish_call(self, call):
+        if call in self._outstanding_calls:
+            self._outstanding_calls.remove(call)
+            if not self._outstanding_calls:
+                self.busy_changed.fire(False)
+#------------------------------------------------------------------------------
+
+class BackgroundExecutorTest(unittest.TestCase):
+    def setUp(self):
+        # Stand in for the main loop with a queue of idle callbacks.
+        self.idle_callbacks = Queue.Queue()
+        self.executor = BackgroundExecutor(max_workers=2,
+            idle_add=lambda callback, *args: self.idle_callbacks.put(
+                (callback, args)))
+
+        self.busy_states = list()
+        self.executor.busy_changed.register(
+            lambda is_busy: self.busy_states.append(is_busy))
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def _run_main_loop_iteration(self):
+        callback, args = self.idle_callbacks.get(timeout=5)
+        callback(*args)
+
+    def test_submit(self):
+        results = list()
+        self.executor.submit(lambda x, y: x + y, (1, 2),
+            on_success=results.append)
+        self.assertTrue(self.executor.is_busy)
+
+        self._run_main_loop_iteration()
+
+        self.assertEqual([3], results)
+        self.assertEqual([True, False], self.busy_states)
+
+    def test_submit_error(self):
+        def fail():
+            raise ValueError("Failed")
+        errors = list()
+        self.executor.submit(fail, on_error=errors.append)
+
+        self._run_main_loop_iteration()
+
+        self.assertIsInstance(errors[0], ValueError)
+        self.assertFalse(self.executor.is_busy)
+
+    def test_cancel(self):
+        started = threading.Event()
+        release = threading.Event()
+        def wait():
+            started.set()
+            release.wait(5)
+        results = list()
+        call = self.executor.submit(wait, on_success=results.append)
+
+        started.wait(5)
+        call.cancel()
+        self.assertEqual([True, False], self.busy_states)
+
+        # The call's result should be ignored once it arrives.
+        release.set()
+        self._run_main_loop_iteration()
+        self.assertEqual([], results)
+
+    def test_busy_until_all_calls_finish(self):
+        self.executor.submit(lambda: 1)
+        self.executor.submit(lambda: 2)
+
+        self._run_main_loop_iteration()
+        self.assertTrue(self.executor.is_busy)
+        self._run_main_loop_iteration()
+
+        self.assertEqual([True, False], self.busy_states)
+#------------------------------------------------------------------------------
@@ -0,0 +1,155 @@
+"""
+Created on May 14, 2012
+
+@author: Clay Carpenter
+"""
+
+import os
+import threading
+import unittest
+
+class PixbufCache(object):
+    """
+    Loads icon images into pixbufs on first use, and then hands out the same
+    pixbuf for every later request. Pixbufs are cached by icon name, size,
+    theme and scale.
+
+    Icons are looked up by file name in a resources dict (such as
+    coggrinder.resources.icons.task_tree.FILES). A themed variant of an icon
+    is found at [icon name]_[theme][icon extension] (e.g., "folder_dark.png"
+    for the "dark" theme), falling back to the plain icon if the theme
+    doesn't provide one.
+    """
+    def __init__(self, files, loader=None):
+        """
+        Args:
+            files: A dict of icon file paths, keyed by file name.
+            loader: Function that loads the file into a pixbuf, called with
+                the file path, the size in pixels (None for the image's own
+                size) and the scale. Defaults to loading through GdkPixbuf.
+        """
+        if loader is None:
+            loader = _load_pixbuf
+
+        self.files = files
+        self._loader = loader
+
+        self._pixbufs = dict()
+        self._lock = threading.Lock()
+
+    def get(self, name, size=None, theme=None, scale=1):
+        """
+        Retrieve the pixbuf for the icon, loading it if it hasn't been
+        requested before.
+
+        Args:
+            name: The icon file name, such as "folder.png".
+            size: The width and height of the icon in pixels, or None to use
+                the size of the image itself.
+            theme: Name of the theme variant to use, or None for the plain
+                icon.
+            scale: Factor the icon size is multiplied by, for high resolution
+                displays.
+        Returns:
+            The (shared) pixbuf. Callers should not modify it.
+        """
+        key = (name, size, theme, scale)
+
+        with self._lock:
+            pixbuf = self._pixbufs.get(key)
+            if pixbuf is None:
+                pixbuf = self._loader(self._get_file_path(name, theme), size,
+                    scale)
+                self._pixbufs[key] = pixbuf
+
+        return pixbuf
+
+    def clear(self):
+        """Discard all of the loaded pixbufs (e.g., after a theme change)."""
+        with self._lock:
+            self._pixbufs.clear()
+
+    def _get_file_path(self, name, theme):
+        if theme is not None:
+            name_root, name_ext = os.path.splitext(name)
+            themed_name = "{0}_{1}{2}".format(name_root, theme, name_ext)
+            if themed_name in self.files:
+                return self.files[themed_name]
+
+        if name not in self.files:
+            raise KeyError("Could not find an icon named {0}.".format(name))
+
+        return self.files[name]
+#------------------------------------------------------------------------------
+
+def _load_pixbuf(file_path, size, scale):
+    # Only import Gtk when an icon is actually loaded, so that the cache can
+    # be created without a display.
+    from gi.repository import GdkPixbuf
+
+    if size is not None:
+        pixel_size = int(size * scale)
+        return GdkPixbuf.Pixbuf.new_from_file_at_scale(file_path, pixel_size,
+            pixel_size, True)
+
+    pixbuf = GdkPixbuf.Pixbuf.new_from_file(file_path)
+    if scale != 1:
+        pixbuf = pixbuf.scale_simple(int(pixbuf.get_width() * scale),
+            int(pixbuf.get_height() * scale), GdkPixbuf.InterpType.BILINEAR)
+
+    return pixbuf
+#------------------------------------------------------------------------------
+
+class PixbufCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.loaded_files = list()
+        def load(file_path, size, scale):
+            self.loaded_files.append((file_path, size, scale))
+            return object()
+
+        self.icon_cache = PixbufCache({"folder.png": "/icons/folder.png",
+            "folder_dark.png": "/icons/folder_dark.png",
+            "checkmark.png": "/icons/checkmark.png"}, loader=load)
+
+    def test_get_loads_once(self):
+        """Test that repeated requests for an icon share a single load.
+
+        Act:
+            Request the folder icon three times.
+
+        Assert:
+            The same pixbuf is returned each time, and the file was only
+            loaded once.
+        """
+        pixbufs = [self.icon_cache.get("folder.png") for i in range(3)]
+
+        self.assertTrue(pixbufs[0] is pixbufs[1] is pixbufs[2])
+        self.assertEqual([("/icons/folder.png", None, 1)], self.loaded_files)
+
+    def test_get_variants(self):
+        """Test that each size, theme and scale is loaded separately.
+
+        Act:
+            Request the folder icon at its own size, at 16 pixels, at 16
+            pixels and double scale, and with the dark theme.
+            Request the checkmark icon with the dark theme (which it lacks).
+
+        Assert:
+            Each request loaded its own variant, with the themed checkmark
+            falling back to the plain checkmark file.
+        """
+        self.icon_cache.get("folder.png")
+        self.icon_cache.get("folder.png", size=16)
+        self.icon_cache.get("folder.png", size=16, scale=2)
+        self.icon_cache.get("folder.png", theme="dark")
+        self.icon_cache.get("checkmark.png", theme="dark")
+
+        self.assertEqual([("/icons/folder.png", None, 1),
+            ("/icons/folder.png", 16, 1), ("/icons/folder.png", 16, 2),
+            ("/icons/folder_dark.png", None, 1),
+            ("/icons/checkmark.png", None, 1)], self.loaded_files)
+
+    def test_get_unknown_icon(self):
+        with self.assertRaises(KeyError):
+            self.icon_cache.get("missing.png")
+#------------------------------------------------------------------------------
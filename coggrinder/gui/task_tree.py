@@ -3,70 +3,204 @@ Created on Apr 9, 2012
 
 @author: Clay Carpenter
 """
-from gi.repository import Gtk, GdkPixbuf
+from gi.repository import Gtk, GdkPixbuf, GObject
 import unittest
 from coggrinder.entities.tasks import TaskList, Task, TaskStatus
+from coggrinder.entities.tree import Tree, EntityChanges
 from coggrinder.resources.icons import task_tree
+from coggrinder.gui.icons import PixbufCache
+
+class TaskTreeModel(GObject.GObject, Gtk.TreeModel):
+    """
+    Tree model presenting the tasklists and tasks of a task tree, reading the
+    row values directly from the entities in the tree. 
+
+    Nothing is copied per row: a row only takes up memory (an iter handle) 
+    once the view has asked for it, and the view only asks for the rows it 
+    shows, so the cost of a huge task tree depends on the rows that are 
+    visible rather than on the total number of tasks.
+
+    Updates are applied to the tree in place, as changes to the individual
+    entities, so the rows of unchanged entities are left alone (along with 
+    their expansion and selection states). The model receives each change to
+    the tree (as its TreeChangeListener) and signals it straight away.
+    """
+    COLUMN_TYPES = (GObject.TYPE_STRING, GObject.TYPE_STRING, 
+        GdkPixbuf.Pixbuf.__gtype__)
 
-class TaskTreeStore(Gtk.TreeStore):            
     def __init__(self):
-        self.store = Gtk.TreeStore(str, str, GdkPixbuf.Pixbuf)
+        GObject.GObject.__init__(self)
+
+        self.tasktree = Tree()
+        self.tasktree.append(None, None)
+
+        # Iters refer to rows by a handle standing in for the row's entity 
+        # ID, so iters stay valid for as long as their row exists, however
+        # the tree is reorganized. Handles are only created for the rows 
+        # that the view asks for.
+        self._handle_entity_ids = dict()
+        self._entity_handles = dict()
+        self._next_handle = 1
+
+        # What each row the view has asked for was last shown with (title 
+        # and icon), keyed by entity ID. Entities can be updated in place, 
+        # so this is the only way to tell that their rows need redrawing.
+        self._row_states = dict()
 
-        self.entity_path_index = dict()
-        
     def build_tree(self, tasklists, tasks):
         """ 
         Build a tree representing all of the user's tasklists and tasks.
         Tasklists will always be first-level nodes, while tasks will always be
         at least second-level nodes or deeper.
         
+        Entities already in the tree are updated (or moved), and kept if 
+        they're not among the tasklists and tasks.
+        
         Args:
-            tasklists:
-            tasks:
+            tasklists: A dict of all TaskLists, keyed by entity ID.
+            tasks: A dict of all Tasks, keyed by entity ID.
         """
-#        self._root
-#        self.entity_path_index = dict()
-#        
-#        # Iterate over the tasklists dict, adding each tasklist to the root. 
-#        for tasklist_id in tasklists:
-#            tasklist = tasklists[tasklist_id]
-#            tasklist_iter = self.append(self._root, TreeNode(tasklist).row_data)
-#            
-#            # Add tasklist to the path index.
-#            self.entity_path_index[tasklist.entity_id] = self.get_path(tasklist_iter).to_string()
-#
-#            # Find all tasks with this tasklist id and FOO parent id.
-#            self._build_tasklist_task_tree(tasks, entity_path_index, tasklist_iter, tasklist_id, None)
-#            
-#        return entity_path_index
-    
-    def _build_tree_from_tasks(self, tasks, parent_iter):
+        self.apply_entity_changes(EntityChanges(
+            tasklists.values() + tasks.values()))
+
+    def apply_entity_changes(self, changes):
         """
-        Build a tree for a particular tasklist.
+        Apply the changes to the tasklists and tasks to the task tree in 
+        place, signalling only the rows of the changed entities.
+
+        Args:
+            changes: The EntityChanges to apply.
         """
-        # Determine which entities remaining in the tasks dict have yet to be 
-        # added to the tree by comparing sets of keys in the tasks dict vs
-        # those in the entity path index.
-        keys_in_tasklist = set(tasks.keys())
-        keys_in_tree = set(self.entity_path_index.keys())
-        remaining_keys = keys_in_tasklist - keys_in_tree
-        
-        # Check to see if the parent is a tasklist or task.
-        parent_id = self[parent_iter][TreeNode.ENTITY_ID]
-        parent = self.entity_path_index[parent_id]
-        if isinstance(parent, TaskList):
-            parent_id = None
-        
-        for entity_id in remaining_keys:
-            task = tasks[entity_id]
-            
-            if task.parent_id == parent_id:
-                task_iter = self.append(parent_iter, TreeNode(task).row_data)
-            
-                # Add task to the path index.
-                self.entity_path_index[task.entity_id] = self.get_string_from_iter(task_iter)
-                
-                self._build_tree_from_tasks(tasks, task_iter)  
+        root_node = self.tasktree.get_node(Tree.ROOT_PATH)
+        if not root_node.children:
+            # Nothing has been shown yet, so the tree is built in one go. Only
+            # the first-level rows are visible, and the view asks for their 
+            # children as it needs them.
+            tasklists = dict()
+            tasks = dict()
+            for entity in changes.updated_entities:
+                if isinstance(entity, TaskList):
+                    tasklists[entity.entity_id] = entity
+                else:
+                    tasks[entity.entity_id] = entity
+
+            self.tasktree = Tree.from_tasks(tasklists, tasks)
+            for node in self.tasktree.get_node(Tree.ROOT_PATH).children:
+                self._emit_row_inserted(node)
+        else:
+            self.tasktree.apply_entity_changes(changes, self)
+
+    def node_inserted(self, node):
+        entity_id = node.value.entity_id
+        if entity_id in self._row_states:
+            self._row_states[entity_id] = self._get_row_state(node.value)
+
+        self._emit_row_inserted(node)
+
+    def node_removed(self, node, path, parent_node, is_moving):
+        self._emit_row_deleted(path, parent_node)
+
+        if not is_moving:
+            # Forget the rows of the removed entities.
+            pending_nodes = [node]
+            while pending_nodes:
+                current_node = pending_nodes.pop()
+                if current_node.value.entity_id in self._entity_handles:
+                    self._forget_row(current_node.value.entity_id)
+                pending_nodes.extend(current_node.children)
+
+    def node_updated(self, node):
+        entity_id = node.value.entity_id
+        row_state = self._row_states.get(entity_id)
+        if row_state is not None:
+            updated_row_state = self._get_row_state(node.value)
+            if updated_row_state != row_state:
+                self._row_states[entity_id] = updated_row_state
+
+                tree_iter = self._create_iter(node)
+                self.row_changed(self.do_get_path(tree_iter), tree_iter)
+
+    def entity_id_replaced(self, old_entity_id, new_entity_id):
+        # Keep the row's handle, so that existing iters remain valid.
+        handle = self._entity_handles.pop(old_entity_id, None)
+        if handle is not None:
+            self._entity_handles[new_entity_id] = handle
+            self._handle_entity_ids[handle] = new_entity_id
+            self._row_states[new_entity_id] = self._row_states.pop(
+                old_entity_id)
+
+    def _emit_row_deleted(self, path, parent_node):
+        """Signal the removal of the row at the (node) path, once it has been
+        taken out from beneath the parent node.
+        """
+        self.row_deleted(self._build_treepath(path))
+
+        # Let the view know when the parent row loses its last child. The 
+        # parent may have been moved since, so its path is taken from the 
+        # removed row's.
+        if not parent_node.children and parent_node.value is not None:
+            self.row_has_child_toggled(self._build_treepath(path[:-1]),
+                self._create_iter(parent_node))
+
+    def _emit_row_inserted(self, node):
+        tree_iter = self._create_iter(node)
+        treepath = self.do_get_path(tree_iter)
+        self.row_inserted(treepath, tree_iter)
+
+        # Let the view know about any rows beneath the inserted one (e.g., 
+        # when a row is moved along with its descendants).
+        if node.children:
+            self.row_has_child_toggled(treepath, tree_iter)
+
+        # Let the view know when the parent row gains its first child.
+        parent_node = node.parent
+        if len(parent_node.children) == 1 and parent_node.value is not None:
+            parent_iter = self._create_iter(parent_node)
+            self.row_has_child_toggled(self.do_get_path(parent_iter),
+                parent_iter)
+
+    def _create_iter(self, node):
+        entity_id = node.value.entity_id
+
+        handle = self._entity_handles.get(entity_id)
+        if handle is None:
+            handle = self._next_handle
+            self._next_handle += 1
+
+            self._entity_handles[entity_id] = handle
+            self._handle_entity_ids[handle] = entity_id
+            self._row_states[entity_id] = self._get_row_state(node.value)
+
+        tree_iter = Gtk.TreeIter()
+        tree_iter.user_data = handle
+
+        return tree_iter
+
+    def _forget_row(self, entity_id):
+        del self._handle_entity_ids[self._entity_handles.pop(entity_id)]
+        del self._row_states[entity_id]
+
+    def _get_node(self, tree_iter):
+        return self.tasktree.get_node_for_entity_id(
+            self._handle_entity_ids[tree_iter.user_data])
+
+    @staticmethod
+    def _get_row_state(entity):
+        return (entity.title, TreeNode.get_icon_name(entity))
+
+    @staticmethod
+    def _get_path_string(node):
+        # Node paths begin with the root node, which has no row.
+        return Tree.PATH_SEPARATOR.join(str(index) for index in node.path[1:])
+
+    @staticmethod
+    def _build_treepath(path):
+        return Gtk.TreePath.new_from_string(Tree.PATH_SEPARATOR.join(
+            str(index) for index in path[1:]))
+
+    @classmethod
+    def _get_treepath(cls, node):
+        return cls._build_treepath(node.path)
 
     def get_entity(self, tree_path):
         """Retrieves the entity targeted by the specified tree path.
@@ -78,11 +212,30 @@ class TaskTreeStore(Gtk.TreeStore):
             The entity (Task or TaskList) at the provided path, or None if the
             path does not point to a valid tree node.
         """
-        assert(isinstance(tree_path, str), 
-            "Tree path provided must be a string in the form of '0:0:0'")
-        
-        return None
-    
+        assert isinstance(tree_path, str), \
+            "Tree path provided must be a string in the form of '0:0:0'"
+
+        node = self.tasktree.get_node(Tree.build_path_from_str(tree_path),
+            must_find=False)
+        if node is None:
+            return None
+
+        return node.value
+
+    def get_entity_path(self, entity_id):
+        """Find the tree path of the entity's row.
+
+        Returns:
+            The tree path string (in the form of "0:0:0") of the row, or None
+            if the entity isn't in the tree.
+        """
+        node = self.tasktree.get_node_for_entity_id(entity_id, 
+            must_find=False)
+        if node is None:
+            return None
+
+        return self._get_path_string(node)
+
     def add_tasklist(self, tasklist, tasks=None):
         """Creates a new task tree branch for the TaskList and its associated 
         Tasks.
@@ -97,36 +250,121 @@ class TaskTreeStore(Gtk.TreeStore):
             should be the entity id, and values should be the associated 
             entity. Defaults to None.
         """
-        # Add the tasklist as a direct descendant of the root of the task tree.
-        tasklist_iter = self.append(self._root, TreeNode(tasklist).row_data)
-        
-        # Recursively build the task tree with the given tasks.
-        if tasks is not None:
-            self._build_tree_from_tasks(tasks, tasklist_iter)
+        if tasks is None:
+            tasks = dict()
+            
+        # Build the tasklist branch, and then add it as a direct descendant of
+        # the root of the task tree.
+        branch_tree = Tree.from_tasks({tasklist.entity_id: tasklist}, tasks)
+        pending_nodes = [(None, branch_tree.get_node(Tree.ROOT_PATH).children[0])]
+        while pending_nodes:
+            parent_iter, node = pending_nodes.pop()
+            node_iter = self.add_entity(node.value, parent_iter)
+
+            pending_nodes.extend((node_iter, child_node)
+                for child_node in reversed(node.children))
             
     def add_entity(self, entity, parent_iter=None):
-        new_node_iter = self.store.append(parent_iter, TreeNode(entity).row_data)
-        self.entity_path_index[entity.entity_id] = self.store.get_string_from_iter(new_node_iter)
-        
+        if parent_iter is None:
+            parent_node = self.tasktree.get_node(Tree.ROOT_PATH)
+        else:
+            parent_node = self._get_node(parent_iter)
+
+        node = self.tasktree.append(parent_node, entity)
+        self._emit_row_inserted(node)
+
+        return self._create_iter(node)
+
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.ITERS_PERSIST
+
+    def do_get_n_columns(self):
+        return len(self.COLUMN_TYPES)
+
+    def do_get_column_type(self, column):
+        return self.COLUMN_TYPES[column]
+
+    def do_get_iter(self, treepath):
+        node = self.tasktree.get_node(Tree.ROOT_PATH 
+            + tuple(treepath.get_indices()), must_find=False)
+        if node is None:
+            return (False, None)
+
+        return (True, self._create_iter(node))
+
+    def do_get_path(self, tree_iter):
+        return self._get_treepath(self._get_node(tree_iter))
+
+    def do_get_value(self, tree_iter, column):
+        entity = self._get_node(tree_iter).value
+        
+        if column == TreeNode.ENTITY_ID:
+            return entity.entity_id
+        elif column == TreeNode.LABEL:
+            return entity.title
+        elif column == TreeNode.ICON:
+            return TreeNode.icon_cache.get(TreeNode.get_icon_name(entity))
+
+    def do_iter_next(self, tree_iter):
+        node = self._get_node(tree_iter)
+        sibling_nodes = node.parent.children
+        
+        next_position = node.path[-1] + 1
+        if next_position < len(sibling_nodes):
+            tree_iter.user_data = self._create_iter(
+                sibling_nodes[next_position]).user_data
+            return True
+
+        return False
+
+    def do_iter_children(self, parent_iter):
+        return self.do_iter_nth_child(parent_iter, 0)
+
+    def do_iter_has_child(self, tree_iter):
+        return self._get_node(tree_iter).has_children()
+
+    def do_iter_n_children(self, tree_iter):
+        if tree_iter is None:
+            return len(self.tasktree.get_node(Tree.ROOT_PATH).children)
+
+        return len(self._get_node(tree_iter).children)
+
+    def do_iter_nth_child(self, parent_iter, position):
+        if parent_iter is None:
+            parent_node = self.tasktree.get_node(Tree.ROOT_PATH)
+        else:
+            parent_node = self._get_node(parent_iter)
+
+        if 0 <= position < len(parent_node.children):
+            return (True, self._create_iter(parent_node.children[position]))
+
+        return (False, None)
+
+    def do_iter_parent(self, child_iter):
+        parent_node = self._get_node(child_iter).parent
+        if parent_node.value is None:
+            # First-level rows (tasklists) have no parent row.
+            return (False, None)
+
+        return (True, self._create_iter(parent_node))
 #------------------------------------------------------------------------------ 
 
-class TaskTreeStoreTest(unittest.TestCase):
-    @unittest.expectedFailure
+class TaskTreeModelTest(unittest.TestCase):
     def test_add_entity(self):
-        """Test adding a single TaskList to a blank TaskTreeStore.
+        """Test adding a single TaskList to a blank TaskTreeModel.
         
         Arrange:
-            Create blank/empty TaskTreeStore.
+            Create blank/empty TaskTreeModel.
             Create a TaskList.
             
         Act:
-            Add the TaskList to the TaskTreeStore.
+            Add the TaskList to the TaskTreeModel.
         
         Assert:
             Tree path "0" should return the TaskList.        
         """
         ### Arrange ###########################################################
-        tasktree = TaskTreeStore()
+        tasktree = TaskTreeModel()
         tasklist = TaskList(entity_id="tl-1")
         
         ### Act ###############################################################   
@@ -135,7 +373,6 @@ class TaskTreeStoreTest(unittest.TestCase):
         ### Assert ############################################################
         self.assertIsNotNone(tasktree.get_entity("0"))
         
-    @unittest.expectedFailure
     def test_create_blank_tree(self):
         """Test creation of an empty tree.
         
@@ -146,12 +383,11 @@ class TaskTreeStoreTest(unittest.TestCase):
             Tree path "0" should return None.        
         """
         ### Act ###############################################################
-        tasktree = TaskTreeStore()        
+        tasktree = TaskTreeModel()        
         
         ### Assert ############################################################
         self.assertIsNone(tasktree.get_entity("0"))
 
-    @unittest.expectedFailure
     def test_create_new_tree_from_tasklist(self):
         """Test creation of a tree populated with child tasks, ensuring those
         children are accessible via (Gtk-style) tree path strings.
@@ -185,8 +421,8 @@ class TaskTreeStoreTest(unittest.TestCase):
         """        
         ### Arrange ###########################################################
         
-        # Create an empty TaskTreeStore.
-        tasktree = TaskTreeStore()
+        # Create an empty TaskTreeModel.
+        tasktree = TaskTreeModel()
         
         tasklist = TaskList(entity_id="tl-1")
 
@@ -221,6 +457,57 @@ class TaskTreeStoreTest(unittest.TestCase):
             (tasklist, task_a, task_b, task_c),
             (actual_tasklist, actual_task_a, actual_task_b, actual_task_c))
         
+    def test_apply_entity_changes(self):
+        """Test applying moved, removed and inserted tasks to the tree in
+        place.
+
+        Arrange:
+            Create a tree of a tasklist with tasks A, B (child of A), and C.
+
+        Act:
+            Apply B moved to the top level (ahead of A), C removed and a new
+            task D added beneath A.
+
+        Assert:
+            The rows are B, A, D (beneath A). Only C and B were signalled as
+            deleted, and only B and D as inserted.
+        """
+        ### Arrange ###########################################################
+        tasklists = {"tl-1": TaskList(entity_id="tl-1")}
+        tasks = {"t-a": Task(entity_id="t-a", tasklist_id="tl-1", 
+                title="task a", position=2),
+            "t-b": Task(entity_id="t-b", tasklist_id="tl-1", title="task b",
+                parent_id="t-a", position=1),
+            "t-c": Task(entity_id="t-c", tasklist_id="tl-1", title="task c", 
+                position=3)}
+
+        tasktree = TaskTreeModel()
+        tasktree.build_tree(tasklists, tasks)
+
+        deleted_paths = list()
+        tasktree.connect("row-deleted", 
+            lambda model, treepath: deleted_paths.append(treepath.to_string()))
+        inserted_paths = list()
+        tasktree.connect("row-inserted", 
+            lambda model, treepath, tree_iter: inserted_paths.append(
+                treepath.to_string()))
+
+        tasks["t-b"].parent_id = None
+        tasks["t-b"].position = 1
+        task_d = Task(entity_id="t-d", tasklist_id="tl-1", title="task d", 
+            parent_id="t-a", position=1)
+
+        ### Act ###############################################################
+        tasktree.apply_entity_changes(EntityChanges([tasks["t-b"], task_d],
+            ["t-c"]))
+
+        ### Assert ############################################################
+        self.assertEqual(["t-b", "t-a", "t-d"], [tasktree.get_entity(path).entity_id
+            for path in ("0:0", "0:1", "0:1:0")])
+        self.assertIsNone(tasktree.get_entity("0:2"))
+        self.assertEqual(["0:1", "0:0:0"], deleted_paths)
+        self.assertEqual(["0:0", "0:1:0"], inserted_paths)
+
     @unittest.skip("Disabled due to refactoring.")
     def test_get_entity_tasklist_only(self):
         expected_tasklists = dict()
@@ -232,7 +519,7 @@ class TaskTreeStoreTest(unittest.TestCase):
             
             expected_tasklists[tasklist.entity_id] = tasklist
             
-        task_treestore = TaskTreeStore(expected_tasklists, {})
+        task_treestore = TaskTreeModel(expected_tasklists, {})
         
         actual_tasklists = dict()
         for i in range(tasklist_count):
@@ -257,7 +544,7 @@ class TaskTreeStoreTest(unittest.TestCase):
         expected_tasks = {expected_task_l1.entity_id: expected_task_l1, 
             expected_task_l2.entity_id:expected_task_l2}
         
-        task_treestore = TaskTreeStore(expected_tasklists, expected_tasks)
+        task_treestore = TaskTreeModel(expected_tasklists, expected_tasks)
         
         actual_task_l1 = task_treestore.get_entity("0:0")
         self.assertEqual(expected_task_l1, actual_task_l1)
@@ -271,31 +558,30 @@ class TreeNode(object):
     LABEL = 1
     ICON = 2
 
+    # Icons are shared by all of the rows, so each icon file is only loaded
+    # once.
+    icon_cache = PixbufCache(task_tree.FILES)
+
     def __init__(self, entity):
         self.row_data = list()
         self.row_data.insert(TreeNode.ENTITY_ID, entity.entity_id)
         self.row_data.insert(TreeNode.LABEL, entity.title)
-    
-        # Create icons needed to present the task tree.
-        self.list_image = Gtk.Image.new_from_file(task_tree.FILES["folder.png"])
-        self.task_complete_image = Gtk.Image.new_from_file(task_tree.FILES["checkmark.png"])
-        self.task_incomplete_image = Gtk.Image.new_from_file(task_tree.FILES["checkbox_unchecked.png"])                        
-        
-        list_icon = self.list_image.get_pixbuf()
-        checked_icon = self.task_complete_image.get_pixbuf()
-        unchecked_icon = self.task_incomplete_image.get_pixbuf()
-        
+        self.row_data.insert(TreeNode.ICON, 
+            TreeNode.icon_cache.get(TreeNode.get_icon_name(entity)))
+
+    @staticmethod
+    def get_icon_name(entity):
+        """Find the name of the icon representing the entity's type (tasklist
+        or task) and status (task complete or incomplete)."""
         if isinstance(entity, TaskList):
-            icon = list_icon
+            return "folder.png"
         elif isinstance(entity, Task):
             if entity.task_status == TaskStatus.COMPLETED:
-                icon = checked_icon
+                return "checkmark.png"
             else:
-                icon = unchecked_icon
+                return "checkbox_unchecked.png"
         else:
             raise ValueError("Cannot determine type of provided entity {0}".format(entity))
-
-        self.row_data.insert(TreeNode.ICON, icon)
 #------------------------------------------------------------------------------ 
 
 class TaskListTree(object):    
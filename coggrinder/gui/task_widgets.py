@@ -3,12 +3,15 @@ Created on Mar 29, 2012
 
 @author: Clay Carpenter
 """
-from gi.repository import Gtk, GdkPixbuf
+from gi.repository import Gtk, GdkPixbuf, GLib
 from coggrinder.entities.tasks import TaskList, Task
 from coggrinder.resources.icons import buttons
 import unittest
 from coggrinder.gui.events import Event
-from coggrinder.gui.tree_data import TaskTreeStore, TreeNode
+from coggrinder.entities.tree import Tree
+from coggrinder.gui.task_tree import TaskTreeModel, TreeNode
+from coggrinder.task_services import BatchOperation
+from coggrinder.gui.executors import BackgroundExecutor
 from pprint import pprint
 
 class TaskTreeWindowController(object):
@@ -18,7 +21,7 @@ class TaskTreeWindowController(object):
         self._taskview_controller = TaskTreeViewController()
         
         self.tasktree_service = None
-        self.tasktree = None
+        self.operation_queue = None
         
         # Initialize the TaskTreeWindow Gtk window that serves as the view
         # for this controller.
@@ -45,18 +48,105 @@ class TaskTreeWindowController(object):
         self.view.configure_button_clicked.register(self._handle_configure_event)
         
         self.view.entity_title_edited.register(self._handle_entity_title_updated)
+        
+        # Service calls are run in the background, so that the UI remains 
+        # responsive. The toolbar shows a busy indicator (and a way to cancel)
+        # while any are outstanding.
+        self.executor = BackgroundExecutor()
+        self.executor.busy_changed.register(self.view.set_busy)
+        self.view.cancel_button_clicked.register(self._handle_cancel_event)
+        self.view.connect("destroy", self._handle_window_destroyed)
+        self._refresh_call = None
 
     def refresh_task_data(self):
         """
         Pull updated tasklist and task information from the task tree
-        services Store the updated results locally before refreshing the UI
-        task tree.
+        services in the background, and update the UI task tree once the
+        refresh has finished. Any refresh that is still outstanding has its 
+        changes shown along with this one's.
         """
-        # Pull updated task data (tasklists and tasks) from the services.
-        self.tasktree = self.tasktree_service.refresh()
-                
-        # Update the UI task tree.
-        self.view.update_task_tree(self.tasktree)
+        if self._refresh_call is not None:
+            self._refresh_call.cancel()
+
+        # Only the tasks that changed since the last refresh are downloaded.
+        self._refresh_call = self.executor.submit(self.tasktree_service.refresh,
+            on_success=self._apply_refreshed_changes)
+
+    def show_cached_task_data(self):
+        """
+        Update the UI task tree from the locally cached task data, without
+        contacting the task services.
+        """
+        self.tasktree_service.load_cache()
+
+        self._apply_refreshed_changes()
+
+    def attach_operation_queue(self, operation_queue):
+        """
+        Send all task and tasklist changes through the operation queue. 
+        Changes are shown in the UI task tree immediately, and updated with
+        the service results once the queue has sent them (or undone, if the 
+        services rejected them).
+        """
+        self.operation_queue = operation_queue
+        self.operation_queue.operation_completed.register(
+            self._handle_operation_completed)
+        self.operation_queue.operation_failed.register(
+            self._handle_operation_failed)
+
+    def _enqueue_operation(self, operation):
+        """
+        Queue the operation to be sent to the task services, and show the 
+        change in the UI task tree right away. An inserted entity is given 
+        its (local) ID.
+        """
+        operation.entity.entity_id = self.operation_queue.enqueue(operation)
+
+        self.view.apply_entity_changes(
+            self.tasktree_service.apply_operation(operation))
+
+    def _handle_operation_completed(self, operation, result):
+        # Fired from the operation queue's flush thread, so apply the result
+        # from the main loop.
+        GLib.idle_add(self._apply_operation_result, operation, result)
+
+    def _apply_operation_result(self, operation, result):
+        self.view.apply_entity_changes(
+            self.tasktree_service.apply_operation_result(operation, result))
+
+        # Run only once when used as an idle callback.
+        return False
+
+    def _handle_operation_failed(self, operation, error):
+        # The services rejected the change, so undo it (from the main loop).
+        GLib.idle_add(self._revert_operation, operation)
+
+    def _revert_operation(self, operation):
+        # The entity is downloaded again in the background.
+        self.executor.submit(self.tasktree_service.revert_operation,
+            (operation,), on_success=self._apply_reverted_changes)
+
+        # Run only once when used as an idle callback.
+        return False
+
+    def _apply_reverted_changes(self, changes):
+        self.view.apply_entity_changes(changes)
+
+        # The tasks of a restored tasklist are only listed again by a refresh.
+        if self.tasktree_service.stale_tasklist_ids:
+            self.refresh_task_data()
+
+    def _apply_refreshed_changes(self, result=None):
+        # Takes the changes made by every refresh so far, including those 
+        # whose results were discarded.
+        self.view.apply_entity_changes(
+            self.tasktree_service.take_entity_changes())
+
+    def _handle_cancel_event(self, button):
+        self.executor.cancel_all()
+
+    def _handle_window_destroyed(self, window):
+        self.executor.shutdown()
 
     def _handle_save_event(self, button):
         raise NotImplementedError
@@ -69,8 +159,9 @@ class TaskTreeWindowController(object):
     
     def _handle_add_list_event(self, button):
         # Create the new (blank) tasklist, and add it to the task tree.
-        new_tasklist = self.tasklist_service.add_tasklist(TaskList(title=""))
-        self.refresh_task_data()
+        new_tasklist = TaskList(title="")
+        self._enqueue_operation(BatchOperation(BatchOperation.INSERT,
+            new_tasklist))
         
         # Find the new tasklist, select it (wiping out other selections), and
         # set it to editable/editing.
@@ -83,10 +174,7 @@ class TaskTreeWindowController(object):
         tasklist = selected_entities[0]
         
         # Delete the tasklist.
-        self.tasklist_service.delete_tasklist(tasklist)
-        
-        # Refresh the task data, tree.
-        self.refresh_task_data()
+        self._enqueue_operation(BatchOperation(BatchOperation.DELETE, tasklist))
         
     def _handle_add_task_event(self, button):
         # Find selected entity. This will determine the new tasks's parent 
@@ -109,10 +197,7 @@ class TaskTreeWindowController(object):
         new_task = Task(parent_id=parent_id, tasklist_id=tasklist_id)
             
         # Add the new task.
-        new_task = self.task_service.add_task(new_task)
-        
-        # Refresh the task data, tree.
-        self.refresh_task_data()
+        self._enqueue_operation(BatchOperation(BatchOperation.INSERT, new_task))
         
         # Override existing selection. Select new task and set the tree node 
         # to be "editable". This will need to expand any collapsed parent nodes
@@ -143,13 +228,11 @@ class TaskTreeWindowController(object):
         # For each task, delete the task. Promote any children of the task to 
         # be children of the task's parent (task or tasklist).
         # Keep track of the child tasks that have their parent updated, as 
-        # they will need 
+        # they will need to be moved.
         update_tasks = dict()
         for selected_task in selected_tasks:
-            # Remove the selected task from the local tasks dict, and from the 
-            # update-pending tasks list, if it's present there.
-            assert self._tasks.has_key(selected_task.entity_id)
-            del self._tasks[selected_task.entity_id]
+            # Remove the selected task from the update-pending tasks list, if
+            # it's present there.
             if update_tasks.has_key(selected_task.entity_id):
                 del update_tasks[selected_task.entity_id]
             
@@ -167,21 +250,18 @@ class TaskTreeWindowController(object):
                 # Include the child task in the list of tasks to be updated.
                 update_tasks[child_task.entity_id] = child_task
         
-        # Execute the updates.
-        for update_task_id in update_tasks:
-            # TODO: This needs to be a move operation, not a parent operation.
-            # According to the Google Tasks service docs, it doesn't look like
-            # this operation has much chance of succeeding without adding
-            # a concept of ordering locally and sending that information along
-            # with the move operation request.
-            self.task_service.update_task(update_tasks[update_task_id])
-            
-        # Execute the deletions.
+        # Move the child tasks up to their new parents, and then delete the
+        # selected tasks. The queue sends operations in order, so the moves 
+        # complete before the deletions are sent.
+        # TODO: The moved tasks are placed first among their new siblings, 
+        # as there isn't yet a concept of ordering locally to determine the 
+        # previous sibling to send with the move.
+        for update_task in update_tasks.values():
+            self._enqueue_operation(BatchOperation(BatchOperation.MOVE,
+                update_task, parent_id=update_task.parent_id))
         for deleted_task in selected_tasks:
-            self.task_service.delete_task(deleted_task)
-
-        # Refresh the data from the server and update the UI.
-        self.refresh_task_data()
+            self._enqueue_operation(BatchOperation(BatchOperation.DELETE,
+                deleted_task))
         
     def _handle_promote_task_event(self, button):
         raise NotImplementedError
@@ -205,17 +285,13 @@ class TaskTreeWindowController(object):
         target_entity.title = updated_title
         
         # Determine the entity type (task or tasklist).
-        if isinstance(target_entity, TaskList):            
-            # Send the updated tasklist to the server.
-            target_entity = self.tasklist_service.update_tasklist(target_entity)
-        elif isinstance(target_entity, Task):     
-            # Send the updated task to the server.
-            target_entity = self.task_service.update_task(target_entity)
-        else:
+        if not isinstance(target_entity, (TaskList, Task)):
             raise ValueError("Target entity must be of type TaskList or Task, was instead {0}".format(type(target_entity)))
         
-        # Update the local task data.
-        self.refresh_task_data()
+        # Queue the updated entity to be sent to the server. Repeated edits
+        # to the same entity are sent as a single update.
+        self._enqueue_operation(BatchOperation(BatchOperation.UPDATE,
+            target_entity))
 
     def _find_child_tasks(self, parent_task):
         """
@@ -231,10 +307,9 @@ class TaskTreeWindowController(object):
         # Simple unordered list of child tasks.
         child_tasks = list()
         
-        for task_id in self._tasks:
+        for task in self.tasktree_service.tasks.values():
             # Look for tasks with a parent ID that matches the parent task's
             # ID and belonging to the same tasklist as the parent task.
-            task = self._tasks[task_id]
             if (task.tasklist_id == parent_task.tasklist_id 
                 and task.parent_id == parent_task.entity_id):
                 # Found a child of the parent task, add it to the list.
@@ -305,6 +380,8 @@ class TaskTreeWindow(Gtk.Window):
                 
         self.configure_button_clicked = Event.propagate(
             self.toolbar_controller.configure_button_clicked)
+        self.cancel_button_clicked = Event.propagate(
+            self.toolbar_controller.cancel_button_clicked)
         
         # Add the task tree controller and view.
         self.treeview_controller = TaskTreeViewController()
@@ -319,8 +396,11 @@ class TaskTreeWindow(Gtk.Window):
         # Connect to the selection changed event from the TreeView.
         self.treeview_controller.selection_state_changed.register(self.toolbar_controller.selection_state_changed)
         
-    def update_task_tree(self, tasklists, tasks):
-        self.treeview_controller.update_task_tree(tasklists, tasks)
+    def apply_entity_changes(self, changes):
+        self.treeview_controller.apply_entity_changes(changes)
+        
+    def set_busy(self, is_busy):
+        self.toolbar_controller.view.set_busy(is_busy)
         
     def set_entity_editable(self, target_entity):
         """
@@ -396,6 +476,10 @@ class TaskToolbarViewController(object):
         self.view.configure_button.connect("clicked",
             self.configure_button_clicked.fire)      
         
+        self.cancel_button_clicked = Event()
+        self.view.cancel_button.connect("clicked",
+            self.cancel_button_clicked.fire)
+        
     def selection_state_changed(self, tasklist_selection_state, task_selection_state):
         self.view.update_button_states(tasklist_selection_state, task_selection_state)
 #------------------------------------------------------------------------------ 
@@ -425,6 +509,9 @@ class TaskToolbarView(Gtk.HBox):
         # Set up configuration buttons.
         self.pack_end(self._build_configuration_buttons(), False, False, 5)
         
+        # Set up the busy indicator.
+        self.pack_end(self._build_busy_indicator(), False, False, 5)
+        
     # TODO: A lot of this button building code is redundant.
     def _build_persistence_buttons(self):
         """ 
@@ -521,6 +608,33 @@ class TaskToolbarView(Gtk.HBox):
         button_box.add(self.configure_button)
         
         return button_box
+    
+    def _build_busy_indicator(self):
+        """
+        Builds a spinner and cancel button, shown only while service calls are
+        outstanding.
+        """
+        busy_box = Gtk.HBox(spacing=5)
+        
+        self.busy_spinner = Gtk.Spinner()
+        busy_box.add(self.busy_spinner)
+        
+        self.cancel_button = Gtk.Button.new_from_stock(Gtk.STOCK_CANCEL)
+        busy_box.add(self.cancel_button)
+        
+        # Stay hidden when the window is first shown.
+        busy_box.set_no_show_all(True)
+        self._busy_box = busy_box
+        
+        return busy_box
+    
+    def set_busy(self, is_busy):
+        if is_busy:
+            self._busy_box.show_all()
+            self.busy_spinner.start()
+        else:
+            self.busy_spinner.stop()
+            self._busy_box.hide()
             
     """
     This would be hard to move to the toolbar view because it requires 
@@ -564,7 +678,7 @@ class TaskTreeViewController(object):
     -- Dict of tasklists, keyed by ID - still necessary?
     -- Dict of tasks, keyed by ID - still necessary?
     -- TaskTreeView/Gtk.TreeView
-    -- TaskTreeStore/Gtk.TreeStore
+    -- TaskTreeModel/Gtk.TreeModel
     """            
     def __init__(self):
         self.view = TaskTreeView()
@@ -576,51 +690,86 @@ class TaskTreeViewController(object):
         self.view.get_selection().connect("changed",
             self._handle_selection_changed)
         
+        # Monitor row expansion events.
+        self.view.connect("row-expanded", self._handle_row_expanded)
+        self.view.connect("row-collapsed", self._handle_row_collapsed)
+        
         # Declare the selection changed and title edited events.
         self.selection_state_changed = Event()
         self.entity_title_edited = Event()
         
-        # Establish the tree store (model) that holds the task entity 
+        # Establish the tree model that presents the task entity 
         # information.
-        self.task_treestore = TaskTreeStore()
-        
-        # This index allows us to quickly look up where in the tree a given
-        # entity is.
-        self.entity_path_index = dict()
-        self._tasks = dict()
-        self._tasklists = dict()
-        self.tree_states = dict()
-        
-        # Set default for clearing flag. This flag is used to help ignore 
-        # "system" selection change events that seem to occur during the 
-        # Gtk.TreeStore.clear() operation.
-        self._is_clearing = False
-        
-        # Connect the tree store/row_data to the tree view.
-        self.view.set_model(self.task_treestore)
-        
-    def update_task_tree(self, tasklists, tasks):
+        self.task_treemodel = TaskTreeModel()
+        
+        # Tree state, tracked as the user expands, collapses and selects 
+        # rows, so that it never has to be collected from every row.
+        self._expanded_entity_ids = set()
+        
+        # The selected entity IDs, mapped to the tasklist ID of each selected
+        # task (or to None for a selected tasklist), along with counts of the
+        # selected tasklists and of the selected tasks in each tasklist. 
+        # These are updated with only the rows added to or removed from the
+        # selection.
+        self._selected_entity_ids = dict()
+        self._selected_tasklist_count = 0
+        self._selected_task_counts = dict()
+        self._tasklist_selection_state = self.SelectionState.NONE
+        self._task_selection_state = self.SelectionState.NONE
+        
+        # Set when a selection change has been seen, but not yet handled.
+        self._is_selection_update_pending = False
+        
+        # Set default for updating flag. This flag is used to help ignore 
+        # "system" selection change events that occur while rows are being
+        # removed from the tree model.
+        self._is_updating = False
+        
+        # Connect the tree model to the tree view.
+        self.view.set_model(self.task_treemodel)
+        
+    def apply_entity_changes(self, changes):
         """
-        Collect the current tree state, replace the tree model, and then 
-        restore the tree state (as much as possible).
+        Apply the changes to the tasklists and tasks to the tree model in 
+        place. Only the rows of the changed entities are signalled, and the
+        expansion and selection states of the rest are left alone.
+
+        Args:
+            changes: The EntityChanges to apply.
         """
-        # Collect current tree state.
-        self._rebuild_tree_state()
-        
-        # Clear out tree. Set clearing flag to disable selection change 
-        # handling, as the clear operation will fire those events.
-        self._is_clearing = True
-        self.task_treestore.clear()
-        self._is_clearing = False
-        
-        # Build a new tree with the updated task data.
-        self._tasklists = tasklists
-        self._tasks = tasks
-        self.entity_path_index = self.task_treestore.build_tree(tasklists, tasks)
-        
-        # With the new tree structure in place, try to restore the old tree 
-        # state to the fullest extent possible.
-        self._restore_tree_state()
+        self._replace_entity_ids(changes.replaced_entity_ids)
+
+        # Set updating flag to disable selection change handling while rows 
+        # are changed, and then handle the (possibly reduced) selection once.
+        self._is_updating = True
+        try:
+            self.task_treemodel.apply_entity_changes(changes)
+            self._restore_tree_state()
+        finally:
+            self._is_updating = False
+
+        self._update_selection_state()
+
+    def _replace_entity_ids(self, replaced_entity_ids):
+        """Carry the expansion and selection states over to the new IDs that
+        the task services gave the (locally inserted) entities.
+        """
+        for old_entity_id, new_entity_id in replaced_entity_ids.items():
+            if old_entity_id in self._expanded_entity_ids:
+                self._expanded_entity_ids.discard(old_entity_id)
+                self._expanded_entity_ids.add(new_entity_id)
+
+            if old_entity_id in self._selected_entity_ids:
+                self._selected_entity_ids[new_entity_id] = (
+                    self._selected_entity_ids.pop(old_entity_id))
+
+            # Selected tasks are counted by their tasklist's ID.
+            if old_entity_id in self._selected_task_counts:
+                self._selected_task_counts[new_entity_id] = (
+                    self._selected_task_counts.pop(old_entity_id))
+                for entity_id, tasklist_id in self._selected_entity_ids.items():
+                    if tasklist_id == old_entity_id:
+                        self._selected_entity_ids[entity_id] = new_entity_id
     
 #    def select_entity(self, target_entity):
 #        entity_tree_path = self._get_path_for_entity_id(target_entity.entity_id)
@@ -639,17 +788,17 @@ class TaskTreeViewController(object):
         # Expand any parent nodes of the entity (to ensure it's visible). This 
         # will only be relevant for task entities, as tasklist entities will 
         # always already be visible.
-        tree_iter = self.task_treestore.get_iter_from_string(entity_tree_path)
-        treepath = self.task_treestore.get_path(tree_iter)
+        tree_iter = self.task_treemodel.get_iter_from_string(entity_tree_path)
+        treepath = self.task_treemodel.get_path(tree_iter)
         self.view.expand_to_path(treepath)        
         
         # Select the entity, making the title editable and holding the keyboard
         # focus.        
-        treepath = self.task_treestore.get_path(tree_iter)
+        treepath = self.task_treemodel.get_path(tree_iter)
         self.view.start_editing(treepath)
     
     def _get_treepath_for_path(self, path):
-        self.task_treestore.get_iter_from_string(path)
+        self.task_treemodel.get_iter_from_string(path)
     
     def _get_parent_entity(self, entity):
         assert isinstance(entity, Task)
@@ -665,110 +814,75 @@ class TaskTreeViewController(object):
 #        if is_expanded:
         
     def get_selected_entities(self):
+        if self._is_selection_update_pending:
+            self._update_selection_state()
+        
         assert (not self._tasklist_selection_state == self.SelectionState.NONE or not self._task_selection_state == self.SelectionState.NONE)
         
-        # Ensure tree state information is up to date.
-        self._rebuild_tree_state()
-                
-        # Loop through the tree states, looking for selected entity IDs.
-        selected_entities = list()
-        for entity_id in self.tree_states.keys():
-            tree_state = self.tree_states.get(entity_id)
-            
-            if tree_state.is_selected:
-                if self._tasklists.has_key(entity_id):
-                    entity = self._tasklists.get(entity_id)                    
-                elif self._tasks.has_key(entity_id):
-                    entity = self._tasks.get(entity_id)
-                else:
-                    raise ValueError("Entity with ID of {0} is not a required type (TaskList or Task)")
-                selected_entities.append(entity)
-        
-        return selected_entities
+        tasktree = self.task_treemodel.tasktree
+        return [tasktree.get_node_for_entity_id(entity_id).value
+            for entity_id in self._selected_entity_ids]
     
-    def _rebuild_tree_state(self):            
-        # Clear out existing tree states.
-        self.tree_states.clear()
-        
-        self._collect_tree_state()
-        
-    def _collect_tree_state(self, tree_iter=None):
-        if tree_iter is None:
-            # Assume a default position of the root node if nothing has been
-            # specified. This allows the method to be called without arguments.
-            tree_iter = self.task_treestore.get_iter_first()
-            
-        while tree_iter != None:
-            tree_path = self.task_treestore.get_path(tree_iter)
-            
-            is_expanded = is_selected = False
-            
-            if self.view.row_expanded(tree_path):
-                is_expanded = True
-            
-            if self.view.get_selection().path_is_selected(tree_path):
-                is_selected = True
-            
-            if is_expanded or is_selected:
-                entity_id = self.task_treestore[tree_iter][TreeNode.ENTITY_ID]
-
-                self.tree_states[entity_id] = self.TreeState(is_expanded, is_selected)            
-            
-            if self.task_treestore.iter_has_child(tree_iter):
-                child_iter = self.task_treestore.iter_children(tree_iter)
-                
-                self._collect_tree_state(child_iter)
-            
-            tree_iter = self.task_treestore.iter_next(tree_iter)
+    def _restore_tree_state(self):
+        """
+        Restore the expansion and selection of rows that have lost them by 
+        being moved (which removes and then reinserts the row), and forget 
+        the entities that are no longer in the tree. Only the expanded and 
+        selected entities are visited.
+        """
+        expanded_paths = list()
+        for entity_id in list(self._expanded_entity_ids):
+            tree_path = self.task_treemodel.get_entity_path(entity_id)
+            if tree_path is None:
+                self._expanded_entity_ids.discard(entity_id)
+            else:
+                expanded_paths.append(Gtk.TreePath.new_from_string(tree_path))
+        
+        # Expand parent rows ahead of their children, as only visible rows 
+        # can be expanded.
+        expanded_paths.sort(key=lambda treepath: treepath.get_depth())
+        for treepath in expanded_paths:
+            if not self.view.row_expanded(treepath):
+                self.view.expand_row(treepath, False)
+        
+        # Entities that are no longer in the tree are dropped from the 
+        # selection by the next selection state update.
+        selection = self.view.get_selection()
+        for entity_id in self._selected_entity_ids:
+            tree_path = self.task_treemodel.get_entity_path(entity_id)
+            if tree_path is not None and not selection.path_is_selected(
+                    Gtk.TreePath.new_from_string(tree_path)):
+                selection.select_path(tree_path)
     
-    def _restore_tree_state(self, tree_iter=None):
-        if tree_iter is None:
-            # Assume a default position of the root node if nothing has been
-            # specified. This allows the method to be called without arguments.
-            tree_iter = self.task_treestore.get_iter_first()
-            
-        while tree_iter != None:
-            tree_path = self.task_treestore.get_path(tree_iter)
-            current_entity_id = self.task_treestore[tree_iter][TreeNode.ENTITY_ID]
-            
-            if self.tree_states.has_key(current_entity_id):
-                tree_row_state = self.tree_states[current_entity_id]
-                
-                if tree_row_state.is_expanded:
-                    self.view.expand_row(tree_path, False)
-                    
-                if tree_row_state.is_selected:
-                    self.view.get_selection().select_path(tree_path)
-            
-            if self.task_treestore.iter_has_child(tree_iter):
-                child_iter = self.task_treestore.iter_children(tree_iter)
-                
-                self._restore_tree_state(child_iter)
-            
-            tree_iter = self.task_treestore.iter_next(tree_iter)
+    def _handle_row_expanded(self, treeview, tree_iter, treepath):
+        self._expanded_entity_ids.add(
+            self.task_treemodel[tree_iter][TreeNode.ENTITY_ID])
+    
+    def _handle_row_collapsed(self, treeview, tree_iter, treepath):
+        # Collapsing a row also collapses all of the rows beneath it.
+        collapsed_path = treepath.to_string()
+        descendant_path_prefix = collapsed_path + Tree.PATH_SEPARATOR
+        
+        for entity_id in list(self._expanded_entity_ids):
+            tree_path = self.task_treemodel.get_entity_path(entity_id)
+            if (tree_path is None or tree_path == collapsed_path
+                    or tree_path.startswith(descendant_path_prefix)):
+                self._expanded_entity_ids.discard(entity_id)
             
     def _get_entity_id_for_path(self, tree_path):
-        if tree_path in self.entity_path_index.values():
-            key_index = self.entity_path_index.values().index(tree_path)
-            return self.entity_path_index.keys()[key_index]
-        else:
-            raise ValueError("Could not find an entity registered with path {0}".format(tree_path))
+        return self._get_entity_for_path(tree_path).entity_id
     
     def _get_path_for_entity_id(self, entity_id):
-        if self.entity_path_index.has_key(entity_id):
-            return self.entity_path_index.get(entity_id)
+        tree_path = self.task_treemodel.get_entity_path(entity_id)
+        if tree_path is not None:
+            return tree_path
         else:
             raise ValueError("Could not find a path for entity with id {0}".format(entity_id))
         
     def _get_entity_for_path(self, tree_path):
-        entity_id = self._get_entity_id_for_path(tree_path)
-        
-        if self._tasklists.has_key(entity_id):
-            entity = self._tasklists.get(entity_id)
-        elif self._tasks.has_key(entity_id):
-            entity = self._tasks.get(entity_id)
-        else:
-            raise ValueError("Could not find an entity for the path {0} and entity id {1}".format(tree_path, entity_id))
+        entity = self.task_treemodel.get_entity(tree_path)
+        if entity is None:
+            raise ValueError("Could not find an entity for the path {0}".format(tree_path))
 
         return entity
         
@@ -782,68 +896,100 @@ class TaskTreeViewController(object):
         self.entity_title_edited.fire(target_entity, updated_title)
     
     def _handle_selection_changed(self, selection_data):
-        # If the clearing flag is set, return immediately to prevent handling
+        # If the updating flag is set, return immediately to prevent handling
         # spurious selection change events.
-        if self._is_clearing:
+        if self._is_updating:
             return
         
-        selected_rows = selection_data.get_selected_rows()[1]
-                
-        self._selected_tasks = list()
-        self._selected_tasklists = list()
-                
-        # Count the tasklists and tasks in the selection.
-        for new_selected_row in selected_rows:            
-            selected_entity = self._get_entity_for_path(
-                new_selected_row.to_string())
-
-            if isinstance(selected_entity, TaskList):
-                # This row represents a Tasklist.
-                self._selected_tasklists.append(selected_entity)
-            elif isinstance(selected_entity, Task):
-                # This row represents a Task.
-                self._selected_tasks.append(selected_entity)
-        
-        if len(self._selected_tasklists) == 1:
-            self._tasklist_selection_state = TaskTreeViewController.SelectionState.SINGLE
-        elif len(self._selected_tasklists) > 1:
-            self._tasklist_selection_state = TaskTreeViewController.SelectionState.MULTIPLE_HETERGENOUS
+        # Selections can change many times in a row (e.g., when rubber band
+        # selecting a lot of rows), so the changes are only handled once the
+        # main loop is idle.
+        if not self._is_selection_update_pending:
+            self._is_selection_update_pending = True
+            GLib.idle_add(self._update_selection_state)
+    
+    def _update_selection_state(self):
+        """
+        Update the selection with the rows that have been added to or removed
+        from it, and notify any listeners if the selection state has changed
+        as a result.
+
+        The selected rows are compared as a whole, as Gtk doesn't say which
+        rows a selection change affected: the "changed" signal carries no 
+        rows, and the select function is also called just to check whether 
+        a row can be selected, so it can't be used to track the changes 
+        either. Listing the selected rows already costs Gtk a walk over the
+        rows of the view, so comparing them (once per burst of changes) adds
+        only O(selected) to that, and only the rows that changed are counted.
+        """
+        self._is_selection_update_pending = False
+        
+        selected_rows = self.view.get_selection().get_selected_rows()[1]
+        selected_entity_ids = set(self._get_entity_id_for_path(
+            selected_row.to_string()) for selected_row in selected_rows)
+        
+        for entity_id in self._selected_entity_ids.keys():
+            if entity_id not in selected_entity_ids:
+                self._deselect_entity(entity_id)
+        
+        for entity_id in selected_entity_ids:
+            if entity_id not in self._selected_entity_ids:
+                self._select_entity(self.task_treemodel.tasktree
+                    .get_node_for_entity_id(entity_id).value)
+        
+        if self._selected_tasklist_count == 1:
+            tasklist_selection_state = TaskTreeViewController.SelectionState.SINGLE
+        elif self._selected_tasklist_count > 1:
+            tasklist_selection_state = TaskTreeViewController.SelectionState.MULTIPLE_HETERGENOUS
         else:
-            self._tasklist_selection_state = TaskTreeViewController.SelectionState.NONE
+            tasklist_selection_state = TaskTreeViewController.SelectionState.NONE
         
-        if len(self._selected_tasks) == 1:
-            self._task_selection_state = TaskTreeViewController.SelectionState.SINGLE
-        elif len(self._selected_tasks) > 1:
+        selected_task_count = sum(self._selected_task_counts.values())
+        if selected_task_count == 1:
+            task_selection_state = TaskTreeViewController.SelectionState.SINGLE
+        elif selected_task_count > 1:
             # Determine if all selected tasks belong to the same tasklist or
             # not.
-            is_homogenous = True
-            prev_tasklist_id = None
-            for selected_task in self._selected_tasks:
-                if prev_tasklist_id is not None and selected_task.tasklist_id != prev_tasklist_id:
-                    is_homogenous = False
-                    break
-            
-            if is_homogenous:
-                self._task_selection_state = TaskTreeViewController.SelectionState.MULTIPLE_HOMOGENOUS
+            if len(self._selected_task_counts) == 1:
+                task_selection_state = TaskTreeViewController.SelectionState.MULTIPLE_HOMOGENOUS
             else:
-                self._task_selection_state = TaskTreeViewController.SelectionState.MULTIPLE_HETERGENOUS
+                task_selection_state = TaskTreeViewController.SelectionState.MULTIPLE_HETERGENOUS
         else:
-            self._task_selection_state = TaskTreeViewController.SelectionState.NONE
-                                    
-        # Notify any listeners of the change in selection state.
-        # TODO: Make this a bit smarter/more efficient by only firing when the
-        # selection state actually changes, instead of on every selection 
-        # event.
-        self.selection_state_changed.fire(self._tasklist_selection_state, self._task_selection_state)  
-        
-    class TreeState(object):
-        """
-        Very simple convenience class to group the two tree node states 
-        together.
-        """
-        def __init__(self, is_expanded=False, is_selected=False):
-            self.is_expanded = is_expanded
-            self.is_selected = is_selected      
+            task_selection_state = TaskTreeViewController.SelectionState.NONE
+        
+        # Notify any listeners of the change in selection state, if there 
+        # actually was one.
+        if ((tasklist_selection_state, task_selection_state) 
+                != (self._tasklist_selection_state, self._task_selection_state)):
+            self._tasklist_selection_state = tasklist_selection_state
+            self._task_selection_state = task_selection_state
+            
+            self.selection_state_changed.fire(self._tasklist_selection_state, self._task_selection_state)
+        
+        # Run only once when used as an idle callback.
+        return False
+    
+    def _select_entity(self, entity):
+        if isinstance(entity, TaskList):
+            # This row represents a Tasklist.
+            self._selected_entity_ids[entity.entity_id] = None
+            self._selected_tasklist_count += 1
+        elif isinstance(entity, Task):
+            # This row represents a Task.
+            self._selected_entity_ids[entity.entity_id] = entity.tasklist_id
+            self._selected_task_counts[entity.tasklist_id] = (
+                self._selected_task_counts.get(entity.tasklist_id, 0) + 1)
+    
+    def _deselect_entity(self, entity_id):
+        # Uses the tasklist ID recorded at selection, as the entity may have
+        # been removed from the tree since.
+        tasklist_id = self._selected_entity_ids.pop(entity_id)
+        if tasklist_id is None:
+            self._selected_tasklist_count -= 1
+        else:
+            self._selected_task_counts[tasklist_id] -= 1
+            if not self._selected_task_counts[tasklist_id]:
+                del self._selected_task_counts[tasklist_id]
         
     class SelectionState(object):
             NONE = 0
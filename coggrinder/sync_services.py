@@ -0,0 +1,646 @@
+"""
+Created on May 9, 2012
+
+@author: Clay Carpenter
+"""
+
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+import uuid
+import apiclient.errors
+import httplib2
+from coggrinder.entities.tasks import TaskList, Task
+from coggrinder.gui.events import Event
+from coggrinder.task_services import BatchOperation, BatchOperationError, \
+    EntityConflictError, TaskService, TaskListService, FakeTaskServiceProxy, \
+    FakeBatchHttpRequest, FakeTaskListServiceProxy
+from coggrinder.utilities import GoogleKeywords
+
+class WriteBehindQueue(object):
+    """
+    Persistent queue of outbound task and tasklist mutations.
+
+    Operations are enqueued immediately (without contacting the Google Task
+    services) and sent in order, in batches, by a background flush thread.
+    Operations that fail with a temporary error (e.g., the network is down)
+    are retried, waiting twice as long after each failure, up to
+    max_retry_delay seconds. Operations rejected by the service are dropped,
+    and reported with operation_failed.
+
+    Pending operations on the same entity are coalesced: repeated updates to
+    an entity are sent as a single update, and deleting an entity that hasn't
+    been sent yet cancels its pending operations.
+
+    Inserted entities are given a local ID until the service assigns their
+    real ID; any pending operations that refer to the local ID are then
+    rewritten to use the real ID.
+
+    Events (fired from the flush thread):
+        operation_completed: Fired with the operation and its result (the
+            updated entity) after each operation is sent.
+        operation_failed: Fired with the operation and the error after an
+            operation has been dropped.
+    """
+    DEFAULT_PATH = "coggrinder-outbox.db"
+    LOCAL_ID_PREFIX = "local-"
+    DEFAULT_RETRY_DELAY = 1.0
+    DEFAULT_MAX_RETRY_DELAY = 60.0
+
+    # HTTP statuses that indicate a temporary failure, even though they are
+    # client errors.
+    _RETRY_STATUSES = (408, 429)
+
+    _TASKLIST = "tasklist"
+    _TASK = "task"
+
+    def __init__(self, tasklist_service, task_service, path=None,
+            retry_delay=DEFAULT_RETRY_DELAY,
+            max_retry_delay=DEFAULT_MAX_RETRY_DELAY):
+        if path is None:
+            path = WriteBehindQueue.DEFAULT_PATH
+        self.path = path
+
+        self.tasklist_service = tasklist_service
+        self.task_service = task_service
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self.operation_completed = Event()
+        self.operation_failed = Event()
+
+        # Pending operations, in order, as [sequence, BatchOperation] entries.
+        self._entries = list()
+        # Sequence numbers of the entries currently being sent.
+        self._in_flight = set()
+        # Local IDs that haven't been replaced by real IDs yet.
+        self._local_ids = set()
+        # Latest etag received for each entity, keyed by entity ID.
+        self._etags = dict()
+
+        self._condition = threading.Condition()
+        self._flush_thread = None
+        self._is_running = False
+
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS operations "
+                "(sequence INTEGER PRIMARY KEY AUTOINCREMENT, operation TEXT, "
+                "entity_type TEXT, tasklist_id TEXT, data TEXT, parent_id TEXT, "
+                "previous_id TEXT)")
+        self._load()
+
+    @property
+    def pending_operations(self):
+        """Copy of the list of operations waiting to be sent, in order."""
+        with self._condition:
+            return [operation for sequence, operation in self._entries]
+
+    def enqueue(self, operation):
+        """
+        Add the operation to the queue. The operation's entity is copied, so
+        later changes to it aren't sent unless it is enqueued again.
+
+        Returns:
+            The ID of the operation's entity. For an insert, this is the new
+            local ID of the entity.
+        """
+        operation = BatchOperation(operation.operation,
+            operation.entity.copy(), operation.parent_id,
+            operation.previous_id)
+        entity = operation.entity
+
+        with self._condition:
+            if operation.operation == BatchOperation.INSERT:
+                entity.entity_id = "{0}{1}".format(self.LOCAL_ID_PREFIX,
+                    uuid.uuid4().hex)
+                self._local_ids.add(entity.entity_id)
+                self._append(operation)
+            else:
+                assert entity.entity_id is not None
+                self._coalesce(operation)
+
+            self._condition.notify_all()
+
+        return entity.entity_id
+
+    def _coalesce(self, operation):
+        # Only operations that haven't started being sent can be changed.
+        pending_entries = [entry for entry in self._entries
+            if entry[0] not in self._in_flight
+                and entry[1].entity.entity_id == operation.entity.entity_id]
+
+        if operation.operation == BatchOperation.UPDATE:
+            for entry in pending_entries:
+                if entry[1].operation in (BatchOperation.INSERT,
+                        BatchOperation.UPDATE):
+                    # Send the latest properties with the earlier operation.
+                    entry[1].entity = operation.entity
+                    self._store(entry)
+                    return
+        elif operation.operation == BatchOperation.MOVE:
+            for entry in pending_entries:
+                if entry[1].operation == BatchOperation.MOVE:
+                    entry[1].parent_id = operation.parent_id
+                    entry[1].previous_id = operation.previous_id
+                    self._store(entry)
+                    return
+        elif operation.operation == BatchOperation.DELETE:
+            for entry in pending_entries:
+                self._remove(entry)
+
+            if any(entry[1].operation == BatchOperation.INSERT
+                    for entry in pending_entries):
+                # The entity was never sent, so there is nothing to delete.
+                return
+
+        self._append(operation)
+
+    def start(self):
+        """Start sending the queued operations from a background thread."""
+        with self._condition:
+            if self._flush_thread is not None:
+                return
+
+            self._is_running = True
+            self._flush_thread = threading.Thread(target=self._run)
+            self._flush_thread.daemon = True
+            self._flush_thread.start()
+
+    def stop(self):
+        """Stop the background flush thread, leaving any unsent operations in
+        the queue.
+        """
+        with self._condition:
+            self._is_running = False
+            self._condition.notify_all()
+            flush_thread, self._flush_thread = self._flush_thread, None
+
+        if flush_thread is not None:
+            flush_thread.join()
+
+    def close(self):
+        self.stop()
+        self._connection.close()
+
+    def _run(self):
+        retry_delay = self.retry_delay
+        while True:
+            with self._condition:
+                while self._is_running and not self._entries:
+                    self._condition.wait()
+                if not self._is_running:
+                    return
+
+            if self.flush():
+                retry_delay = self.retry_delay
+            else:
+                # Wait before trying again (or until stopped).
+                with self._condition:
+                    if self._is_running:
+                        self._condition.wait(retry_delay)
+                retry_delay = min(retry_delay * 2, self.max_retry_delay)
+
+    def flush(self):
+        """
+        Send the queued operations, in order.
+
+        Returns:
+            True if the queue was emptied, or False if an operation failed
+            with a temporary error and must be retried later.
+        """
+        while True:
+            with self._condition:
+                entries = self._take_batch()
+                if not entries:
+                    return True
+                self._in_flight.update(entry[0] for entry in entries)
+
+            operations = [entry[1] for entry in entries]
+            service = self._get_service(operations[0].entity)
+            try:
+                results = service.execute_batch(operations)
+                errors = dict()
+            except BatchOperationError as error:
+                results = error.results
+                errors = error.errors
+            except Exception as error:
+                results = [None] * len(operations)
+                errors = dict((index, error) for index in range(len(operations)))
+
+            is_retry_needed = False
+            completed = list()
+            failed = list()
+            with self._condition:
+                self._in_flight.difference_update(entry[0] for entry in entries)
+
+                for index, entry in enumerate(entries):
+                    if index not in errors:
+                        self._complete(entry, results[index])
+                        completed.append((entry[1], results[index]))
+                    elif self._is_retryable(errors[index]):
+                        is_retry_needed = True
+                    else:
+                        self._remove(entry)
+                        failed.append((entry[1], errors[index]))
+
+            for operation, result in completed:
+                self.operation_completed.fire(operation, result)
+            for operation, error in failed:
+                self.operation_failed.fire(operation, error)
+
+            if is_retry_needed:
+                return False
+
+    def _take_batch(self):
+        """
+        Collect the leading run of operations that can be sent together:
+        operations of the same kind, for the same service, on different
+        entities, none of which refer to an entity that hasn't been inserted
+        yet. Operations that are already being sent are skipped, along with
+        any later operations on the same entities.
+        """
+        pending_entries = list()
+        in_flight_ids = set()
+        for entry in self._entries:
+            if entry[0] in self._in_flight:
+                in_flight_ids.add(entry[1].entity.entity_id)
+            else:
+                pending_entries.append(entry)
+
+        while pending_entries:
+            first_operation = pending_entries[0][1]
+            if not self._refers_to_local_id(first_operation):
+                break
+            if in_flight_ids:
+                # The insert this operation depends on may still be in 
+                # flight.
+                return list()
+
+            # The insert this operation depends on was dropped, so it can
+            # never be sent.
+            entry = pending_entries.pop(0)
+            self._remove(entry)
+            self._condition.release()
+            try:
+                self.operation_failed.fire(entry[1], ValueError(
+                    "Operation refers to an entity that was never inserted."))
+            finally:
+                self._condition.acquire()
+        else:
+            return list()
+
+        service = self._get_service(first_operation.entity)
+        batch = list()
+        entity_ids = set()
+        for entry in pending_entries:
+            operation = entry[1]
+            if (operation.operation != first_operation.operation
+                    or self._get_service(operation.entity) is not service
+                    or operation.entity.entity_id in entity_ids
+                    or operation.entity.entity_id in in_flight_ids
+                    or self._refers_to_local_id(operation)
+                    or len(batch) >= service.MAX_BATCH_SIZE):
+                break
+
+            # Make the operation conditional on the latest known etag, so
+            # that the entity isn't seen as changed by someone else because
+            # of an earlier operation. The entity's own etag is left alone,
+            # so that it isn't sent as a modified property.
+            operation.if_match = self._etags.get(operation.entity.entity_id)
+
+            batch.append(entry)
+            entity_ids.add(operation.entity.entity_id)
+
+        return batch
+
+    def _refers_to_local_id(self, operation):
+        entity = operation.entity
+        referenced_ids = [operation.parent_id, operation.previous_id]
+        if operation.operation != BatchOperation.INSERT:
+            referenced_ids.append(entity.entity_id)
+        if isinstance(entity, Task):
+            referenced_ids.extend((entity.parent_id, entity.tasklist_id))
+
+        return any(entity_id in self._local_ids for entity_id in referenced_ids)
+
+    def _complete(self, entry, result):
+        self._remove(entry)
+
+        operation = entry[1]
+        if operation.operation == BatchOperation.DELETE:
+            self._etags.pop(operation.entity.entity_id, None)
+            return
+
+        self._etags[result.entity_id] = result.e_tag
+
+        if operation.operation == BatchOperation.INSERT:
+            local_id = operation.entity.entity_id
+            self._local_ids.discard(local_id)
+            self._replace_entity_id(local_id, result.entity_id)
+
+    def _replace_entity_id(self, local_id, entity_id):
+        """Rewrite every pending reference to the local ID."""
+        for entry in self._entries:
+            operation = entry[1]
+            entity = operation.entity
+            is_changed = False
+
+            if entity.entity_id == local_id:
+                entity.entity_id = entity_id
+                is_changed = True
+            if operation.parent_id == local_id:
+                operation.parent_id = entity_id
+                is_changed = True
+            if operation.previous_id == local_id:
+                operation.previous_id = entity_id
+                is_changed = True
+            if isinstance(entity, Task):
+                if entity.parent_id == local_id:
+                    entity.parent_id = entity_id
+                    is_changed = True
+                if entity.tasklist_id == local_id:
+                    entity.tasklist_id = entity_id
+                    is_changed = True
+
+            if is_changed:
+                self._store(entry)
+
+    def _is_retryable(self, error):
+        if isinstance(error, EntityConflictError):
+            return False
+        if isinstance(error, apiclient.errors.HttpError):
+            status = error.resp.status
+            return status >= 500 or status in self._RETRY_STATUSES
+
+        # Anything else (e.g., a socket error) is treated as a connection
+        # problem.
+        return True
+
+    def _get_service(self, entity):
+        if isinstance(entity, TaskList):
+            return self.tasklist_service
+
+        return self.task_service
+
+    def _append(self, operation):
+        with self._connection:
+            cursor = self._connection.execute("INSERT INTO operations "
+                "(operation, entity_type, tasklist_id, data, parent_id, "
+                "previous_id) VALUES (?, ?, ?, ?, ?, ?)",
+                self._to_row(operation))
+        self._entries.append([cursor.lastrowid, operation])
+
+    def _store(self, entry):
+        with self._connection:
+            self._connection.execute("UPDATE operations SET operation = ?, "
+                "entity_type = ?, tasklist_id = ?, data = ?, parent_id = ?, "
+                "previous_id = ? WHERE sequence = ?",
+                self._to_row(entry[1]) + (entry[0],))
+
+    def _remove(self, entry):
+        with self._connection:
+            self._connection.execute(
+                "DELETE FROM operations WHERE sequence = ?", (entry[0],))
+        self._entries.remove(entry)
+
+    def _to_row(self, operation):
+        entity = operation.entity
+        if isinstance(entity, Task):
+            entity_type = self._TASK
+            tasklist_id = entity.tasklist_id
+        else:
+            entity_type = self._TASKLIST
+            tasklist_id = None
+
+        return (operation.operation, entity_type, tasklist_id,
+            json.dumps(entity.to_str_dict()), operation.parent_id,
+            operation.previous_id)
+
+    def _load(self):
+        for (sequence, operation, entity_type, tasklist_id, data, parent_id,
+                previous_id) in self._connection.execute("SELECT sequence, "
+                    "operation, entity_type, tasklist_id, data, parent_id, "
+                    "previous_id FROM operations ORDER BY sequence"):
+            if entity_type == self._TASK:
+                entity = Task.from_str_dict(json.loads(data))
+                entity.tasklist_id = self._to_str(tasklist_id)
+            else:
+                entity = TaskList.from_str_dict(json.loads(data))
+
+            # Which properties were modified isn't stored, so send all of
+            # them.
+            entity.mark_modified()
+
+            self._entries.append([sequence, BatchOperation(str(operation),
+                entity, self._to_str(parent_id), self._to_str(previous_id))])
+
+            if (operation == BatchOperation.INSERT
+                    and entity.entity_id.startswith(self.LOCAL_ID_PREFIX)):
+                self._local_ids.add(entity.entity_id)
+
+    @staticmethod
+    def _to_str(value):
+        if value is None:
+            return None
+
+        return str(value)
+#------------------------------------------------------------------------------
+
+class WriteBehindQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.task_str_dicts = {"tl-0": [{GoogleKeywords.ID: "t-0",
+            GoogleKeywords.TITLE: "Task 0", GoogleKeywords.ETAG: "etag-0"}]}
+        self.task_proxy = FakeTaskServiceProxy(self.task_str_dicts)
+        self.task_service = TaskService(self.task_proxy,
+            batch_request_factory=FakeBatchHttpRequest)
+        self.tasklist_service = TaskListService(FakeTaskListServiceProxy([]))
+
+        self.queue = WriteBehindQueue(self.tasklist_service, self.task_service,
+            path=":memory:")
+
+        self.completed = list()
+        self.failed = list()
+        self.queue.operation_completed.register(
+            lambda operation, result: self.completed.append((operation, result)))
+        self.queue.operation_failed.register(
+            lambda operation, error: self.failed.append((operation, error)))
+
+    def tearDown(self):
+        self.queue.close()
+
+    def _get_task(self, entity_id="t-0"):
+        task = Task(tasklist_id="tl-0", entity_id=entity_id, title="Task 0")
+        task.e_tag = self.task_str_dicts["tl-0"][0].get(GoogleKeywords.ETAG)
+
+        return task
+
+    def test_coalesce_updates(self):
+        task = self._get_task()
+        for count in range(5):
+            task.title = "Renamed {0}".format(count)
+            self.queue.enqueue(BatchOperation(BatchOperation.UPDATE, task))
+
+        self.assertEqual(1, len(self.queue.pending_operations))
+
+        self.assertTrue(self.queue.flush())
+
+        self.assertEqual("Renamed 4", self.task_str_dicts["tl-0"][0][GoogleKeywords.TITLE])
+        self.assertEqual(1, self.task_proxy.execute_count)
+        self.assertEqual([], self.queue.pending_operations)
+
+    def test_insert_then_update_and_delete(self):
+        # An update to an unsent insert is folded into the insert, and a
+        # delete cancels both.
+        new_task = Task(tasklist_id="tl-0", title="New")
+        local_id = self.queue.enqueue(BatchOperation(BatchOperation.INSERT,
+            new_task))
+        self.assertTrue(local_id.startswith(WriteBehindQueue.LOCAL_ID_PREFIX))
+
+        new_task.entity_id = local_id
+        new_task.title = "New, renamed"
+        self.queue.enqueue(BatchOperation(BatchOperation.UPDATE, new_task))
+        self.assertEqual(1, len(self.queue.pending_operations))
+        self.assertEqual("New, renamed",
+            self.queue.pending_operations[0].entity.title)
+
+        self.queue.enqueue(BatchOperation(BatchOperation.DELETE, new_task))
+        self.assertEqual([], self.queue.pending_operations)
+
+    def test_insert_child_of_inserted_task(self):
+        parent_id = self.queue.enqueue(BatchOperation(BatchOperation.INSERT,
+            Task(tasklist_id="tl-0", title="Parent")))
+        self.queue.enqueue(BatchOperation(BatchOperation.INSERT,
+            Task(tasklist_id="tl-0", title="Child", parent_id=parent_id)))
+
+        self.assertTrue(self.queue.flush())
+
+        # The child should have been inserted under the parent's real ID.
+        parent_operation, parent = self.completed[0]
+        child_operation, child = self.completed[1]
+        self.assertEqual(parent_id, parent_operation.entity.entity_id)
+        self.assertNotEqual(parent_id, parent.entity_id)
+        self.assertEqual(parent.entity_id, child.parent_id)
+
+    def test_update_after_update_uses_latest_etag(self):
+        task = self._get_task()
+        task.title = "First"
+        self.queue.enqueue(BatchOperation(BatchOperation.UPDATE, task))
+        self.assertTrue(self.queue.flush())
+
+        # The task still has its original etag, which the service no longer
+        # accepts.
+        task.title = "Second"
+        self.queue.enqueue(BatchOperation(BatchOperation.UPDATE, task))
+        self.assertTrue(self.queue.flush())
+
+        self.assertEqual([], self.failed)
+        self.assertEqual("Second", self.task_str_dicts["tl-0"][0][GoogleKeywords.TITLE])
+
+    def test_update_does_not_send_etag(self):
+        # The latest etag is only sent as a condition, not as a modified 
+        # property of a task that was loaded from the service.
+        bodies = list()
+        original_patch = self.task_proxy.patch
+        def patch(tasklist, task, body):
+            bodies.append(dict(body))
+            return original_patch(tasklist=tasklist, task=task, body=body)
+        self.task_proxy.patch = patch
+
+        task = Task.from_str_dict(dict(self.task_str_dicts["tl-0"][0]))
+        task.tasklist_id = "tl-0"
+        for title in ("First", "Second"):
+            task.title = title
+            self.queue.enqueue(BatchOperation(BatchOperation.UPDATE, task))
+            self.assertTrue(self.queue.flush())
+
+        self.assertEqual([], self.failed)
+        self.assertEqual([{GoogleKeywords.TITLE: "First"},
+            {GoogleKeywords.TITLE: "Second"}], bodies)
+
+    def test_skip_in_flight_operations(self):
+        task = self._get_task()
+        task.title = "First"
+        self.queue.enqueue(BatchOperation(BatchOperation.UPDATE, task))
+
+        # Pretend the update is being sent by another flush. A later update 
+        # to the same task has to wait for it.
+        self.queue._in_flight.add(self.queue._entries[0][0])
+        task.title = "Second"
+        self.queue.enqueue(BatchOperation(BatchOperation.UPDATE, task))
+        self.assertEqual(2, len(self.queue.pending_operations))
+
+        self.assertTrue(self.queue.flush())
+        self.assertEqual(0, self.task_proxy.execute_count)
+
+        self.queue._in_flight.clear()
+        self.assertTrue(self.queue.flush())
+        self.assertEqual([], self.failed)
+        self.assertEqual("Second", self.task_str_dicts["tl-0"][0][GoogleKeywords.TITLE])
+
+    def test_retry_temporary_failure(self):
+        def fail(*args, **kwargs):
+            raise httplib2.ServerNotFoundError("Offline")
+        original_execute_batch = self.task_service.execute_batch
+        self.task_service.execute_batch = fail
+
+        self.queue.enqueue(BatchOperation(BatchOperation.DELETE, self._get_task()))
+        self.assertFalse(self.queue.flush())
+        self.assertEqual(1, len(self.queue.pending_operations))
+
+        self.task_service.execute_batch = original_execute_batch
+        self.assertTrue(self.queue.flush())
+        self.assertEqual(1, len(self.completed))
+
+    def test_drop_rejected_operation(self):
+        self.queue.enqueue(BatchOperation(BatchOperation.DELETE,
+            self._get_task("missing")))
+
+        self.assertTrue(self.queue.flush())
+
+        self.assertEqual(1, len(self.failed))
+        self.assertEqual([], self.queue.pending_operations)
+
+    def test_background_flush(self):
+        flushed = threading.Event()
+        self.queue.operation_completed.register(
+            lambda operation, result: flushed.set())
+        self.queue.start()
+
+        self.queue.enqueue(BatchOperation(BatchOperation.INSERT,
+            Task(tasklist_id="tl-0", title="New")))
+
+        flushed.wait(5)
+        self.assertTrue(flushed.is_set())
+        self.queue.stop()
+#------------------------------------------------------------------------------
+
+class WriteBehindQueuePersistenceTest(unittest.TestCase):
+    def test_pending_operations_reloaded(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, "outbox.db")
+            queue = WriteBehindQueue(None, None, path=path)
+            local_id = queue.enqueue(BatchOperation(BatchOperation.INSERT,
+                Task(tasklist_id="tl-0", title="New")))
+            queue.enqueue(BatchOperation(BatchOperation.MOVE,
+                Task(tasklist_id="tl-0", entity_id="t-0", title="Task 0"),
+                parent_id=local_id))
+            queue.close()
+
+            queue = WriteBehindQueue(None, None, path=path)
+            operations = queue.pending_operations
+            queue.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+        self.assertEqual([BatchOperation.INSERT, BatchOperation.MOVE],
+            [operation.operation for operation in operations])
+        self.assertEqual(local_id, operations[0].entity.entity_id)
+        self.assertEqual("tl-0", operations[0].entity.tasklist_id)
+        self.assertEqual(local_id, operations[1].parent_id)
+#------------------------------------------------------------------------------
@@ -12,20 +12,320 @@ from datetime import datetime
 from coggrinder.entities.properties import TaskStatus, IntConverter, \
     TaskStatusConverter, StrConverter, RFC3339Converter, BooleanConverter
 from coggrinder.utilities import GoogleKeywords
-import apiclient.discovery
+from coggrinder.entities.tree import Tree, EntityChanges
+from coggrinder.cache_services import TaskCacheService, DiscoveryDocumentCache
+import multiprocessing.pool
+import threading
+import time
+import apiclient.errors
+import apiclient.http
+import httplib2
+
+class BatchOperation(object):
+    """
+    A single entity mutation (insert, update, delete, or move) to be executed
+    as part of a batch request. 
+    """
+    INSERT = "insert"
+    UPDATE = "update"
+    DELETE = "delete"
+    MOVE = "move"
+
+    def __init__(self, operation, entity, parent_id=None, previous_id=None,
+            if_match=None):
+        """
+        Args:
+            operation: One of the INSERT, UPDATE, DELETE, or MOVE operations.
+            entity: The entity to be mutated.
+            parent_id: For a task move, the ID of the new parent task, or None
+                to move the task to the top level of its tasklist. 
+            previous_id: For a task move, the ID of the sibling task that the
+                moved task will follow, or None to move it to the first 
+                position.
+            if_match: For an update, the etag that the update is conditional
+                on, or None to use the entity's own etag.
+        """
+        assert operation in (BatchOperation.INSERT, BatchOperation.UPDATE,
+            BatchOperation.DELETE, BatchOperation.MOVE)
+        assert entity is not None
+
+        self.operation = operation
+        self.entity = entity
+        self.parent_id = parent_id
+        self.previous_id = previous_id
+        self.if_match = if_match
+
+    def __str__(self):
+        return "BatchOperation: ({0}, {1})".format(self.operation,
+            self.entity.entity_id)
+
+    def __repr__(self):
+        return self.__str__()
+#------------------------------------------------------------------------------ 
+
+class BatchOperationError(Exception):
+    """
+    Raised when one or more operations in a batch failed. All of the 
+    operations in the batch are still attempted.
+    
+    Attributes:
+        results: List of the results of each operation, in the same order as 
+            the operations. Failed operations have a None result.
+        errors: Dict of the exceptions raised by the failed operations, keyed 
+            by the index of the operation.
+    """
+    def __init__(self, results, errors):
+        self.results = results
+        self.errors = errors
+
+        Exception.__init__(self, "{0} of {1} batch operations failed: {2}".format(
+            len(errors), len(results), errors))
+#------------------------------------------------------------------------------ 
+
+class EntityConflictError(Exception):
+    """
+    Raised when an entity could not be updated because it was changed on the
+    server since it was last retrieved (its etag no longer matches).
+    """
+#------------------------------------------------------------------------------ 
 
 class AuthenticatedService(object):
-    def __init__(self, service_proxy):
+    _ABSTRACT_ERROR_MESSAGE = "Abstract method cannot be called."
+
+    # Maximum number of requests packed into a single batch request.
+    MAX_BATCH_SIZE = 100
+
+    # HTTP statuses for conditional requests.
+    _NOT_MODIFIED = 304
+    _NOT_FOUND = 404
+    _PRECONDITION_FAILED = 412
+
+    def __init__(self, service_proxy, batch_request_factory=None):
         self.service_proxy = service_proxy
+
+        # Default to the real Google API batch request.
+        if batch_request_factory is None:
+            batch_request_factory = apiclient.http.BatchHttpRequest
+        self.batch_request_factory = batch_request_factory
+
+        # Most recent results of each list request, keyed by a request key.
+        # Each entry is a tuple of the request arguments, the etag of the 
+        # results, the next page token, and the IDs of the listed entities. 
+        # The entities themselves aren't kept; the caller rebuilds them from
+        # its own copies when the results are unchanged.
+        self._list_results = dict()
+
+    @staticmethod
+    def _get_etag(entity):
+        """Get the entity's etag, or None if there's no entity or the entity's
+        etag is unset.
+        """
+        if entity is None:
+            return None
+
+        return getattr(entity, "e_tag", None)
+
+    @staticmethod
+    def _get_operation_etag(operation):
+        """Get the etag that the batch operation is conditional on, or None
+        if there is no etag.
+        """
+        if operation.if_match is not None:
+            return operation.if_match
+
+        return AuthenticatedService._get_etag(operation.entity)
+
+    def _execute(self, request, if_none_match=None, if_match=None):
+        """
+        Execute the request, optionally making it conditional on the etag of 
+        the requested resource.
+        
+        Args:
+            request: The (unexecuted) service request.
+            if_none_match: Optional etag of the local copy of the resource. If
+                the resource is unchanged, no response is downloaded.
+            if_match: Optional etag of the local copy of the resource, which 
+                the resource must still match for the request to succeed.
+
+        Returns:
+            The response, or None if the resource matched if_none_match (was
+            not modified).
+
+        Raises:
+            EntityConflictError if the resource no longer matches if_match.
+        """
+        if if_none_match is not None:
+            request.headers["If-None-Match"] = if_none_match
+        if if_match is not None:
+            request.headers["If-Match"] = if_match
+
+        try:
+            return request.execute()
+        except apiclient.errors.HttpError as error:
+            if (if_none_match is not None 
+                    and error.resp.status == AuthenticatedService._NOT_MODIFIED):
+                return None
+
+            conflict_error = self._translate_error(error)
+            if conflict_error is not error:
+                raise conflict_error
+            raise
+
+    @staticmethod
+    def _translate_error(error):
+        """Translate a failed precondition into an EntityConflictError; any 
+        other error is returned as-is.
+        """
+        if (isinstance(error, apiclient.errors.HttpError) 
+                and error.resp.status == AuthenticatedService._PRECONDITION_FAILED):
+            return EntityConflictError(
+                "The entity was modified on the server: {0}".format(error))
+
+        return error
+
+    def _execute_list(self, request_key, request_kwargs, request, decode,
+            get_unchanged=None):
+        """
+        Execute a list request, making it conditional on the etag of the 
+        previous results of the same request (if any), and decode the 
+        results. 
+        
+        Args:
+            request_key: Identifies the list request; only the most recent 
+                results for each key are kept.
+            request_kwargs: The arguments the request was created with.
+            request: The (unexecuted) list request.
+            decode: Function that converts the list results str dict into a
+                list of entities.
+            get_unchanged: Optional function, called with the list of IDs of
+                the previously listed entities, that returns the caller's own
+                copies of those entities (in the same order) for when the 
+                results are unchanged, or None if it doesn't have all of them.
+                The request is only made conditional if this is provided.
+
+        Returns:
+            A tuple of the list of entities and the next page token (or None).
+            If the results are unchanged, the entities returned by 
+            get_unchanged are returned.
+        """
+        previous_results = self._list_results.get(request_key)
+        if_none_match = None
+        if (get_unchanged is not None and previous_results is not None 
+                and previous_results[0] == request_kwargs):
+            if_none_match = previous_results[1]
+
+        list_results_str_dict = self._execute(request, if_none_match=if_none_match)
+        if list_results_str_dict is None:
+            entities = get_unchanged(previous_results[3])
+            if entities is not None:
+                return entities, previous_results[2]
+
+            # The results have to be downloaded again after all.
+            del request.headers["If-None-Match"]
+            list_results_str_dict = self._execute(request)
+
+        entities = decode(list_results_str_dict)
+        next_page_token = list_results_str_dict.get(GoogleKeywords.NEXT_PAGE_TOKEN)
+
+        etag = list_results_str_dict.get(GoogleKeywords.ETAG)
+        if etag is not None:
+            self._list_results[request_key] = (dict(request_kwargs), etag,
+                next_page_token, [entity.entity_id for entity in entities])
+        else:
+            self._list_results.pop(request_key, None)
+
+        return entities, next_page_token
+
+    def execute_batch(self, operations):
+        """
+        Execute the operations, packing them into as few batch requests as 
+        possible, and decode the result of each operation.
+
+        Operations within a single batch may be executed by the service in 
+        any order, so operations that depend on each other should be executed
+        in separate calls.
+
+        Returns:
+            A list of the results of each operation, in the same order as the
+            operations.
+
+        Raises:
+            BatchOperationError if any of the operations failed.
+        """
+        operations = list(operations)
+        requests = [self._create_batch_request(operation)
+            for operation in operations]
+
+        results = list()
+        errors = dict()
+        for index, (response, exception) in enumerate(
+                self._execute_requests(requests)):
+            if exception is None:
+                results.append(self._decode_batch_response(operations[index],
+                    response))
+            else:
+                results.append(None)
+                errors[index] = exception
+
+        if errors:
+            raise BatchOperationError(results, errors)
+
+        return results
+
+    def _execute_requests(self, requests):
+        """
+        Execute the requests in batches of at most MAX_BATCH_SIZE requests.
+
+        Returns:
+            A list of (response, exception) tuples, one per request, in the 
+            same order as the requests.
+        """
+        responses = [None] * len(requests)
+
+        def handle_response(request_id, response, exception):
+            if exception is not None:
+                exception = self._translate_error(exception)
+            responses[int(request_id)] = (response, exception)
+
+        for start_index in range(0, len(requests), self.MAX_BATCH_SIZE):
+            batch_request = self.batch_request_factory(callback=handle_response)
+            for index in range(start_index,
+                    min(start_index + self.MAX_BATCH_SIZE, len(requests))):
+                batch_request.add(requests[index], request_id=str(index))
+
+            batch_request.execute()
+
+        return responses
+
+    def _create_batch_request(self, operation):
+        """
+        Create the (unexecuted) service request for the batch operation.
+        """
+        raise NotImplementedError(AuthenticatedService._ABSTRACT_ERROR_MESSAGE)
+
+    def _decode_batch_response(self, operation, response):
+        """
+        Convert the service response for the batch operation into a result.
+        """
+        raise NotImplementedError(AuthenticatedService._ABSTRACT_ERROR_MESSAGE)
 #------------------------------------------------------------------------------ 
 
 class TaskService(AuthenticatedService):
-    def get_task(self, tasklist_id, task_id):   
+    def get_task(self, tasklist_id, task_id, cached_task=None):   
+        """
+        Get the task. If a cached copy of the task is provided, the task is
+        only downloaded if it has changed since; otherwise, the cached task is
+        returned.
+        """
         assert (task_id is not None 
             and tasklist_id is not None)  
            
-        result_str_dict = self.service_proxy.get(tasklist=tasklist_id, 
-            task=task_id).execute()
+        result_str_dict = self._execute(self.service_proxy.get(
+            tasklist=tasklist_id, task=task_id),
+            if_none_match=self._get_etag(cached_task))
+        if result_str_dict is None:
+            return cached_task
+
         task = Task.from_str_dict(result_str_dict)
         
         return task
@@ -66,18 +366,28 @@ class TaskService(AuthenticatedService):
         self.service_proxy.delete(tasklist=task.tasklist_id, 
             task=task.entity_id).execute()
         
-        # Refresh the task by getting updated properties from the server.
-        task = self.get_task(task.tasklist_id, task.entity_id)        
+        # The service doesn't return anything for a delete, so flag the local
+        # task as deleted rather than fetching it again.
+        task.is_deleted = True
         
         return task
     
     def update_task(self, task):
+        """
+        Update the task. Only the properties that have been modified since 
+        the task was retrieved are sent (as a patch). If the task has an etag,
+        the update only succeeds if the task hasn't been changed on the server
+        since it was retrieved.
+        
+        Raises:
+            EntityConflictError if the task was changed on the server.
+        """
         assert (task is not None 
             and task.entity_id is not None 
             and task.tasklist_id is not None)
         
-        # Create a str dict that holds the task's updated properties.
-        update_str_dict = task.to_str_dict()
+        # Create a str dict that holds the task's modified properties.
+        update_str_dict = task.get_modified_str_dict()
         
         # Store the tasklist ID temporarily as it will be lost in the Task
         # object as it is re-created with the Google service update response.
@@ -85,9 +395,9 @@ class TaskService(AuthenticatedService):
         
         # Execute the update operation and capture the resulting str dict, 
         # which contains the up-to-date values for the task properties.
-        update_result_str_dict = self.service_proxy.update(
-            tasklist=tasklist_id, task=task.entity_id,
-            body=update_str_dict).execute()
+        update_result_str_dict = self._execute(self.service_proxy.patch(
+            tasklist=tasklist_id, task=task.entity_id, body=update_str_dict),
+            if_match=self._get_etag(task))
         
         # Replace the Task with a new Task populated with the updated 
         # properties.
@@ -96,33 +406,368 @@ class TaskService(AuthenticatedService):
         
         return task
     
+    def _create_batch_request(self, operation):
+        task = operation.entity
+        assert task.tasklist_id is not None
+
+        if operation.operation == BatchOperation.INSERT:
+            request_kwargs = dict()
+            if task.parent_id is not None:
+                request_kwargs["parent"] = task.parent_id
+
+            # Only send the properties that can be set on a new task; in 
+            # particular, the (local) ID is assigned by the service.
+            keywords = coggrinder.utilities.GoogleKeywords
+            insert_str_dict = coggrinder.utilities.DictUtilities.filter_dict(
+                task.to_str_dict(), (keywords.TITLE, keywords.NOTES,
+                    keywords.STATUS, keywords.DUE, keywords.COMPLETED))
+
+            request = self.service_proxy.insert(tasklist=task.tasklist_id,
+                body=insert_str_dict, **request_kwargs)
+        else:
+            assert task.entity_id is not None
+
+            if operation.operation == BatchOperation.UPDATE:
+                request = self.service_proxy.patch(tasklist=task.tasklist_id,
+                    task=task.entity_id, body=task.get_modified_str_dict())
+
+                # Detect concurrent changes to the task.
+                etag = self._get_operation_etag(operation)
+                if etag is not None:
+                    request.headers["If-Match"] = etag
+            elif operation.operation == BatchOperation.DELETE:
+                request = self.service_proxy.delete(tasklist=task.tasklist_id,
+                    task=task.entity_id)
+            elif operation.operation == BatchOperation.MOVE:
+                # Leaving out the parent or previous sibling moves the task to
+                # the top level or first position, respectively.
+                request_kwargs = dict()
+                if operation.parent_id is not None:
+                    request_kwargs["parent"] = operation.parent_id
+                if operation.previous_id is not None:
+                    request_kwargs["previous"] = operation.previous_id
+
+                request = self.service_proxy.move(tasklist=task.tasklist_id,
+                    task=task.entity_id, **request_kwargs)
+
+        return request
+
+    def _decode_batch_response(self, operation, response):
+        if operation.operation == BatchOperation.DELETE:
+            # The service doesn't return anything for a delete, so flag the 
+            # local task as deleted rather than fetching it again.
+            task = operation.entity
+            task.is_deleted = True
+        else:
+            # Re-create the task from the updated properties returned by the
+            # service, restoring the (locally maintained) tasklist ID.
+            task = Task.from_str_dict(response)
+            task.tasklist_id = operation.entity.tasklist_id
+
+        return task
+
     def get_tasks_in_tasklist(self, tasklist):     
         """
         Return a dictionary of all tasks belonging to the specified tasklist. 
         Dictionary keys will be entity IDs, values will be the corresponding 
         task instances.
         """   
-        # Execute the list operation and store the resulting str dict, which 
-        # contains an array/list of results stored under an "items" key.
-        assert (tasklist is not None and tasklist.entity_id is not None)
-        list_results_str_dict = self.service_proxy.list(tasklist=tasklist.entity_id).execute()
-        
         tasks = dict()
+        for task in self.iter_tasks_in_tasklist(tasklist):
+            tasks[task.entity_id] = task
         
-        # Check to see if the tasklist has any assigned tasks.
-        if list_results_str_dict.has_key(GoogleKeywords.ITEMS):               
-            for task_str_dict in list_results_str_dict.get(GoogleKeywords.ITEMS):
+        return tasks
+
+    def iter_tasks_in_tasklist(self, tasklist, max_results=None,
+            updated_min=None, show_deleted=False, show_hidden=False,
+            get_local_tasks=None):
+        """
+        Generate each task belonging to the specified tasklist, following the
+        list results across as many pages as the service returns. Tasks are 
+        yielded as each page arrives, so only a single page of results is 
+        held at a time.
+        
+        Args:
+            tasklist: The tasklist to list the tasks of.
+            max_results: Optional maximum number of tasks to request per page.
+                The service default is used if this is not provided.
+            updated_min: Optional datetime; only tasks updated at or after 
+                this time are listed.
+            show_deleted: Whether deleted tasks are listed.
+            show_hidden: Whether hidden (cleared) tasks are listed.
+            get_local_tasks: Optional function (called without arguments) 
+                that returns the local copies of the tasks matching the 
+                listing. If provided, a page that hasn't changed since it was
+                last listed isn't downloaded again; the local copies of the 
+                tasks on that page are yielded in its place instead, in the 
+                same order. The page is downloaded after all if any of its 
+                tasks has no local copy. Each listed task is yielded once, 
+                as in a listing without get_local_tasks.
+        """
+        assert (tasklist is not None and tasklist.entity_id is not None)
+
+        # Only pass the paging and filtering arguments when they're actually
+        # needed.
+        list_kwargs = dict()
+        if max_results is not None:
+            list_kwargs["maxResults"] = max_results
+        if updated_min is not None:
+            list_kwargs["updatedMin"] = RFC3339Converter().to_str(updated_min)
+        if show_deleted:
+            list_kwargs["showDeleted"] = True
+        if show_hidden:
+            list_kwargs["showHidden"] = True
+
+        def decode(list_results_str_dict):
+            tasks = list()
+            for task_str_dict in list_results_str_dict.get(GoogleKeywords.ITEMS, ()):
                 # Create a Task to represent the result captured in the str dict.
                 task = Task.from_str_dict(task_str_dict)
-                
+
                 # Set the tasklist id (this property is maintained locally per
                 # session, not provided by the Google service.
                 task.tasklist_id = tasklist.entity_id
-                
-                # Add the resulting Task to the results list.
-                tasks[task.entity_id] = task
-        
-        return tasks
+
+                tasks.append(task)
+
+            return tasks
+
+        get_unchanged = None
+        if get_local_tasks is not None:
+            def get_unchanged(task_ids):
+                # The local tasks are only gathered once, however many pages
+                # are unchanged.
+                if get_unchanged.local_tasks is None:
+                    get_unchanged.local_tasks = dict((task.entity_id, task)
+                        for task in get_local_tasks())
+                local_tasks = get_unchanged.local_tasks
+
+                if not all(task_id in local_tasks for task_id in task_ids):
+                    return None
+
+                return [local_tasks[task_id] for task_id in task_ids]
+            get_unchanged.local_tasks = None
+
+        while True:
+            # Execute the list operation. The results (the tasks on the page,
+            # and a page token if more results are available) are only 
+            # downloaded if they changed since the last time this page was
+            # listed.
+            tasks, next_page_token = self._execute_list(
+                (tasklist.entity_id, list_kwargs.get("pageToken")), list_kwargs,
+                self.service_proxy.list(tasklist=tasklist.entity_id,
+                    **list_kwargs), decode, get_unchanged)
+
+            for task in tasks:
+                yield task
+
+            if next_page_token is None:
+                break
+
+            list_kwargs["pageToken"] = next_page_token
+#------------------------------------------------------------------------------ 
+
+class FakeTaskServiceProxy(object):
+    """
+    Stands in for the Google Tasks tasks() service proxy, serving requests 
+    from a local collection of task str dicts in the same way the real service
+    does (list results are served in pages). Each request is only carried out
+    when it's executed.
+    """
+    DEFAULT_MAX_RESULTS = 20
+
+    class Request(object):
+        def __init__(self, service_proxy, handler):
+            self.service_proxy = service_proxy
+            self.handler = handler
+            self.headers = dict()
+
+        def execute(self):
+            self.service_proxy.execute_count += 1
+            if self.service_proxy.latency:
+                time.sleep(self.service_proxy.latency)
+
+            return self.handler(self.headers)
+
+    @staticmethod
+    def check_etag(headers, etag):
+        """Raise the HTTP error the service responds with if the etag doesn't 
+        satisfy the conditional request headers.
+        """
+        if "If-None-Match" in headers and headers["If-None-Match"] == etag:
+            FakeTaskServiceProxy._raise_http_error(
+                AuthenticatedService._NOT_MODIFIED)
+        if headers.get("If-Match", etag) != etag:
+            FakeTaskServiceProxy._raise_http_error(
+                AuthenticatedService._PRECONDITION_FAILED)
+
+    @staticmethod
+    def _raise_http_error(status):
+        raise apiclient.errors.HttpError(httplib2.Response({"status": status}),
+            "")
+
+    def __init__(self, task_str_dicts, latency=0):
+        """
+        Args:
+            task_str_dicts: Dict of task str dict lists, keyed by tasklist ID.
+            latency: Seconds that each request takes to execute, simulating 
+                a network round trip.
+        """
+        self.task_str_dicts = task_str_dicts
+        self.latency = latency
+        self.list_calls = list()
+        self.execute_count = 0
+
+    def list(self, tasklist, pageToken=None, maxResults=None, updatedMin=None,
+            showDeleted=False, showHidden=False):
+        self.list_calls.append((tasklist, pageToken, maxResults, updatedMin))
+
+        if maxResults is None:
+            maxResults = FakeTaskServiceProxy.DEFAULT_MAX_RESULTS
+
+        # Page tokens are simply the (str) index of the first item of the 
+        # page.
+        start_index = 0
+        if pageToken is not None:
+            start_index = int(pageToken)
+        end_index = start_index + maxResults
+
+        def handle_list(headers):
+            items = [task_str_dict for task_str_dict
+                in self.task_str_dicts.get(tasklist, [])
+                if self._is_listed(task_str_dict, updatedMin, showDeleted,
+                    showHidden)]
+            result = {GoogleKeywords.ITEMS: items[start_index:end_index]}
+            if end_index < len(items):
+                result[GoogleKeywords.NEXT_PAGE_TOKEN] = str(end_index)
+
+            # The etag of the results is derived from the etags of the tasks
+            # they include.
+            result[GoogleKeywords.ETAG] = str(hash(tuple(
+                task_str_dict.get(GoogleKeywords.ETAG) 
+                for task_str_dict in result[GoogleKeywords.ITEMS])))
+            FakeTaskServiceProxy.check_etag(headers, result[GoogleKeywords.ETAG])
+
+            return result
+
+        return FakeTaskServiceProxy.Request(self, handle_list)
+
+    def get(self, tasklist, task):
+        def handle_get(headers):
+            task_str_dict = self._find_task_str_dict(tasklist, task)
+            FakeTaskServiceProxy.check_etag(headers,
+                task_str_dict.get(GoogleKeywords.ETAG))
+
+            return dict(task_str_dict)
+
+        return FakeTaskServiceProxy.Request(self, handle_get)
+
+    def insert(self, tasklist, body, parent=None):
+        def handle_insert(headers):
+            task_str_dict = dict(body)
+            task_str_dict[GoogleKeywords.ID] = "new-{0}".format(
+                self.execute_count)
+            task_str_dict[GoogleKeywords.ETAG] = "fake-etag-{0}".format(
+                self.execute_count)
+            if parent is not None:
+                task_str_dict[GoogleKeywords.PARENT] = parent
+            self.task_str_dicts.setdefault(tasklist, []).append(task_str_dict)
+
+            return task_str_dict
+
+        return FakeTaskServiceProxy.Request(self, handle_insert)
+
+    def patch(self, tasklist, task, body):
+        def handle_patch(headers):
+            task_str_dict = self._find_task_str_dict(tasklist, task)
+            FakeTaskServiceProxy.check_etag(headers,
+                task_str_dict.get(GoogleKeywords.ETAG))
+
+            # Properties patched with None are cleared.
+            for key, value in body.items():
+                if value is None:
+                    task_str_dict.pop(key, None)
+                else:
+                    task_str_dict[key] = value
+            task_str_dict[GoogleKeywords.ETAG] = "fake-etag-{0}".format(
+                self.execute_count)
+
+            return task_str_dict
+
+        return FakeTaskServiceProxy.Request(self, handle_patch)
+
+    def delete(self, tasklist, task):
+        def handle_delete(headers):
+            self._find_task_str_dict(tasklist, task)[GoogleKeywords.DELETED] = "True"
+
+            return ""
+
+        return FakeTaskServiceProxy.Request(self, handle_delete)
+
+    def move(self, tasklist, task, parent=None, previous=None):
+        def handle_move(headers):
+            task_str_dict = self._find_task_str_dict(tasklist, task)
+            if parent is None:
+                task_str_dict.pop(GoogleKeywords.PARENT, None)
+            else:
+                task_str_dict[GoogleKeywords.PARENT] = parent
+
+            return task_str_dict
+
+        return FakeTaskServiceProxy.Request(self, handle_move)
+
+    def _is_listed(self, task_str_dict, updated_min, show_deleted, show_hidden):
+        boolean_converter = BooleanConverter()
+        if (not show_deleted and boolean_converter.from_str(
+                task_str_dict.get(GoogleKeywords.DELETED, ""))):
+            return False
+        if (not show_hidden and boolean_converter.from_str(
+                task_str_dict.get(GoogleKeywords.HIDDEN, ""))):
+            return False
+        if updated_min is not None:
+            rfc_converter = RFC3339Converter()
+            updated_date = rfc_converter.from_str(
+                task_str_dict.get(GoogleKeywords.UPDATED))
+            if (updated_date is None 
+                    or updated_date < rfc_converter.from_str(updated_min)):
+                return False
+
+        return True
+
+    def _find_task_str_dict(self, tasklist, task):
+        for task_str_dict in self.task_str_dicts.get(tasklist, []):
+            if task_str_dict[GoogleKeywords.ID] == task:
+                return task_str_dict
+
+        # The service responds to a missing task with Not Found.
+        FakeTaskServiceProxy._raise_http_error(404)
+#------------------------------------------------------------------------------ 
+
+class FakeBatchHttpRequest(object):
+    """
+    Stands in for apiclient.http.BatchHttpRequest, executing each of the 
+    added requests in turn when the batch is executed. Keeps track of each
+    batch created, in order to verify how requests were batched.
+    """
+    created_batches = list()
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = list()
+
+        FakeBatchHttpRequest.created_batches.append(self)
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        for request_id, request in self.requests:
+            try:
+                response = request.execute()
+            except Exception as exception:
+                self.callback(request_id, None, exception)
+            else:
+                self.callback(request_id, response, None)
 #------------------------------------------------------------------------------ 
 
 class TaskServiceTest(unittest.TestCase):
@@ -188,6 +833,233 @@ class TaskServiceTest(unittest.TestCase):
         
         self.assertEqual(expected_tasks, actual_tasks) 
     
+    def test_iter_tasks_in_tasklist_multiple_pages(self):
+        tasklist = TaskList(entity_id="abclistid")
+        task_str_dicts = [Task(entity_id=str(count),
+            title="Test Task " + str(count)).to_str_dict()
+            for count in range(45)]
+        
+        fake_service_proxy = FakeTaskServiceProxy(
+            {tasklist.entity_id: task_str_dicts})
+        task_service = TaskService(fake_service_proxy)
+        
+        actual_tasks = list(task_service.iter_tasks_in_tasklist(tasklist,
+            max_results=10))
+        
+        self.assertEqual([str(count) for count in range(45)],
+            [task.entity_id for task in actual_tasks])
+        self.assertTrue(all(task.tasklist_id == tasklist.entity_id
+            for task in actual_tasks))
+        self.assertEqual([None, "10", "20", "30", "40"],
+            [list_call[1] for list_call in fake_service_proxy.list_calls])
+        
+    def test_iter_tasks_in_tasklist_streams_pages(self):
+        # Only the first page should be requested before the first task is
+        # yielded.
+        tasklist = TaskList(entity_id="abclistid")
+        task_str_dicts = [Task(entity_id=str(count),
+            title="Test Task " + str(count)).to_str_dict()
+            for count in range(50)]
+        
+        fake_service_proxy = FakeTaskServiceProxy(
+            {tasklist.entity_id: task_str_dicts})
+        task_service = TaskService(fake_service_proxy)
+        
+        next(task_service.iter_tasks_in_tasklist(tasklist))
+        
+        self.assertEqual(1, len(fake_service_proxy.list_calls))
+        
+    def test_get_tasks_in_tasklist_multiple_pages(self):
+        tasklist = TaskList(entity_id="abclistid")
+        task_str_dicts = [Task(entity_id=str(count),
+            title="Test Task " + str(count)).to_str_dict()
+            for count in range(25)]
+        
+        task_service = TaskService(FakeTaskServiceProxy(
+            {tasklist.entity_id: task_str_dicts}))
+        
+        actual_tasks = task_service.get_tasks_in_tasklist(tasklist)
+        
+        self.assertEqual(set(str(count) for count in range(25)),
+            set(actual_tasks.keys()))
+
+    def test_execute_batch(self):
+        tasklist = TaskList(entity_id="abclistid")
+        task_str_dicts = [Task(entity_id=str(count), tasklist_id=tasklist.entity_id,
+            title="Test Task " + str(count)).to_str_dict()
+            for count in range(3)]
+        fake_service_proxy = FakeTaskServiceProxy(
+            {tasklist.entity_id: task_str_dicts})
+        task_service = TaskService(fake_service_proxy,
+            batch_request_factory=FakeBatchHttpRequest)
+        
+        updated_task = Task.from_str_dict(task_str_dicts[0])
+        updated_task.tasklist_id = tasklist.entity_id
+        updated_task.title = "Updated title"
+        deleted_task = Task.from_str_dict(task_str_dicts[1])
+        deleted_task.tasklist_id = tasklist.entity_id
+        moved_task = Task.from_str_dict(task_str_dicts[2])
+        moved_task.tasklist_id = tasklist.entity_id
+        new_task = Task(tasklist_id=tasklist.entity_id, entity_id="local-1",
+            title="New task", updated_date=datetime(2012, 3, 21, 13, 52, 6))
+        
+        results = task_service.execute_batch((
+            BatchOperation(BatchOperation.UPDATE, updated_task),
+            BatchOperation(BatchOperation.DELETE, deleted_task),
+            BatchOperation(BatchOperation.MOVE, moved_task,
+                parent_id=updated_task.entity_id),
+            BatchOperation(BatchOperation.INSERT, new_task)))
+        
+        self.assertEqual("Updated title", results[0].title)
+        self.assertTrue(results[1].is_deleted)
+        self.assertEqual(updated_task.entity_id, results[2].parent_id)
+        self.assertEqual("New task", results[3].title)
+        self.assertNotEqual(new_task.entity_id, results[3].entity_id)
+        self.assertNotIn(GoogleKeywords.UPDATED,
+            fake_service_proxy.task_str_dicts[tasklist.entity_id][-1])
+        self.assertTrue(all(result.tasklist_id == tasklist.entity_id
+            for result in results))
+        
+    def test_execute_batch_chunks_requests(self):
+        # Deleting 250 tasks should only take three batch requests.
+        tasklist = TaskList(entity_id="abclistid")
+        tasks = [Task(entity_id=str(count), tasklist_id=tasklist.entity_id,
+            title="Test Task " + str(count)) for count in range(250)]
+        fake_service_proxy = FakeTaskServiceProxy(
+            {tasklist.entity_id: [task.to_str_dict() for task in tasks]})
+        task_service = TaskService(fake_service_proxy,
+            batch_request_factory=FakeBatchHttpRequest)
+        del FakeBatchHttpRequest.created_batches[:]
+        
+        results = task_service.execute_batch([BatchOperation(
+            BatchOperation.DELETE, task) for task in tasks])
+        
+        self.assertEqual(tasks, results)
+        self.assertEqual([100, 100, 50], [len(batch.requests)
+            for batch in FakeBatchHttpRequest.created_batches])
+        
+    def test_execute_batch_failed_operation(self):
+        tasklist = TaskList(entity_id="abclistid")
+        existing_task = Task(entity_id="1", tasklist_id=tasklist.entity_id,
+            title="Test Task")
+        missing_task = Task(entity_id="2", tasklist_id=tasklist.entity_id,
+            title="Missing Task")
+        task_service = TaskService(FakeTaskServiceProxy(
+            {tasklist.entity_id: [existing_task.to_str_dict()]}),
+            batch_request_factory=FakeBatchHttpRequest)
+        
+        with self.assertRaises(BatchOperationError) as context:
+            task_service.execute_batch((
+                BatchOperation(BatchOperation.DELETE, missing_task),
+                BatchOperation(BatchOperation.DELETE, existing_task)))
+        
+        self.assertEqual([None, existing_task], context.exception.results)
+        self.assertEqual([0], context.exception.errors.keys())
+
+    def test_get_task_not_modified(self):
+        tasklist = TaskList(entity_id="abclistid")
+        task = Task(entity_id="1", tasklist_id=tasklist.entity_id,
+            title="Test Task")
+        task.e_tag = "etag-1"
+        fake_service_proxy = FakeTaskServiceProxy(
+            {tasklist.entity_id: [task.to_str_dict()]})
+        task_service = TaskService(fake_service_proxy)
+        
+        # An unchanged task should not be downloaded again.
+        cached_task = task_service.get_task(tasklist.entity_id, task.entity_id)
+        self.assertIs(cached_task, task_service.get_task(tasklist.entity_id,
+            task.entity_id, cached_task))
+        
+        # A changed task should be.
+        fake_service_proxy.task_str_dicts[tasklist.entity_id][0][
+            GoogleKeywords.ETAG] = "etag-2"
+        self.assertEqual("etag-2", task_service.get_task(tasklist.entity_id,
+            task.entity_id, cached_task).e_tag)
+        
+    def test_iter_tasks_in_tasklist_not_modified(self):
+        tasklist = TaskList(entity_id="abclistid")
+        task_str_dicts = list()
+        for count in range(25):
+            task = Task(entity_id=str(count), title="Test Task " + str(count))
+            task.e_tag = "etag-{0}".format(count)
+            task_str_dicts.append(task.to_str_dict())
+        fake_service_proxy = FakeTaskServiceProxy(
+            {tasklist.entity_id: task_str_dicts})
+        task_service = TaskService(fake_service_proxy)
+        
+        first_tasks = list(task_service.iter_tasks_in_tasklist(tasklist,
+            max_results=10))
+        
+        # Change a task on the first and last pages; only the tasks on the 
+        # unchanged (middle) page should be made up from the local tasks, and
+        # each task should be listed once.
+        for index in (0, 24):
+            task_str_dicts[index][GoogleKeywords.TITLE] = "Updated title"
+            task_str_dicts[index][GoogleKeywords.ETAG] = "etag-updated"
+        second_tasks = list(task_service.iter_tasks_in_tasklist(tasklist,
+            max_results=10, get_local_tasks=lambda: first_tasks))
+        
+        self.assertEqual([str(count) for count in range(25)],
+            [task.entity_id for task in second_tasks])
+        for first_task, second_task in zip(first_tasks, second_tasks):
+            if 10 <= int(first_task.entity_id) < 20:
+                self.assertIs(first_task, second_task)
+            else:
+                self.assertIsNot(first_task, second_task)
+        self.assertEqual("Updated title", second_tasks[0].title)
+        self.assertEqual("Updated title", second_tasks[24].title)
+
+        # An unchanged page is downloaded again if a task on it has no local
+        # copy.
+        third_tasks = list(task_service.iter_tasks_in_tasklist(tasklist,
+            max_results=10, get_local_tasks=lambda: second_tasks[:15]))
+
+        self.assertEqual([str(count) for count in range(25)],
+            [task.entity_id for task in third_tasks])
+        self.assertIsNot(second_tasks[10], third_tasks[10])
+        self.assertEqual("Updated title", second_tasks[-1].title)
+        
+    def test_update_task_conflict(self):
+        tasklist = TaskList(entity_id="abclistid")
+        task = Task(entity_id="1", tasklist_id=tasklist.entity_id,
+            title="Test Task")
+        task.e_tag = "etag-1"
+        fake_service_proxy = FakeTaskServiceProxy(
+            {tasklist.entity_id: [task.to_str_dict()]})
+        task_service = TaskService(fake_service_proxy)
+        
+        # Update the task once (changing its etag on the server), then try to
+        # update the (now stale) original task again.
+        updated_task = task_service.update_task(task)
+        
+        self.assertNotEqual(task.e_tag, updated_task.e_tag)
+        with self.assertRaises(EntityConflictError):
+            task_service.update_task(task)
+        
+    def test_update_task_modified_properties(self):
+        task_str_dict = {GoogleKeywords.ID: "t-0",
+            GoogleKeywords.TITLE: "Task 0", GoogleKeywords.NOTES: "Notes"}
+        task = Task.from_str_dict(task_str_dict)
+        task.tasklist_id = "tl-0"
+        task.title = "Updated title"
+
+        # Only the modified title should be sent.
+        expected_body = {GoogleKeywords.TITLE: "Updated title"}
+        mock_service_proxy = mock()
+        mock_patch_request = mock()
+        when(mock_service_proxy).patch(tasklist="tl-0", task="t-0",
+            body=expected_body).thenReturn(mock_patch_request)
+        when(mock_patch_request).execute().thenReturn(
+            dict(task_str_dict, **expected_body))
+
+        task = TaskService(mock_service_proxy).update_task(task)
+
+        verify(mock_service_proxy).patch(tasklist="tl-0", task="t-0",
+            body=expected_body)
+        self.assertEqual("Updated title", task.title)
+        self.assertEqual("Notes", task.notes)
+        self.assertEqual({}, task.get_modified_str_dict())
+
     def test_update_task_simple(self):
         # IDs used to specify which task to delete and get.
         tasklist = TaskList()
@@ -231,7 +1103,7 @@ class TaskServiceTest(unittest.TestCase):
         
         # Set up service proxy mock behavior in order to provide the update
         # method with the necessary backend.
-        when(mock_service_proxy).update(tasklist=tasklist.entity_id, task=input_task.entity_id, body=any(dict)).thenReturn(mock_update_request)
+        when(mock_service_proxy).patch(tasklist=tasklist.entity_id, task=input_task.entity_id, body=any(dict)).thenReturn(mock_update_request)
         when(mock_update_request).execute().thenReturn(update_result_str_dict)
         
         # Create a new TaskService.
@@ -290,67 +1162,39 @@ class TaskServiceTest(unittest.TestCase):
         self.assertEqual(expected_task_status, actual_task.task_status)
     
     def test_delete_task(self):
-        # IDs used to specify which task to delete and get.
+        # IDs used to specify which task to delete.
         tasklist = TaskList()
         tasklist.entity_id = "tasklistid"
         
-        # Fake an updated update date by capturing a date, adding five minutes,
-        # and using that new date as the date source for a str dict that is
-        # returned by the fake service proxy?
-        existing_updated_date = datetime(2012, 3, 21, 13, 52, 06)
-        expected_updated_date = datetime(2012, 3, 21, 13, 57, 06)
-        
         input_task = Task()
         input_task.entity_id = "abcid"
         input_task.tasklist_id = tasklist.entity_id
         input_task.title = "Task title"
-        input_task.position = 10456 
         input_task.task_status = TaskStatus.COMPLETED
-        input_task.updated_date = existing_updated_date
-        
-        expected_task = Task()
-        expected_task.entity_id = input_task.entity_id
-        expected_task.title = input_task.entity_id
-        expected_task.position = input_task.position
-        expected_task.task_status = input_task.task_status
-        expected_task.updated_date = expected_updated_date
+        input_task.updated_date = datetime(2012, 3, 21, 13, 52, 06)
         
         # Mock service and request objects.
         mock_service_proxy = mock()
         mock_delete_request = mock()
-        mock_get_request = mock()
-        
-        # Note that this str dict serves as the result of a subsequent get 
-        # called on the same task after that task has been deleted. It includes
-        # the expected (mock updated) update date.
-        get_result_str_dict = {
-            GoogleKeywords.ID: StrConverter().to_str(expected_task.entity_id),
-            GoogleKeywords.TITLE: StrConverter().to_str(expected_task.title),
-            GoogleKeywords.UPDATED: RFC3339Converter().to_str(expected_updated_date),
-            GoogleKeywords.POSITION: IntConverter().to_str(expected_task.position),
-            GoogleKeywords.STATUS: TaskStatusConverter().to_str(expected_task.task_status),
-            GoogleKeywords.DELETED: BooleanConverter().to_str(True)
-        }
         
         # Set up service proxy mock behavior in order to provide the delete
         # method with the necessary backend.
         when(mock_service_proxy).delete(tasklist=tasklist.entity_id, task=input_task.entity_id).thenReturn(mock_delete_request)
         when(mock_delete_request).execute().thenReturn("")
-        when(mock_service_proxy).get(tasklist=tasklist.entity_id, task=input_task.entity_id).thenReturn(mock_get_request)
-        when(mock_get_request).execute().thenReturn(get_result_str_dict)
         
         # Create a new TaskService.
         task_service = TaskService(mock_service_proxy)
         
-        # Delete the task, and store the updated results.
+        # Delete the task.
         actual_task = task_service.delete_task(input_task)
         
-        # Task should be present and have these updated properties:
-        # * update date
-        # * deleted
+        # The task should be flagged as deleted, without being fetched again
+        # from the server.
         self.assertIsNotNone(actual_task)
-        self.assertEqual(expected_updated_date, actual_task.updated_date)
-        self.assertTrue(actual_task.is_deleted, True)
+        self.assertEqual(input_task.entity_id, actual_task.entity_id)
+        self.assertTrue(actual_task.is_deleted)
+        verify(mock_service_proxy, times=0).get(tasklist=tasklist.entity_id,
+            task=input_task.entity_id)
         
     @unittest.skip("Waiting for task tree to be completed before working on this method.")
     def test_move_task_change_parent_task(self):
@@ -392,27 +1236,50 @@ class TaskServiceTest(unittest.TestCase):
 #------------------------------------------------------------------------------
 
 class TaskListService(AuthenticatedService):    
-    def get_all_tasklists(self):     
+    def get_all_tasklists(self, get_local_tasklists=None):     
         """
         Return a dictionary of all tasklists available. Dictionary keys will be
         entity IDs, values will be the corresponding tasklist instances.
+
+        Args:
+            get_local_tasklists: Optional function (called without arguments)
+                that returns the local copies of all tasklists. If provided,
+                the tasklists are only downloaded if they've changed since 
+                they were last listed; otherwise, the local tasklists are 
+                returned.
         """   
-        tasklist_items_dict = self.service_proxy.list().execute()
-        
-        assert tasklist_items_dict.has_key(coggrinder.utilities.GoogleKeywords.ITEMS)
-        
-        tasklist_items_list = tasklist_items_dict.get(coggrinder.utilities.GoogleKeywords.ITEMS)
+        def decode(tasklist_items_dict):
+            assert tasklist_items_dict.has_key(coggrinder.utilities.GoogleKeywords.ITEMS)
+            
+            tasklist_items_list = tasklist_items_dict.get(coggrinder.utilities.GoogleKeywords.ITEMS)
+            
+            return [TaskList.from_str_dict(tasklist_dict) 
+                for tasklist_dict in tasklist_items_list]
+
+        # All of the local tasklists are used in place of unchanged results.
+        get_unchanged = None
+        if get_local_tasklists is not None:
+            get_unchanged = lambda tasklist_ids: get_local_tasklists()
+
+        tasklists, next_page_token = self._execute_list(None, {},
+            self.service_proxy.list(), decode, get_unchanged)
         
         tasklist_result_list = dict()
-        for tasklist_dict in tasklist_items_list:
-            tasklist = TaskList.from_str_dict(tasklist_dict)
-            
+        for tasklist in tasklists:
             tasklist_result_list[tasklist.entity_id] = tasklist
          
         return tasklist_result_list
     
-    def get_tasklist(self, entity_id):        
-        tasklist_dict = self.service_proxy.get(tasklist=entity_id).execute()
+    def get_tasklist(self, entity_id, cached_tasklist=None):        
+        """
+        Get the tasklist. If a cached copy of the tasklist is provided, the 
+        tasklist is only downloaded if it has changed since; otherwise, the
+        cached tasklist is returned.
+        """
+        tasklist_dict = self._execute(self.service_proxy.get(tasklist=entity_id),
+            if_none_match=self._get_etag(cached_tasklist))
+        if tasklist_dict is None:
+            return cached_tasklist
         
         tasklist = TaskList.from_str_dict(tasklist_dict)
         
@@ -446,26 +1313,59 @@ class TaskListService(AuthenticatedService):
     def update_tasklist(self, tasklist):
         """
         This method updates the TaskList using a patch command rather than a
-        full update.
-        TODO: Enhance this method to only update fields that have been locally
-        modified.
+        full update, sending only the properties that have been modified since
+        the TaskList was retrieved.
         """
-        tasklist_dict = tasklist.to_str_dict()
+        tasklist_dict = tasklist.get_modified_str_dict()
                 
-        # Create a dict with only the 'title' and 'id' properties.   
+        # Create a dict with only the 'title' property (if modified).   
         keywords = coggrinder.utilities.GoogleKeywords
         filtered_update_dict = coggrinder.utilities.DictUtilities.filter_dict(tasklist_dict,
-            (keywords.TITLE, keywords.ID))
+            (keywords.TITLE,))
         
         # Execute the update operation.
-        result_dict = self.service_proxy.patch(tasklist=tasklist.entity_id,
-            body=filtered_update_dict).execute()
+        result_dict = self._execute(self.service_proxy.patch(
+            tasklist=tasklist.entity_id, body=filtered_update_dict),
+            if_match=self._get_etag(tasklist))
 
         # Convert the resulting dict (which contains updated values  from the 
         # service) back into a TaskList object.
         tasklist = TaskList.from_str_dict(result_dict)
 
         return tasklist
+
+    def _create_batch_request(self, operation):
+        tasklist = operation.entity
+
+        # Tasklists only accept a title on insert, and a (modified) title on 
+        # update (see add_tasklist and update_tasklist).
+        keywords = coggrinder.utilities.GoogleKeywords
+        if operation.operation == BatchOperation.INSERT:
+            request = self.service_proxy.insert(
+                body=coggrinder.utilities.DictUtilities.filter_dict(
+                    tasklist.to_str_dict(), (keywords.TITLE,)))
+        elif operation.operation == BatchOperation.UPDATE:
+            request = self.service_proxy.patch(tasklist=tasklist.entity_id,
+                body=coggrinder.utilities.DictUtilities.filter_dict(
+                    tasklist.get_modified_str_dict(), (keywords.TITLE,)))
+
+            # Detect concurrent changes to the tasklist.
+            etag = self._get_operation_etag(operation)
+            if etag is not None:
+                request.headers["If-Match"] = etag
+        elif operation.operation == BatchOperation.DELETE:
+            request = self.service_proxy.delete(tasklist=tasklist.entity_id)
+        else:
+            raise ValueError("Tasklists do not support the {0} operation.".format(
+                operation.operation))
+
+        return request
+
+    def _decode_batch_response(self, operation, response):
+        if operation.operation == BatchOperation.DELETE:
+            return operation.entity
+
+        return TaskList.from_str_dict(response)
 #------------------------------------------------------------------------------  
 
 class TaskListServiceTest(unittest.TestCase):
@@ -564,14 +1464,914 @@ class TaskListServiceTest(unittest.TestCase):
         verify(mock_delete_request).execute()
 #------------------------------------------------------------------------------ 
 
+class TaskTreeService(object):
+    """
+    Maintains the local copy of the user's tasklists and tasks, and keeps it
+    in sync with the Google Tasks services.
+    
+    After the first (full) refresh of a tasklist, later refreshes only ask for
+    the tasks that have changed since the most recent update seen in that 
+    tasklist (its "high-water mark"), including tasks that were deleted or 
+    hidden, and merge those changes into the local tasks. The cost of a 
+    refresh is then proportional to the number of changes rather than to the
+    size of the account.
+
+    The changes merged by refreshes (and by loading the cache) are collected 
+    until they're taken with take_entity_changes, to be applied to the task 
+    tree shown in the UI.
+    
+    If a cache service is provided, the changes made by each refresh are 
+    saved to it, and the saved data can be loaded (along with the high-water
+    marks) at startup. A refresh can be run from a background thread; the 
+    local data is only locked while the fetched changes are merged into it
+    (or, for a full refresh or a cache load, while the data built beforehand
+    is swapped in), so local operations can be applied (e.g., from the main
+    loop) while the refresh is waiting on the network.
+    
+    The tasklists are fetched concurrently by a pool of at most max_workers
+    threads, so a refresh takes roughly as long as the slowest tasklist. A 
+    tasklist that can't be fetched within fetch_timeout seconds keeps its 
+    previous local tasks, and is listed in stale_tasklist_ids until a later
+    refresh succeeds.
+    """
+    # Tasks are listed in pages of the maximum size allowed by the service, to
+    # keep the number of round trips down.
+    LIST_PAGE_SIZE = 100
+    DEFAULT_MAX_WORKERS = 8
+    DEFAULT_FETCH_TIMEOUT = 60
+
+    def __init__(self, tasklist_service=None, task_service=None,
+            cache_service=None, max_workers=DEFAULT_MAX_WORKERS,
+            fetch_timeout=DEFAULT_FETCH_TIMEOUT):
+        self.tasklist_service = tasklist_service
+        self.task_service = task_service
+        self.cache_service = cache_service
+        self.max_workers = max_workers
+        self.fetch_timeout = fetch_timeout
+
+        self.tasklists = dict()
+        self.tasks = dict()
+        self.stale_tasklist_ids = set()
+
+        # Latest task updated date seen for each tasklist, keyed by tasklist
+        # ID.
+        self._high_water_marks = dict()
+
+        # IDs of the tasks updated at each tasklist's high-water mark, keyed 
+        # by tasklist ID. An unchanged listing of a tasklist's changes is made
+        # up from these tasks, rather than from all of the local tasks.
+        self._high_water_mark_task_ids = dict()
+
+        # IDs of the entities changed by refreshes and cache loads, since the
+        # changes were last taken.
+        self._changed_entity_ids = set()
+
+        # Whether the cache holds the local data as of the last save (or 
+        # load), so that only the changes since then need to be saved.
+        self._is_cache_synced = False
+
+        # Serializes refreshes, and guards the local data, respectively.
+        self._refresh_lock = threading.Lock()
+        self._data_lock = threading.Lock()
+        self._worker_pool = None
+
+    def close(self):
+        """Shut down the worker pool used to fetch tasklists."""
+        if self._worker_pool is not None:
+            self._worker_pool.terminate()
+            self._worker_pool = None
+
+    def load_cache(self):
+        """
+        Replace the local tasklists and tasks with those stored in the cache,
+        without contacting the Google Task services.
+        """
+        assert self.cache_service is not None
+
+        # Only the loaded data is swapped in under the lock.
+        tasklists, tasks, high_water_marks = self.cache_service.load()
+
+        with self._data_lock:
+            previous_tasklists, previous_tasks = self.tasklists, self.tasks
+
+            self.tasklists, self.tasks = tasklists, tasks
+            self._high_water_marks = high_water_marks
+            self._high_water_mark_task_ids = dict()
+            self._is_cache_synced = True
+
+            self._changed_entity_ids.update(tasklists)
+            self._changed_entity_ids.update(tasks)
+            self._changed_entity_ids.update(previous_tasklists)
+            self._changed_entity_ids.update(previous_tasks)
+
+    def take_entity_changes(self):
+        """
+        Collect the changes made to the local tasklists and tasks by the 
+        refreshes and cache loads since the last call. (The changes made by 
+        apply_operation and apply_operation_result are returned by those 
+        instead.)
+
+        Each changed entity is reported as it is now, so no change is lost or
+        applied out of order, even when the results of a refresh have been 
+        discarded.
+
+        Returns:
+            The EntityChanges, to be applied to the task tree.
+        """
+        with self._data_lock:
+            changed_entity_ids = self._changed_entity_ids
+            self._changed_entity_ids = set()
+
+            updated_entities = list()
+            removed_entity_ids = list()
+            for entity_id in changed_entity_ids:
+                entity = self.tasklists.get(entity_id)
+                if entity is None:
+                    entity = self.tasks.get(entity_id)
+
+                if entity is None:
+                    removed_entity_ids.append(entity_id)
+                else:
+                    updated_entities.append(entity)
+
+        return EntityChanges(updated_entities, removed_entity_ids)
+
+    def refresh(self, full=False):
+        """
+        Pull updated tasklist and task information from the Google Task 
+        services, and merge it into the local tasklists and tasks.
+        
+        Args:
+            full: If True, discard the local data and download every task 
+                again.
+        """
+        with self._refresh_lock:
+            return self._refresh(full)
+
+    def _refresh(self, full):
+        with self._data_lock:
+            if full:
+                high_water_marks = dict()
+            else:
+                high_water_marks = dict(self._high_water_marks)
+            previous_stale_tasklist_ids = set(self.stale_tasklist_ids)
+
+        tasklists = self.tasklist_service.get_all_tasklists(
+            self._get_local_tasklists)
+
+        # Fetch the changes to each tasklist concurrently, and then merge them
+        # (from this thread) in to the local tasks.
+        if self._worker_pool is None:
+            self._worker_pool = multiprocessing.pool.ThreadPool(self.max_workers)
+
+        # Unchanged results are made up from the local tasks, except for a 
+        # full refresh, and for a tasklist whose previous fetch timed out (as
+        # its results may have been listed, but never merged).
+        pending_fetches = [(tasklist, self._worker_pool.apply_async(
+            self._fetch_tasklist_changes, (tasklist,
+                high_water_marks.get(tasklist.entity_id), not full 
+                    and tasklist.entity_id not in previous_stale_tasklist_ids)))
+            for tasklist in tasklists.values()]
+
+        # The timeout applies to each fetch from the time the results are
+        # first waited on.
+        fetched_changes = list()
+        stale_tasklist_ids = set()
+        for tasklist, pending_fetch in pending_fetches:
+            try:
+                changed_tasks, high_water_mark = pending_fetch.get(
+                    self.fetch_timeout)
+            except multiprocessing.TimeoutError:
+                stale_tasklist_ids.add(tasklist.entity_id)
+                continue
+
+            fetched_changes.append((tasklist, changed_tasks, high_water_mark))
+
+        if full:
+            # A full refresh lists every task of the tasklists that were 
+            # fetched, so their replacement is built before the local data is
+            # locked.
+            replacement_tasks = dict()
+            for tasklist, changed_tasks, high_water_mark in fetched_changes:
+                for task in changed_tasks:
+                    if not (task.is_deleted or task.is_hidden):
+                        replacement_tasks[task.entity_id] = task
+
+        with self._data_lock:
+            updated_entities = list()
+            for tasklist_id, tasklist in tasklists.items():
+                local_tasklist = self.tasklists.get(tasklist_id)
+                if self._is_entity_changed(local_tasklist, tasklist):
+                    updated_entities.append(tasklist)
+                else:
+                    # Keep the local tasklist, which the task tree holds.
+                    tasklists[tasklist_id] = local_tasklist
+            self._changed_entity_ids.update(tasklist.entity_id 
+                for tasklist in updated_entities)
+
+            # The tasks of a tasklist that no longer exists are removed along
+            # with it.
+            removed_tasklist_ids = set(tasklist_id for tasklist_id 
+                in self.tasklists if tasklist_id not in tasklists)
+            removed_tasklist_ids.update(tasklist_id for tasklist_id 
+                in self._high_water_marks if tasklist_id not in tasklists)
+            removed_entity_ids = list(removed_tasklist_ids)
+            for tasklist_id in removed_tasklist_ids:
+                self._high_water_marks.pop(tasklist_id, None)
+                self._high_water_mark_task_ids.pop(tasklist_id, None)
+
+            self.tasklists = tasklists
+            self.stale_tasklist_ids = stale_tasklist_ids
+
+            if full:
+                # Tasklists that couldn't be fetched keep their previous tasks
+                # (and high-water marks). Only then do the local tasks need to
+                # be gone through here.
+                if stale_tasklist_ids:
+                    for task_id, task in self.tasks.iteritems():
+                        if task.tasklist_id in stale_tasklist_ids:
+                            replacement_tasks[task_id] = task
+                self._high_water_marks = dict((tasklist_id, high_water_mark)
+                    for tasklist_id, high_water_mark 
+                    in self._high_water_marks.iteritems()
+                    if tasklist_id in stale_tasklist_ids)
+
+                previous_tasks, self.tasks = self.tasks, replacement_tasks
+                updated_entities.extend(replacement_tasks.itervalues())
+                self._changed_entity_ids.update(replacement_tasks)
+            else:
+                if removed_tasklist_ids:
+                    self.tasks = dict((task_id, task) for task_id, task 
+                        in self.tasks.iteritems() 
+                        if task.tasklist_id not in removed_tasklist_ids)
+
+                updated_tasks = list()
+                for tasklist, changed_tasks, high_water_mark in fetched_changes:
+                    self._merge_tasklist_changes(changed_tasks, updated_tasks,
+                        removed_entity_ids)
+                updated_entities.extend(updated_tasks)
+                self._changed_entity_ids.update(task.entity_id 
+                    for task in updated_tasks)
+
+            for tasklist, changed_tasks, high_water_mark in fetched_changes:
+                self._set_high_water_mark(tasklist, changed_tasks, 
+                    high_water_mark)
+            self._changed_entity_ids.update(removed_entity_ids)
+
+            # Until the cache holds the local data, all of it is saved.
+            is_cache_replaced = not self._is_cache_synced
+            if is_cache_replaced:
+                updated_entities = self.tasklists.values() + self.tasks.values()
+                removed_entity_ids = list()
+
+            high_water_marks = dict(self._high_water_marks)
+
+        if full:
+            # The previous tasks are no longer changed by anything else, so 
+            # the tasks that are gone can be found without the lock.
+            removed_task_ids = [task_id for task_id, task 
+                in previous_tasks.iteritems() 
+                if task_id not in replacement_tasks 
+                    and task.tasklist_id not in removed_tasklist_ids]
+            with self._data_lock:
+                self._changed_entity_ids.update(removed_task_ids)
+            if not is_cache_replaced:
+                removed_entity_ids.extend(removed_task_ids)
+
+        if self.cache_service is not None:
+            self.cache_service.save(updated_entities, removed_entity_ids,
+                high_water_marks, replace=is_cache_replaced)
+            self._is_cache_synced = True
+
+    def _fetch_tasklist_changes(self, tasklist, high_water_mark,
+            use_local_tasks):
+        """
+        Fetch the tasks in the tasklist that have changed since the 
+        high-water mark (or all tasks, if there is no mark yet). Run from the
+        worker pool, so this must not modify any local data.
+
+        Args:
+            use_local_tasks: Whether pages of the listing that are unchanged
+                since they were last listed can be made up from the local 
+                tasks, rather than downloaded again.
+        Returns:
+            A tuple of the list of changed tasks, and the new high-water mark.
+        """
+        get_local_tasks = None
+        if use_local_tasks:
+            get_local_tasks = lambda: self._get_local_tasks(
+                tasklist.entity_id, high_water_mark)
+
+        if high_water_mark is None:
+            # Nothing has been seen from this tasklist yet, so list all of its
+            # (current) tasks.
+            changed_tasks = self.task_service.iter_tasks_in_tasklist(tasklist,
+                max_results=self.LIST_PAGE_SIZE, 
+                get_local_tasks=get_local_tasks)
+        else:
+            # The update bound is inclusive, so tasks updated at the 
+            # high-water mark itself are listed (and merged) again.
+            changed_tasks = self.task_service.iter_tasks_in_tasklist(tasklist,
+                max_results=self.LIST_PAGE_SIZE, updated_min=high_water_mark,
+                show_deleted=True, show_hidden=True,
+                get_local_tasks=get_local_tasks)
+
+        changed_tasks = list(changed_tasks)
+        for task in changed_tasks:
+            if (task.updated_date is not None
+                    and (high_water_mark is None 
+                        or task.updated_date > high_water_mark)):
+                high_water_mark = task.updated_date
+
+        return changed_tasks, high_water_mark
+
+    def _get_local_tasklists(self):
+        with self._data_lock:
+            return self.tasklists.values()
+
+    def _get_local_tasks(self, tasklist_id, updated_min=None):
+        """
+        Find the local tasks in the tasklist that were updated at or after
+        updated_min (or all of them, if updated_min is None). Safe to call 
+        from the worker pool.
+        """
+        with self._data_lock:
+            high_water_mark_task_ids = self._high_water_mark_task_ids.get(
+                tasklist_id)
+            if (high_water_mark_task_ids is not None and updated_min is not None
+                    and updated_min == self._high_water_marks.get(tasklist_id)):
+                # These are the tasks that were listed from the mark the last
+                # time.
+                return [self.tasks[task_id] for task_id 
+                    in high_water_mark_task_ids if task_id in self.tasks]
+
+            tasks = self.tasks.values()
+
+        return [task for task in tasks if task.tasklist_id == tasklist_id 
+            and (updated_min is None or (task.updated_date is not None 
+                and task.updated_date >= updated_min))]
+
+    def apply_operation(self, operation):
+        """
+        Apply a (not yet sent) operation to the local tasklists and tasks, so
+        that the change can be shown before the Google Task services have 
+        accepted it.
+
+        Returns:
+            The EntityChanges made, to be applied to the task tree.
+        """
+        with self._data_lock:
+            entity = operation.entity
+            entities = self._get_local_entities(entity)
+
+            if operation.operation == BatchOperation.DELETE:
+                entities.pop(entity.entity_id, None)
+                if isinstance(entity, TaskList):
+                    self.tasks = dict((task_id, task) for task_id, task 
+                        in self.tasks.items()
+                        if task.tasklist_id != entity.entity_id)
+
+                return EntityChanges(removed_entity_ids=[entity.entity_id])
+
+            if operation.operation == BatchOperation.MOVE:
+                entity.parent_id = operation.parent_id
+            entities[entity.entity_id] = entity
+
+            return EntityChanges([entity])
+
+    def apply_operation_result(self, operation, result):
+        """
+        Replace the local copy of an operation's entity with the result sent 
+        back by the Google Task services. For an insert, this replaces the 
+        entity's local ID with the ID assigned by the services.
+
+        Returns:
+            The EntityChanges made, to be applied to the task tree.
+        """
+        if operation.operation == BatchOperation.DELETE:
+            return EntityChanges()
+
+        with self._data_lock:
+            local_id = operation.entity.entity_id
+            entities = self._get_local_entities(result)
+            entities.pop(local_id, None)
+            entities[result.entity_id] = result
+
+            if local_id == result.entity_id:
+                return EntityChanges([result])
+
+            for task in self.tasks.values():
+                if task.parent_id == local_id:
+                    task.parent_id = result.entity_id
+                if task.tasklist_id == local_id:
+                    task.tasklist_id = result.entity_id
+
+            return EntityChanges([result],
+                replaced_entity_ids={local_id: result.entity_id})
+
+    def revert_operation(self, operation):
+        """
+        Undo an operation that was applied with apply_operation, but then
+        rejected by the Google Task services. An inserted entity is removed;
+        any other entity is downloaded again (or removed, if it no longer 
+        exists), so this should be run from a background thread.
+
+        Returns:
+            The EntityChanges made, to be applied to the task tree.
+        """
+        entity = operation.entity
+        if operation.operation == BatchOperation.INSERT:
+            current_entity = None
+        else:
+            current_entity = self._download_entity(entity)
+
+        with self._data_lock:
+            entities = self._get_local_entities(entity)
+            if current_entity is None:
+                entities.pop(entity.entity_id, None)
+                if isinstance(entity, TaskList):
+                    self.tasks = dict((task_id, task) for task_id, task 
+                        in self.tasks.items()
+                        if task.tasklist_id != entity.entity_id)
+
+                return EntityChanges(removed_entity_ids=[entity.entity_id])
+
+            if (operation.operation == BatchOperation.DELETE 
+                    and isinstance(entity, TaskList)):
+                # The tasklist's tasks were removed along with it, so the next
+                # refresh lists all of them again.
+                self._high_water_marks.pop(entity.entity_id, None)
+                self._high_water_mark_task_ids.pop(entity.entity_id, None)
+                self.stale_tasklist_ids.add(entity.entity_id)
+
+            entities[current_entity.entity_id] = current_entity
+
+            return EntityChanges([current_entity])
+
+    def _download_entity(self, entity):
+        """
+        Download the current version of the entity, or return None if it no
+        longer exists.
+        """
+        try:
+            if isinstance(entity, TaskList):
+                return self.tasklist_service.get_tasklist(entity.entity_id)
+
+            task = self.task_service.get_task(entity.tasklist_id,
+                entity.entity_id)
+        except apiclient.errors.HttpError as error:
+            if error.resp.status == AuthenticatedService._NOT_FOUND:
+                return None
+            raise
+
+        if task.is_deleted or task.is_hidden:
+            return None
+
+        task.tasklist_id = entity.tasklist_id
+
+        return task
+
+    def _get_local_entities(self, entity):
+        if isinstance(entity, TaskList):
+            return self.tasklists
+
+        return self.tasks
+
+    @staticmethod
+    def _is_entity_changed(local_entity, entity):
+        # Entities listed as unchanged are the local ones, and the tasks at a
+        # high-water mark are listed again (as equal copies) every refresh.
+        return local_entity is None or (local_entity is not entity 
+            and local_entity != entity)
+
+    def _merge_tasklist_changes(self, changed_tasks, updated_entities,
+            removed_entity_ids):
+        """
+        Merge the changed tasks into the local tasks, adding the tasks that 
+        were actually updated or removed to the lists.
+        """
+        for task in changed_tasks:
+            if task.is_deleted or task.is_hidden:
+                if self.tasks.pop(task.entity_id, None) is not None:
+                    removed_entity_ids.append(task.entity_id)
+            elif self._is_entity_changed(self.tasks.get(task.entity_id), task):
+                self.tasks[task.entity_id] = task
+                updated_entities.append(task)
+
+    def _set_high_water_mark(self, tasklist, changed_tasks, high_water_mark):
+        if high_water_mark is not None:
+            self._high_water_marks[tasklist.entity_id] = high_water_mark
+            self._high_water_mark_task_ids[tasklist.entity_id] = [
+                task.entity_id for task in changed_tasks 
+                if task.updated_date == high_water_mark]
+#------------------------------------------------------------------------------ 
+
+class FakeTaskListServiceProxy(object):
+    """
+    Stands in for the Google Tasks tasklists() service proxy, listing a local 
+    collection of tasklist str dicts.
+    """
+    def __init__(self, tasklist_str_dicts, latency=0):
+        self.tasklist_str_dicts = tasklist_str_dicts
+        self.latency = latency
+        self.execute_count = 0
+
+    def list(self):
+        return FakeTaskServiceProxy.Request(self, lambda headers:
+            {GoogleKeywords.ITEMS: list(self.tasklist_str_dicts)})
+
+    def get(self, tasklist):
+        def handle_get(headers):
+            for tasklist_str_dict in self.tasklist_str_dicts:
+                if tasklist_str_dict[GoogleKeywords.ID] == tasklist:
+                    return dict(tasklist_str_dict)
+
+            FakeTaskServiceProxy._raise_http_error(404)
+
+        return FakeTaskServiceProxy.Request(self, handle_get)
+#------------------------------------------------------------------------------ 
+
+class TaskTreeServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.tasklist = TaskList(entity_id="tl-0", title="TaskList 0")
+        self.task_str_dicts = [Task(entity_id="t-{0}".format(count),
+            title="Task {0}".format(count), 
+            updated_date=datetime(2012, 5, 1, 12, 0, count)).to_str_dict()
+            for count in range(30)]
+
+        self.task_service_proxy = FakeTaskServiceProxy(
+            {self.tasklist.entity_id: self.task_str_dicts})
+        self.tasktree_service = TaskTreeService(
+            TaskListService(FakeTaskListServiceProxy(
+                [self.tasklist.to_str_dict()])),
+            TaskService(self.task_service_proxy))
+
+        # Stands in for the task tree shown in the UI.
+        self.tasktree = Tree.from_tasks({}, {})
+
+    def tearDown(self):
+        self.tasktree_service.close()
+
+    def _apply_entity_changes(self, tasktree_service=None):
+        if tasktree_service is None:
+            tasktree_service = self.tasktree_service
+
+        changes = tasktree_service.take_entity_changes()
+        self.tasktree.apply_entity_changes(changes)
+
+        return changes
+
+    def _set_task_properties(self, index, seconds, **properties):
+        self.task_str_dicts[index].update(properties)
+        self.task_str_dicts[index][GoogleKeywords.UPDATED] = \
+            RFC3339Converter().to_str(datetime(2012, 5, 1, 12, 1, seconds))
+
+    def test_refresh_full(self):
+        self.tasktree_service.refresh()
+        changes = self._apply_entity_changes()
+
+        self.assertEqual(30, len(self.tasktree_service.tasks))
+        self.assertEqual(31, len(changes.updated_entities))
+        self.assertTrue(self.tasktree.has_entity_id("t-29"))
+
+    def test_refresh_full_removed_task(self):
+        self.tasktree_service.refresh()
+        self._apply_entity_changes()
+
+        del self.task_str_dicts[5]
+        self.tasktree_service.refresh(full=True)
+        changes = self._apply_entity_changes()
+
+        self.assertEqual(["t-5"], changes.removed_entity_ids)
+        self.assertNotIn("t-5", self.tasktree_service.tasks)
+        self.assertFalse(self.tasktree.has_entity_id("t-5"))
+
+    def test_refresh_incremental(self):
+        """Change, delete and hide tasks after the first refresh, and add a 
+        new task. 
+        
+        Arrange:
+            Refresh the task tree service, then update t-1, delete t-2, hide
+            t-3, and add t-new.
+        Act:
+            Refresh the task tree service again.
+        Assert:
+            That the changes were merged into the local tasks, and that only
+            the changed tasks were listed by the second refresh and taken as
+            changes.
+        """
+        ### Arrange ###
+        self.tasktree_service.refresh()
+        self._apply_entity_changes()
+        list_call_count = len(self.task_service_proxy.list_calls)
+
+        self._set_task_properties(1, 1, title="Updated title")
+        self._set_task_properties(2, 2, deleted="true")
+        self._set_task_properties(3, 3, hidden="true")
+        self.task_str_dicts.append(Task(entity_id="t-new", title="New task",
+            updated_date=datetime(2012, 5, 1, 12, 1, 4)).to_str_dict())
+
+        ### Act ###
+        self.tasktree_service.refresh()
+        changes = self._apply_entity_changes()
+
+        ### Assert ###
+        tasks = self.tasktree_service.tasks
+        self.assertEqual("Updated title", tasks["t-1"].title)
+        self.assertNotIn("t-2", tasks)
+        self.assertNotIn("t-3", tasks)
+        self.assertIn("t-new", tasks)
+        self.assertEqual(29, len(tasks))
+
+        self.assertEqual(["t-1", "t-new"], sorted(entity.entity_id 
+            for entity in changes.updated_entities))
+        self.assertEqual(["t-2", "t-3"], sorted(changes.removed_entity_ids))
+        self.assertTrue(self.tasktree.has_entity_id("t-new"))
+        self.assertFalse(self.tasktree.has_entity_id("t-2"))
+
+        # All five listed tasks (four changes, plus the task at the previous 
+        # high-water mark) fit on a single page.
+        self.assertEqual(list_call_count + 1, 
+            len(self.task_service_proxy.list_calls))
+
+    def test_refresh_unchanged(self):
+        # Once the incremental listing of a tasklist is unchanged, its tasks 
+        # should be made up from the local tasks rather than downloaded.
+        self.tasktree_service.refresh()
+        self.tasktree_service.refresh()
+        self._apply_entity_changes()
+        previous_tasks = dict(self.tasktree_service.tasks)
+
+        self.tasktree_service.refresh()
+        changes = self._apply_entity_changes()
+
+        self.assertEqual(30, len(self.tasktree_service.tasks))
+        self.assertIs(previous_tasks["t-29"], 
+            self.tasktree_service.tasks["t-29"])
+        self.assertEqual(([], []), (changes.updated_entities, 
+            changes.removed_entity_ids))
+
+    def test_refresh_saves_changes(self):
+        # Only the changes made by a refresh should be saved to the cache.
+        cache_service = TaskCacheService(":memory:")
+        saved_entity_ids = list()
+        save = cache_service.save
+        def recording_save(updated_entities, removed_entity_ids, *args, 
+                **kwargs):
+            saved_entity_ids.append((sorted(entity.entity_id 
+                for entity in updated_entities), sorted(removed_entity_ids)))
+            save(updated_entities, removed_entity_ids, *args, **kwargs)
+        cache_service.save = recording_save
+        self.tasktree_service.cache_service = cache_service
+
+        self.tasktree_service.refresh()
+        self._set_task_properties(1, 1, title="Updated title")
+        self._set_task_properties(2, 2, deleted="true")
+        self.tasktree_service.refresh()
+
+        self.assertEqual(31, len(saved_entity_ids[0][0]))
+        self.assertEqual((["t-1"], ["t-2"]), saved_entity_ids[1])
+        self.assertEqual(self.tasktree_service.tasks, cache_service.load()[1])
+
+    def test_load_cache(self):
+        # A new service should be able to pick up (incrementally) from where 
+        # the cached refresh left off.
+        cache_service = TaskCacheService(":memory:")
+        self.tasktree_service.cache_service = cache_service
+        self.tasktree_service.refresh()
+
+        tasktree_service = TaskTreeService(self.tasktree_service.tasklist_service,
+            self.tasktree_service.task_service, cache_service)
+        tasktree_service.load_cache()
+        self._apply_entity_changes(tasktree_service)
+        list_call_count = len(self.task_service_proxy.list_calls)
+        tasktree_service.refresh()
+
+        tasktree_service.close()
+
+        self.assertTrue(self.tasktree.has_entity_id("t-29"))
+        self.assertEqual(self.tasktree_service.tasks, tasktree_service.tasks)
+        self.assertEqual((self.tasklist.entity_id, None, 
+            TaskTreeService.LIST_PAGE_SIZE, RFC3339Converter().to_str(datetime(2012, 5, 1, 12, 0, 29))),
+            self.task_service_proxy.list_calls[list_call_count])
+
+    def test_refresh_concurrent(self):
+        # Spread the tasks over several tasklists, with each request taking
+        # long enough for the fetches to overlap.
+        tasklists = [TaskList(entity_id="tl-{0}".format(count),
+            title="TaskList {0}".format(count)) for count in range(6)]
+        task_str_dicts = dict((tasklist.entity_id, [Task(
+            entity_id="t-{0}-{1}".format(tasklist.entity_id, count),
+            title="Task {0}".format(count)).to_str_dict() for count in range(5)])
+            for tasklist in tasklists)
+
+        in_flight_lock = threading.Lock()
+        in_flight_counts = [0, 0]
+        class ConcurrencyTrackingProxy(FakeTaskServiceProxy):
+            def list(self, *args, **kwargs):
+                request = FakeTaskServiceProxy.list(self, *args, **kwargs)
+                handler = request.handler
+                def tracking_handler(headers):
+                    with in_flight_lock:
+                        in_flight_counts[0] += 1
+                        in_flight_counts[1] = max(in_flight_counts)
+                    time.sleep(0.02)
+                    with in_flight_lock:
+                        in_flight_counts[0] -= 1
+                    return handler(headers)
+                request.handler = tracking_handler
+                return request
+
+        tasktree_service = TaskTreeService(
+            TaskListService(FakeTaskListServiceProxy([tasklist.to_str_dict()
+                for tasklist in tasklists])),
+            TaskService(ConcurrencyTrackingProxy(task_str_dicts)),
+            max_workers=3)
+
+        tasktree_service.refresh()
+        tasktree_service.close()
+
+        self.assertEqual(30, len(tasktree_service.tasks))
+        self.assertGreater(in_flight_counts[1], 1)
+        self.assertLessEqual(in_flight_counts[1], 3)
+
+    def test_refresh_timeout(self):
+        # A tasklist that takes too long to fetch should keep its previous
+        # tasks, and be reported as stale.
+        self.tasktree_service.refresh()
+        self.task_str_dicts[0][GoogleKeywords.TITLE] = "Updated title"
+        self.task_str_dicts[0][GoogleKeywords.UPDATED] = \
+            RFC3339Converter().to_str(datetime(2012, 5, 1, 12, 5, 0))
+
+        self.task_service_proxy.latency = 0.5
+        self.tasktree_service.fetch_timeout = 0.05
+        self.tasktree_service.refresh()
+
+        self.assertEqual(set([self.tasklist.entity_id]),
+            self.tasktree_service.stale_tasklist_ids)
+        self.assertEqual("Task 0", self.tasktree_service.tasks["t-0"].title)
+
+        self.task_service_proxy.latency = 0
+        self.tasktree_service.fetch_timeout = 5
+        self.tasktree_service.refresh()
+
+        self.assertEqual(set(), self.tasktree_service.stale_tasklist_ids)
+        self.assertEqual("Updated title",
+            self.tasktree_service.tasks["t-0"].title)
+
+    def test_refresh_full_timeout(self):
+        # A full refresh should also leave a stale tasklist's previous tasks
+        # in place.
+        self.tasktree_service.refresh()
+
+        self.task_service_proxy.latency = 0.5
+        self.tasktree_service.fetch_timeout = 0.05
+        self.tasktree_service.refresh(full=True)
+
+        self.assertEqual(set([self.tasklist.entity_id]),
+            self.tasktree_service.stale_tasklist_ids)
+        self.assertEqual(30, len(self.tasktree_service.tasks))
+
+    def test_refresh_removed_tasklist(self):
+        self.tasktree_service.refresh()
+
+        self._apply_entity_changes()
+
+        self.tasktree_service.tasklist_service.service_proxy.tasklist_str_dicts = []
+        self.tasktree_service.refresh()
+        changes = self._apply_entity_changes()
+
+        self.assertEqual({}, self.tasktree_service.tasks)
+        self.assertEqual(["tl-0"], changes.removed_entity_ids)
+        self.assertFalse(self.tasktree.has_entity_id("t-0"))
+
+    def test_apply_operation_insert_and_result(self):
+        self.tasktree_service.refresh()
+        self._apply_entity_changes()
+        tree = self.tasktree
+
+        # Add a child task under a new (local) task.
+        local_task = Task(tasklist_id="tl-0", entity_id="local-1", title="New")
+        child_task = Task(tasklist_id="tl-0", entity_id="local-2",
+            title="Child", parent_id="local-1")
+        tree.apply_entity_changes(self.tasktree_service.apply_operation(
+            BatchOperation(BatchOperation.INSERT, local_task)))
+        tree.apply_entity_changes(self.tasktree_service.apply_operation(
+            BatchOperation(BatchOperation.INSERT, child_task)))
+        self.assertEqual("local-1", tree.get_node_for_entity_id(
+            "local-2").parent.value.entity_id)
+
+        # The services assign the new task its real ID.
+        result = Task(tasklist_id="tl-0", entity_id="t-new", title="New")
+        changes = self.tasktree_service.apply_operation_result(BatchOperation(
+            BatchOperation.INSERT, local_task), result)
+        self.assertEqual({"local-1": "t-new"}, changes.replaced_entity_ids)
+        tree.apply_entity_changes(changes)
+
+        tasks = self.tasktree_service.tasks
+        self.assertNotIn("local-1", tasks)
+        self.assertIs(result, tasks["t-new"])
+        self.assertEqual("t-new", tasks["local-2"].parent_id)
+        self.assertFalse(tree.has_entity_id("local-1"))
+        self.assertIs(result, tree.get_node_for_entity_id("t-new").value)
+        self.assertEqual("t-new", tree.get_node_for_entity_id(
+            "local-2").parent.value.entity_id)
+
+    def test_apply_operation_delete_tasklist(self):
+        self.tasktree_service.refresh()
+        self._apply_entity_changes()
+        tree = self.tasktree
+
+        tree.apply_entity_changes(self.tasktree_service.apply_operation(
+            BatchOperation(BatchOperation.DELETE, self.tasklist)))
+
+        self.assertEqual({}, self.tasktree_service.tasklists)
+        self.assertEqual({}, self.tasktree_service.tasks)
+        self.assertFalse(tree.has_entity_id("tl-0"))
+        self.assertFalse(tree.has_entity_id("t-0"))
+
+    def test_revert_operation(self):
+        self.tasktree_service.refresh()
+        self._apply_entity_changes()
+        tree = self.tasktree
+
+        local_task = Task(tasklist_id="tl-0", entity_id="local-1", title="New")
+        updated_task = self.tasktree_service.tasks["t-1"].copy()
+        updated_task.title = "Renamed"
+        deleted_task = self.tasktree_service.tasks["t-2"]
+        operations = (BatchOperation(BatchOperation.INSERT, local_task),
+            BatchOperation(BatchOperation.UPDATE, updated_task),
+            BatchOperation(BatchOperation.DELETE, deleted_task))
+        for operation in operations:
+            tree.apply_entity_changes(
+                self.tasktree_service.apply_operation(operation))
+
+        # The services reject each of the operations.
+        for operation in operations:
+            tree.apply_entity_changes(
+                self.tasktree_service.revert_operation(operation))
+
+        tasks = self.tasktree_service.tasks
+        self.assertNotIn("local-1", tasks)
+        self.assertFalse(tree.has_entity_id("local-1"))
+        self.assertEqual("Task 1", tasks["t-1"].title)
+        self.assertEqual("tl-0", tasks["t-1"].tasklist_id)
+        self.assertIs(tasks["t-1"], tree.get_node_for_entity_id("t-1").value)
+        self.assertIn("t-2", tasks)
+        self.assertTrue(tree.has_entity_id("t-2"))
+
+    def test_revert_operation_missing_task(self):
+        self.tasktree_service.refresh()
+        self._apply_entity_changes()
+
+        # An update to a task that no longer exists is rejected.
+        missing_task = Task(tasklist_id="tl-0", entity_id="missing", 
+            title="Missing")
+        operation = BatchOperation(BatchOperation.UPDATE, missing_task)
+        self.tasktree_service.apply_operation(operation)
+
+        changes = self.tasktree_service.revert_operation(operation)
+
+        self.assertEqual(["missing"], changes.removed_entity_ids)
+        self.assertNotIn("missing", self.tasktree_service.tasks)
+
+    def test_revert_operation_delete_tasklist(self):
+        self.tasktree_service.refresh()
+        self._apply_entity_changes()
+        tree = self.tasktree
+
+        operation = BatchOperation(BatchOperation.DELETE, self.tasklist)
+        tree.apply_entity_changes(
+            self.tasktree_service.apply_operation(operation))
+        tree.apply_entity_changes(
+            self.tasktree_service.revert_operation(operation))
+
+        # The tasklist is back right away, and its tasks after the next 
+        # refresh.
+        self.assertIn("tl-0", self.tasktree_service.tasklists)
+        self.assertTrue(tree.has_entity_id("tl-0"))
+        self.assertEqual({}, self.tasktree_service.tasks)
+
+        self.tasktree_service.refresh()
+        self._apply_entity_changes()
+
+        self.assertEqual(30, len(self.tasktree_service.tasks))
+        self.assertTrue(tree.has_entity_id("t-0"))
+        self.assertEqual(set(), self.tasktree_service.stale_tasklist_ids)
+#------------------------------------------------------------------------------ 
+
 # TODO: Prune this class?
 class GoogleTasksServiceProxy(object):
-    def __init__(self, authenticated_http):
+    def __init__(self, authenticated_http, discovery_cache=None):
         self.authenticated_http = authenticated_http
         
-        # Build the (real) Google Tasks service proxy.
-        self.gtasks_service_proxy = apiclient.discovery.build("tasks", "v1",
-            http=self.authenticated_http)    
+        if discovery_cache is None:
+            discovery_cache = DiscoveryDocumentCache()
+        
+        # Build the (real) Google Tasks service proxy from the cached discovery
+        # document.
+        self.gtasks_service_proxy = discovery_cache.build_service("tasks", "v1",
+            self.authenticated_http)    
 
     def create_tasklist_service(self):        
         assert self.gtasks_service_proxy is not None
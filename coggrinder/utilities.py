@@ -15,6 +15,7 @@ class GoogleKeywords(object):
     
     # Result collection properties
     ITEMS = "items"
+    NEXT_PAGE_TOKEN = "nextPageToken"
     
     # TaskItem properties
     COMPLETED = "completed"